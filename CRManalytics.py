@@ -0,0 +1,413 @@
+import logging
+import threading
+import time
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+try:
+    import numpy as np
+except ImportError:  # chunks are aggregated row by row instead
+    np = None
+
+logger = logging.getLogger("CRM ANALYTICS")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_seconds(timestamp):
+    """Naive UTC datetime -> seconds since the epoch, without the local timezone getting involved"""
+    return (timestamp - EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def percentile(sorted_values, fraction):
+    """Linear-interpolated percentile of an already sorted sequence"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(values):
+    """count / mean / p50 / p90 / p95 / max of a column of numbers"""
+    values = sorted(values)
+    if not values:
+        return {'count': 0, 'mean': None, 'p50': None, 'p90': None, 'p95': None, 'max': None}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 2),
+        'p50': round(percentile(values, 0.5), 2),
+        'p90': round(percentile(values, 0.9), 2),
+        'p95': round(percentile(values, 0.95), 2),
+        'max': round(values[-1], 2)
+    }
+
+
+class MessageColumns:
+    """A chunk of messages held as parallel columns instead of ORM objects"""
+
+    def __init__(self, rows):
+        self.id = array('q')
+        self.conversation_id = array('q')
+        self.sender_id = array('q')
+        self.timestamp = array('d')
+        self.sender_type = []
+
+        for message_id, conversation_id, sender_type, sender_id, timestamp in rows:
+            self.id.append(message_id)
+            self.conversation_id.append(conversation_id)
+            self.sender_type.append(sender_type)
+            self.sender_id.append(sender_id or 0)
+            self.timestamp.append(to_seconds(timestamp))
+
+    def __len__(self):
+        return len(self.id)
+
+
+def _new_conversation_stats():
+    return {'total': 0, 'user': 0, 'agent': 0, 'ai': 0,
+            'first_user': None, 'first_agent': None, 'first_agent_id': None, 'last': None}
+
+
+def aggregate(chunk):
+    """({conversation_id: stats}, {day: [messages, user, agent]}) for a chunk of messages"""
+    per_conversation = defaultdict(_new_conversation_stats)
+    per_day = defaultdict(lambda: [0, 0, 0])
+
+    for conversation_id, sender_type, sender_id, timestamp in zip(
+            chunk.conversation_id, chunk.sender_type, chunk.sender_id, chunk.timestamp):
+        stats = per_conversation[conversation_id]
+        stats['total'] += 1
+        day = per_day[from_seconds(timestamp).date()]
+        day[0] += 1
+
+        if sender_type == 'user':
+            stats['user'] += 1
+            day[1] += 1
+            if stats['first_user'] is None or timestamp < stats['first_user']:
+                stats['first_user'] = timestamp
+        elif sender_type == 'agent':
+            stats['agent'] += 1
+            day[2] += 1
+            if stats['first_agent'] is None or timestamp < stats['first_agent']:
+                stats['first_agent'] = timestamp
+                stats['first_agent_id'] = sender_id or None
+        else:
+            stats['ai'] += 1
+
+        if stats['last'] is None or timestamp > stats['last']:
+            stats['last'] = timestamp
+
+    return per_conversation, per_day
+
+
+def aggregate_vectorised(chunk):
+    """Same result as aggregate(), from grouped NumPy reductions over the columns"""
+    conversation_ids = np.frombuffer(chunk.conversation_id, dtype=np.int64)
+    sender_ids = np.frombuffer(chunk.sender_id, dtype=np.int64)
+    timestamps = np.frombuffer(chunk.timestamp, dtype=np.float64)
+    sender_types = np.array(chunk.sender_type)
+    is_user = sender_types == 'user'
+    is_agent = sender_types == 'agent'
+
+    conversations, group = np.unique(conversation_ids, return_inverse=True)
+    size = len(conversations)
+    total = np.bincount(group, minlength=size)
+    user = np.bincount(group[is_user], minlength=size)
+    agent = np.bincount(group[is_agent], minlength=size)
+    first_user = np.full(size, np.inf)
+    np.minimum.at(first_user, group[is_user], timestamps[is_user])
+    last = np.full(size, -np.inf)
+    np.maximum.at(last, group, timestamps)
+
+    # Earliest agent message of each conversation; the sort is stable, so ties go to the lowest id
+    agent_rows = np.flatnonzero(is_agent)
+    ordered = agent_rows[np.lexsort((timestamps[agent_rows], group[agent_rows]))]
+    firsts = ordered[np.r_[True, group[ordered][1:] != group[ordered][:-1]]] if len(ordered) else ordered
+    first_agent = dict(zip(group[firsts].tolist(), zip(timestamps[firsts].tolist(), sender_ids[firsts].tolist())))
+
+    per_conversation = {}
+    for position, conversation_id in enumerate(conversations.tolist()):
+        first_agent_at, first_agent_id = first_agent.get(position, (None, 0))
+        per_conversation[conversation_id] = {
+            'total': int(total[position]), 'user': int(user[position]), 'agent': int(agent[position]),
+            'ai': int(total[position] - user[position] - agent[position]),
+            'first_user': float(first_user[position]) if user[position] else None,
+            'first_agent': first_agent_at, 'first_agent_id': first_agent_id or None,
+            'last': float(last[position])
+        }
+
+    days, day_group = np.unique((timestamps // 86400).astype(np.int64), return_inverse=True)
+    day_totals = np.bincount(day_group, minlength=len(days))
+    day_users = np.bincount(day_group[is_user], minlength=len(days))
+    day_agents = np.bincount(day_group[is_agent], minlength=len(days))
+    per_day = {
+        EPOCH.date() + timedelta(days=day): [int(messages), int(users), int(agents)]
+        for day, messages, users, agents in zip(days.tolist(), day_totals, day_users, day_agents)
+    }
+    return per_conversation, per_day
+
+
+class ConversationAnalytics:
+    """Incrementally maintained response-time, resolution and load metrics.
+
+    Each refresh reads only messages past the stored watermark, folds them
+    into one ConversationMetrics row per conversation and per-day totals, and
+    re-reads conversations updated since the previous refresh so status
+    changes and assignments are picked up. Reports are computed from the
+    per-conversation rows, never from the messages table.
+
+    Refreshes are serialised: by a lock within the process and by locking
+    the watermark row across processes, since two runs folding the same
+    chunk would count it twice. With NumPy a chunk is aggregated in
+    vectorised passes over its columns.
+    """
+
+    WATERMARK = 'messages'
+
+    def __init__(self, app, db, Conversation, Message, ConversationMetrics, AnalyticsDaily, AnalyticsWatermark,
+                 chunk_size=5000):
+        self.app = app
+        self.db = db
+        self.Conversation = Conversation
+        self.Message = Message
+        self.ConversationMetrics = ConversationMetrics
+        self.AnalyticsDaily = AnalyticsDaily
+        self.AnalyticsWatermark = AnalyticsWatermark
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watermark(self):
+        """The watermark row, locked until the next commit where the database supports it"""
+        session = self.db.session
+        watermark = session.execute(
+            select(self.AnalyticsWatermark)
+            .where(self.AnalyticsWatermark.name == self.WATERMARK)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        ).scalar()
+        if watermark is None:
+            watermark = self.AnalyticsWatermark(name=self.WATERMARK, last_id=0)
+            session.add(watermark)
+        return watermark
+
+    def refresh(self):
+        """Fold new messages and changed conversations into the metrics tables"""
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        session = self.db.session
+        Message = self.Message
+        watermark = self.watermark()
+        started_at = datetime.utcnow()
+        processed = 0
+
+        while True:
+            chunk = MessageColumns(session.execute(
+                select(Message.id, Message.conversation_id, Message.sender_type, Message.sender_id, Message.timestamp)
+                .where(Message.id > watermark.last_id)
+                .order_by(Message.id)
+                .limit(self.chunk_size)
+            ).all())
+            if not len(chunk):
+                break
+
+            touched = self._fold_messages(chunk)
+            self._sync_conversations(touched)
+            watermark.last_id = chunk.id[-1]
+            session.commit()
+            processed += len(chunk)
+            watermark = self.watermark()
+
+        # Closures and reassignments without new messages
+        if watermark.last_run_at:
+            changed = session.execute(
+                select(self.Conversation.id).where(self.Conversation.updated_at >= watermark.last_run_at)
+            ).scalars().all()
+            for start in range(0, len(changed), self.chunk_size):
+                self._sync_conversations(changed[start:start + self.chunk_size])
+
+        watermark.last_run_at = started_at
+        session.commit()
+
+        if processed:
+            logger.info(f"Analytics processed {processed} new messages")
+        return processed
+
+    def start(self, interval=300):
+        """Keep the metrics up to date from a daemon thread"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name="crm-analytics", daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing analytics: {e}", exc_info=True)
+            time.sleep(interval)
+
+    def _fold_messages(self, chunk):
+        """Aggregate a chunk per conversation and per day, then merge into the stored rows"""
+        per_conversation, per_day = aggregate_vectorised(chunk) if np is not None else aggregate(chunk)
+
+        session = self.db.session
+        Metrics = self.ConversationMetrics
+        existing = {
+            row.conversation_id: row for row in session.execute(
+                select(Metrics).where(Metrics.conversation_id.in_(list(per_conversation)))
+            ).scalars()
+        }
+
+        for conversation_id, stats in per_conversation.items():
+            row = existing.get(conversation_id)
+            if row is None:
+                row = Metrics(conversation_id=conversation_id, message_count=0, user_message_count=0,
+                              agent_message_count=0, ai_message_count=0)
+                session.add(row)
+
+            row.message_count += stats['total']
+            row.user_message_count += stats['user']
+            row.agent_message_count += stats['agent']
+            row.ai_message_count += stats['ai']
+            row.first_user_message_at = self._earliest(row.first_user_message_at, stats['first_user'])
+            if stats['first_agent'] is not None:
+                first_agent = from_seconds(stats['first_agent'])
+                if row.first_agent_response_at is None or first_agent < row.first_agent_response_at:
+                    row.first_agent_response_at = first_agent
+                    row.first_agent_id = stats['first_agent_id']
+            last = from_seconds(stats['last'])
+            if row.last_message_at is None or last > row.last_message_at:
+                row.last_message_at = last
+
+        Daily = self.AnalyticsDaily
+        days = {
+            row.day: row for row in session.execute(select(Daily).where(Daily.day.in_(list(per_day)))).scalars()
+        }
+        for day, (total, user, agent) in per_day.items():
+            row = days.get(day)
+            if row is None:
+                row = Daily(day=day, messages=0, user_messages=0, agent_messages=0)
+                session.add(row)
+            row.messages += total
+            row.user_messages += user
+            row.agent_messages += agent
+
+        session.flush()
+        return list(per_conversation)
+
+    @staticmethod
+    def _earliest(current, timestamp):
+        if timestamp is None:
+            return current
+        candidate = from_seconds(timestamp)
+        return candidate if current is None or candidate < current else current
+
+    def _sync_conversations(self, conversation_ids):
+        """Copy status, assignment and timing from the conversations into their metrics rows"""
+        if not conversation_ids:
+            return
+        session = self.db.session
+        Conversation = self.Conversation
+        Metrics = self.ConversationMetrics
+
+        rows = {
+            row.conversation_id: row for row in session.execute(
+                select(Metrics).where(Metrics.conversation_id.in_(conversation_ids))
+            ).scalars()
+        }
+        for conversation_id, status, agent_id, created_at, closed_at in session.execute(
+                select(Conversation.id, Conversation.status, Conversation.assigned_agent_id,
+                       Conversation.created_at, Conversation.closed_at)
+                .where(Conversation.id.in_(conversation_ids))):
+            row = rows.get(conversation_id)
+            if row is None:
+                row = Metrics(conversation_id=conversation_id, message_count=0, user_message_count=0,
+                              agent_message_count=0, ai_message_count=0)
+                session.add(row)
+            row.status = status
+            row.assigned_agent_id = agent_id
+            row.created_at = created_at
+            row.closed_at = closed_at
+        session.flush()
+
+    def report(self, days=14):
+        """Percentiles and per-agent load computed over the per-conversation columns"""
+        Metrics = self.ConversationMetrics
+        rows = self.db.session.execute(
+            select(Metrics.assigned_agent_id, Metrics.first_agent_id, Metrics.message_count,
+                   Metrics.agent_message_count, Metrics.status, Metrics.created_at, Metrics.closed_at,
+                   Metrics.first_user_message_at, Metrics.first_agent_response_at)
+        ).all()
+
+        first_response = array('d')
+        resolution = array('d')
+        messages = array('d')
+        agents = defaultdict(lambda: {'conversations': 0, 'open': 0, 'agent_messages': 0,
+                                      'first_response': array('d'), 'resolution': array('d')})
+
+        for (assigned_agent_id, first_agent_id, message_count, agent_message_count, status, created_at,
+             closed_at, first_user_at, first_agent_at) in rows:
+            messages.append(message_count)
+            agent_id = assigned_agent_id or first_agent_id
+            agent = agents[agent_id] if agent_id else None
+
+            if first_user_at and first_agent_at and first_agent_at >= first_user_at:
+                seconds = (first_agent_at - first_user_at).total_seconds()
+                first_response.append(seconds)
+                if agent is not None:
+                    agent['first_response'].append(seconds)
+            if created_at and closed_at:
+                seconds = (closed_at - created_at).total_seconds()
+                resolution.append(seconds)
+                if agent is not None:
+                    agent['resolution'].append(seconds)
+            if agent is not None:
+                agent['conversations'] += 1
+                agent['agent_messages'] += agent_message_count
+                if status in ('open', 'assigned'):
+                    agent['open'] += 1
+
+        watermark = self.db.session.get(self.AnalyticsWatermark, self.WATERMARK)
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+        Daily = self.AnalyticsDaily
+        throughput = [
+            {'day': day.isoformat(), 'messages': total, 'user_messages': user, 'agent_messages': agent}
+            for day, total, user, agent in self.db.session.execute(
+                select(Daily.day, Daily.messages, Daily.user_messages, Daily.agent_messages)
+                .where(Daily.day >= since).order_by(Daily.day)
+            )
+        ]
+
+        return {
+            'conversations': len(rows),
+            'first_response_seconds': summarize(first_response),
+            'resolution_seconds': summarize(resolution),
+            'messages_per_conversation': summarize(messages),
+            'agents': {
+                agent_id: {
+                    'conversations': stats['conversations'],
+                    'open_conversations': stats['open'],
+                    'agent_messages': stats['agent_messages'],
+                    'first_response_seconds': summarize(stats['first_response']),
+                    'resolution_seconds': summarize(stats['resolution'])
+                }
+                for agent_id, stats in agents.items()
+            },
+            'throughput': throughput,
+            'last_message_id': watermark.last_id if watermark else 0,
+            'last_refresh': watermark.last_run_at.isoformat() if watermark and watermark.last_run_at else None
+        }
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+logger = logging.getLogger("CRM ARCHIVE")
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived_conversations (
+    archive_id INTEGER PRIMARY KEY,
+    id INTEGER NOT NULL,
+    telegram_user_id INTEGER NOT NULL,
+    status TEXT,
+    assigned_agent_id INTEGER,
+    title TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    closed_at TEXT,
+    message_count INTEGER NOT NULL,
+    archived_at TEXT NOT NULL,
+    messages BLOB NOT NULL,
+    -- SQLite may hand a deleted conversation's id to a new conversation
+    UNIQUE (id, created_at)
+);
+CREATE INDEX IF NOT EXISTS ix_archived_conversations_user ON archived_conversations (telegram_user_id, closed_at);
+"""
+
+MESSAGE_FIELDS = ('id', 'sender_type', 'sender_id', 'content', 'message_type', 'timestamp', 'is_ai_response',
+                  'read_by_agent', 'template_id', 'template_version')
+
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+
+def parse_iso(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+class ArchivedMessage:
+    """Read-only stand-in for a Message row restored from the archive"""
+
+    # Absent from conversations archived before catalogue responses
+    template_id = None
+    template_version = None
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self.timestamp = parse_iso(fields['timestamp'])
+
+
+class ConversationArchiver:
+    """Moves long-closed conversations out of the hot tables into a compressed SQLite archive.
+
+    Each conversation becomes one archive row holding its metadata and its
+    messages as zlib-compressed JSON. The archive row is committed before the
+    originals are deleted, and re-archiving replaces it, so a crash between
+    the two steps never loses data. Work is done in small batches with a
+    pause in between, so bot writes are never blocked for long.
+    """
+
+    def __init__(self, app, db, Conversation, Message, path, retention_days=90, batch_size=50, pause=0.5,
+                 interval=3600, dependent_tables=(), after_batch=None):
+        self.app = app
+        self.db = db
+        self.Conversation = Conversation
+        self.Message = Message
+        self.path = path
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.dependent_tables = dependent_tables
+        self.after_batch = after_batch
+        self.stats = {'conversations': 0, 'messages': 0, 'bytes_in': 0, 'bytes_out': 0, 'runs': 0}
+        self._thread = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as archive:
+            archive.executescript(ARCHIVE_SCHEMA)
+
+    def _connect(self):
+        archive = sqlite3.connect(self.path, timeout=30)
+        archive.row_factory = sqlite3.Row
+        return archive
+
+    def archive_batch(self, cutoff):
+        """Archive up to batch_size conversations closed before cutoff; returns how many"""
+        session = self.db.session
+        Conversation = self.Conversation
+        Message = self.Message
+
+        conversations = session.execute(
+            select(Conversation.id, Conversation.telegram_user_id, Conversation.status,
+                   Conversation.assigned_agent_id, Conversation.title, Conversation.created_at,
+                   Conversation.updated_at, Conversation.closed_at)
+            .where(Conversation.status == 'completed', Conversation.closed_at < cutoff)
+            .order_by(Conversation.closed_at)
+            .limit(self.batch_size)
+        ).all()
+        if not conversations:
+            session.rollback()
+            return 0
+
+        conversation_ids = [conv.id for conv in conversations]
+        messages = {conversation_id: [] for conversation_id in conversation_ids}
+        for row in session.execute(
+                select(Message.conversation_id, *(getattr(Message, field) for field in MESSAGE_FIELDS))
+                .where(Message.conversation_id.in_(conversation_ids))
+                .order_by(Message.timestamp, Message.id)):
+            messages[row[0]].append({
+                field: isoformat(value) if field == 'timestamp' else value
+                for field, value in zip(MESSAGE_FIELDS, row[1:])
+            })
+        # Release the read transaction before touching the archive file
+        session.rollback()
+
+        archived_at = datetime.utcnow().isoformat()
+        rows = []
+        message_count = 0
+        for conv in conversations:
+            raw = json.dumps(messages[conv.id], ensure_ascii=False).encode()
+            payload = zlib.compress(raw, 6)
+            self.stats['bytes_in'] += len(raw)
+            self.stats['bytes_out'] += len(payload)
+            message_count += len(messages[conv.id])
+            rows.append((None, conv.id, conv.telegram_user_id, conv.status, conv.assigned_agent_id, conv.title,
+                         isoformat(conv.created_at), isoformat(conv.updated_at), isoformat(conv.closed_at),
+                         len(messages[conv.id]), archived_at, payload))
+
+        with closing(self._connect()) as archive:
+            with archive:
+                archive.executemany(
+                    "INSERT OR REPLACE INTO archived_conversations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+
+        # Only once the archive is durable do the originals go, by the ids that were archived.
+        # The check for unarchived messages runs after the first delete, when the write lock
+        # (row locks on PostgreSQL) keeps new ones out. A conversation that got another
+        # message meanwhile stays put and is archived again on the next run.
+        while conversation_ids:
+            session.execute(select(Conversation.id).where(Conversation.id.in_(conversation_ids)).with_for_update())
+            session.execute(delete(Message).where(Message.id.in_(
+                [message['id'] for conversation_id in conversation_ids for message in messages[conversation_id]]
+            )))
+            grown = set(session.execute(
+                select(Message.conversation_id).where(Message.conversation_id.in_(conversation_ids)).distinct()
+            ).scalars())
+            if not grown:
+                break
+            session.rollback()
+            conversation_ids = [conversation_id for conversation_id in conversation_ids if conversation_id not in grown]
+        message_count = sum(len(messages[conversation_id]) for conversation_id in conversation_ids)
+
+        for table, column in self.dependent_tables:
+            session.execute(delete(table).where(column.in_(conversation_ids)))
+        session.execute(delete(Conversation).where(Conversation.id.in_(conversation_ids)))
+        if self.after_batch:
+            self.after_batch({'conversations': len(conversation_ids), 'messages': message_count})
+        session.commit()
+
+        self.stats['conversations'] += len(conversation_ids)
+        self.stats['messages'] += message_count
+        logger.info(f"Archived {len(conversation_ids)} conversations with {message_count} messages")
+        return len(conversations)
+
+    def run_once(self, retention_days=None):
+        """Archive everything past the retention period, batch by batch"""
+        days = self.retention_days if retention_days is None else retention_days
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        total = 0
+        with self.app.app_context():
+            while True:
+                archived = self.archive_batch(cutoff)
+                total += archived
+                if archived < self.batch_size:
+                    break
+                time.sleep(self.pause)
+        self.stats['runs'] += 1
+        return total
+
+    def start(self):
+        """Archive in a daemon thread every interval seconds"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, name="crm-archiver", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Error archiving conversations: {e}", exc_info=True)
+            time.sleep(self.interval)
+
+    def conversations_for_user(self, telegram_user_id):
+        """Archived conversation summaries for a Telegram user, newest first"""
+        with closing(self._connect()) as archive:
+            rows = archive.execute(
+                "SELECT archive_id, id, status, assigned_agent_id, title, created_at, updated_at, closed_at, message_count, "
+                "archived_at FROM archived_conversations WHERE telegram_user_id = ? ORDER BY closed_at DESC",
+                (telegram_user_id,)
+            ).fetchall()
+        return [
+            {**dict(row), **{key: parse_iso(row[key]) for key in ('created_at', 'updated_at', 'closed_at', 'archived_at')}}
+            for row in rows
+        ]
+
+    def load(self, archive_id):
+        """(conversation summary, messages) of an archived conversation, or None"""
+        with closing(self._connect()) as archive:
+            row = archive.execute("SELECT * FROM archived_conversations WHERE archive_id = ?", (archive_id,)).fetchone()
+        if row is None:
+            return None
+
+        conversation = {key: row[key] for key in row.keys() if key != 'messages'}
+        for key in ('created_at', 'updated_at', 'closed_at', 'archived_at'):
+            conversation[key] = parse_iso(conversation[key])
+        messages = [ArchivedMessage(fields) for fields in json.loads(zlib.decompress(row['messages']))]
+        return conversation, messages
+
+    def summary(self):
+        with closing(self._connect()) as archive:
+            count, messages = archive.execute(
+                "SELECT count(*), coalesce(sum(message_count), 0) FROM archived_conversations"
+            ).fetchone()
+        return {
+            'path': self.path,
+            'retention_days': self.retention_days,
+            'archived_conversations': count,
+            'archived_messages': messages,
+            'this_process': self.stats
+        }
@@ -0,0 +1,314 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import bindparam, exists, insert, select, update
+
+logger = logging.getLogger("CRM BROADCAST")
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ChatRateLimiter:
+    """Keeps a minimum interval between messages to the same chat"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_allowed.get(chat_id, now))
+            self._next_allowed[chat_id] = slot + self.interval
+
+            # Forget chats whose slot has passed so the map stays small
+            if len(self._next_allowed) > 10000:
+                self._next_allowed = {key: value for key, value in self._next_allowed.items() if value > now}
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class BroadcastEngine:
+    """Rate-limited mass messaging to a segment of Telegram users.
+
+    Recipients are materialized into broadcast_recipients with a status per
+    row, so a broadcast interrupted by a crash resumes with the rows that are
+    still pending. Statuses are written as sends complete, flush_size at a
+    time or every flush_interval seconds, and at most two sends per worker
+    are queued, so a crash re-sends only those and the last unwritten batch.
+    """
+
+    def __init__(self, app, db, TelegramUser, Conversation, Broadcast, BroadcastRecipient, sender,
+                 global_rate=25, per_chat_interval=1.0, chunk_size=500, workers=8, flush_size=25,
+                 flush_interval=1.0):
+        self.app = app
+        self.db = db
+        self.TelegramUser = TelegramUser
+        self.Conversation = Conversation
+        self.Broadcast = Broadcast
+        self.BroadcastRecipient = BroadcastRecipient
+        self.sender = sender
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        # Telegram allows about 30 messages per second overall and 1 per second per chat
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_limiter = ChatRateLimiter(per_chat_interval)
+
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def segment_filters(self, segment):
+        """Translate a segment description into SQL filters on TelegramUser"""
+        TelegramUser = self.TelegramUser
+        Conversation = self.Conversation
+        filters = []
+
+        if segment.get('language_code'):
+            filters.append(TelegramUser.language_code == segment['language_code'])
+
+        conversation_filters = []
+        if segment.get('conversation_status'):
+            conversation_filters.append(Conversation.status == segment['conversation_status'])
+        if segment.get('active_since'):
+            conversation_filters.append(Conversation.updated_at >= datetime.fromisoformat(segment['active_since']))
+        if segment.get('active_until'):
+            conversation_filters.append(Conversation.updated_at < datetime.fromisoformat(segment['active_until']))
+
+        if conversation_filters:
+            filters.append(exists().where(Conversation.telegram_user_id == TelegramUser.id, *conversation_filters))
+
+        return filters
+
+    def create(self, text, segment=None, created_by=None):
+        """Create a broadcast and materialize its recipients in chunks.
+
+        The broadcast and all its recipients commit together, so resume()
+        never finds a broadcast whose audience was only partly written.
+        """
+        segment = segment or {}
+        filters = self.segment_filters(segment)
+
+        broadcast = self.Broadcast(text=text, segment=json.dumps(segment), created_by=created_by)
+        self.db.session.add(broadcast)
+        self.db.session.flush()
+        broadcast_id = broadcast.id
+
+        total = 0
+        last_id = 0
+        while True:
+            rows = self.db.session.execute(
+                select(self.TelegramUser.id, self.TelegramUser.telegram_id)
+                .where(self.TelegramUser.id > last_id, *filters)
+                .order_by(self.TelegramUser.id)
+                .limit(self.chunk_size)
+            ).all()
+            if not rows:
+                break
+
+            self.db.session.execute(insert(self.BroadcastRecipient), [
+                {'broadcast_id': broadcast_id, 'telegram_user_id': user_id, 'chat_id': chat_id, 'status': 'pending'}
+                for user_id, chat_id in rows
+            ])
+            total += len(rows)
+            last_id = rows[-1][0]
+
+        broadcast.total_recipients = total
+        self.db.session.commit()
+        logger.info(f"Broadcast #{broadcast_id} created for {total} recipients")
+        return broadcast_id
+
+    def start(self, broadcast_id):
+        """Deliver a broadcast in a background thread"""
+        with self._lock:
+            if broadcast_id in self._running:
+                return False
+            thread = threading.Thread(target=self.run, args=(broadcast_id,), name=f"crm-broadcast-{broadcast_id}",
+                                      daemon=True)
+            self._running[broadcast_id] = thread
+        thread.start()
+        return True
+
+    def resume(self):
+        """Restart broadcasts that were interrupted by a shutdown or crash"""
+        with self.app.app_context():
+            broadcast_ids = self.db.session.execute(
+                select(self.Broadcast.id).where(self.Broadcast.status.in_(['pending', 'running']))
+            ).scalars().all()
+        for broadcast_id in broadcast_ids:
+            logger.info(f"Resuming broadcast #{broadcast_id}")
+            self.start(broadcast_id)
+
+    def cancel(self, broadcast_id):
+        self.db.session.execute(
+            update(self.Broadcast)
+            .where(self.Broadcast.id == broadcast_id, self.Broadcast.status.in_(['pending', 'running']))
+            .values(status='cancelled', finished_at=datetime.utcnow())
+        )
+        self.db.session.commit()
+
+    def _deliver(self, chat_id, text):
+        self.chat_limiter.acquire(chat_id)
+        try:
+            self.sender.send_now(chat_id, text)
+            return 'sent', None
+        except Exception as e:
+            return 'failed', str(e)[:255]
+
+    def run(self, broadcast_id):
+        """Send every pending recipient of a broadcast, one chunk at a time"""
+        try:
+            with self.app.app_context():
+                self._run(broadcast_id)
+        except Exception as e:
+            logger.error(f"Error in broadcast #{broadcast_id}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._running.pop(broadcast_id, None)
+
+    def _run(self, broadcast_id):
+        session = self.db.session
+        Broadcast = self.Broadcast
+        Recipient = self.BroadcastRecipient
+
+        broadcast = session.get(Broadcast, broadcast_id)
+        if not broadcast or broadcast.status not in ('pending', 'running'):
+            return
+        text = broadcast.text
+        if not broadcast.started_at:
+            broadcast.started_at = datetime.utcnow()
+        broadcast.status = 'running'
+        session.commit()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                status = session.execute(select(Broadcast.status).where(Broadcast.id == broadcast_id)).scalar()
+                if status != 'running':
+                    logger.info(f"Broadcast #{broadcast_id} stopped with status {status}")
+                    return
+
+                recipients = session.execute(
+                    select(Recipient.id, Recipient.chat_id)
+                    .where(Recipient.broadcast_id == broadcast_id, Recipient.status == 'pending')
+                    .order_by(Recipient.id)
+                    .limit(self.chunk_size)
+                ).all()
+                if not recipients:
+                    break
+
+                in_flight = []
+                results = []
+                flushed_at = time.monotonic()
+                for recipient_id, chat_id in recipients:
+                    self.global_bucket.acquire()
+                    in_flight.append((recipient_id, executor.submit(self._deliver, chat_id, text)))
+                    in_flight = self._collect(in_flight, results)
+                    # Don't queue sends far ahead of the workers; their statuses would wait with them
+                    while len(in_flight) > self.workers * 2:
+                        self._collect([in_flight.pop(0)], results, wait=True)
+                    if len(results) >= self.flush_size or \
+                            (results and time.monotonic() - flushed_at >= self.flush_interval):
+                        self._record(broadcast_id, results)
+                        results = []
+                        flushed_at = time.monotonic()
+
+                for recipient_id, future in in_flight:
+                    self._collect([(recipient_id, future)], results, wait=True)
+                    if len(results) >= self.flush_size:
+                        self._record(broadcast_id, results)
+                        results = []
+                if results:
+                    self._record(broadcast_id, results)
+
+        session.execute(
+            update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status == 'running')
+            .values(status='completed', finished_at=datetime.utcnow())
+        )
+        session.commit()
+        logger.info(f"Broadcast #{broadcast_id} completed")
+
+    @staticmethod
+    def _collect(in_flight, results, wait=False):
+        """Move finished sends from in_flight to results; returns the sends still in flight"""
+        still_running = []
+        for recipient_id, future in in_flight:
+            if not wait and not future.done():
+                still_running.append((recipient_id, future))
+                continue
+            result, error = future.result()
+            results.append({
+                'recipient_id': recipient_id,
+                'status': result,
+                'error': error,
+                'sent_at': datetime.utcnow() if result == 'sent' else None
+            })
+        return still_running
+
+    def _record(self, broadcast_id, results):
+        """Write a batch of delivery results and the broadcast's counters in one transaction"""
+        session = self.db.session
+        Broadcast = self.Broadcast
+        Recipient = self.BroadcastRecipient
+        sent = sum(1 for row in results if row['status'] == 'sent')
+        session.connection().execute(
+            update(Recipient)
+            .where(Recipient.id == bindparam('recipient_id'))
+            .values(status=bindparam('status'), error=bindparam('error'), sent_at=bindparam('sent_at'))
+            .execution_options(synchronize_session=False),
+            results
+        )
+        session.execute(
+            update(Broadcast).where(Broadcast.id == broadcast_id).values(
+                sent_count=Broadcast.sent_count + sent,
+                failed_count=Broadcast.failed_count + len(results) - sent
+            )
+        )
+        session.commit()
+
+    def progress(self, broadcast):
+        """Delivery counters and throughput for a broadcast"""
+        end = broadcast.finished_at or datetime.utcnow()
+        elapsed = (end - broadcast.started_at).total_seconds() if broadcast.started_at else 0
+        done = broadcast.sent_count + broadcast.failed_count
+        return {
+            'id': broadcast.id,
+            'status': broadcast.status,
+            'segment': json.loads(broadcast.segment or '{}'),
+            'total_recipients': broadcast.total_recipients,
+            'sent': broadcast.sent_count,
+            'failed': broadcast.failed_count,
+            'pending': broadcast.total_recipients - done,
+            'elapsed_seconds': round(elapsed, 3),
+            'messages_per_second': round(done / elapsed, 2) if elapsed else None,
+            'created_at': broadcast.created_at.isoformat() if broadcast.created_at else None,
+            'started_at': broadcast.started_at.isoformat() if broadcast.started_at else None,
+            'finished_at': broadcast.finished_at.isoformat() if broadcast.finished_at else None
+        }
@@ -1,22 +1,74 @@
 import telebot
 import logging
 import re
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
-from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import event, update
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from CRMhub import serialize_message, serialize_conversation
+from CRMworkers import KeyedWorkerPool
+from CRMcache import LRUCache
+from CRMsessions import MemorySessionStore
+from CRMintents import IntentEngine
+from CRMresponders import AutoReplyService, IntentResponder
 
 logger = logging.getLogger("CRM CLASS BOT")
 
+# Detached snapshots served from the cache instead of re-querying the rows
+TelegramUserRef = namedtuple('TelegramUserRef', 'id telegram_id username first_name last_name')
+ConversationRef = namedtuple('ConversationRef', 'id telegram_user_id status assigned_agent_id')
+
 class CRMTelegramBot:
-    def __init__(self, app, db, telegram_bot_token, TelegramUser, Conversation, Message):
+    def __init__(self, app, db, telegram_bot_token, TelegramUser, Conversation, Message, hub=None,
+                 workers=0, queue_size=100, write_mode='handler', message_writer=None,
+                 cache_size=10000, cache_ttl=300, session_store=None, auto_reply=None, responses=None):
         self.app = app
         self.db = db
-        self.bot = telebot.TeleBot(telegram_bot_token)
+        self.bot = telebot.TeleBot(telegram_bot_token, threaded=not workers)
         self.TelegramUser = TelegramUser
         self.Conversation = Conversation
         self.Message = Message
 
+        # Live update hub shared with the web dashboard
+        self.hub = hub
+
+        # Batching of DB writes, see CRMpersistence.WRITE_MODES
+        if write_mode == 'window' and message_writer is None:
+            raise ValueError("write_mode 'window' needs a message_writer")
+        self.write_mode = write_mode
+        self.message_writer = message_writer
+        self._handler_state = threading.local()
+        event.listen(db.session, 'after_rollback', self._after_rollback)
+
+        # telegram_id -> TelegramUserRef, TelegramUser.id -> open ConversationRef
+        self.user_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self.conversation_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        if hub:
+            hub.add_listener(self.on_hub_event)
+
         # User session storage for contract process
-        self.user_sessions = {}
+        self.user_sessions = session_store if session_store is not None else MemorySessionStore()
+
+        # Automatic replies; keyword intents only unless a configured service is passed in
+        if auto_reply is None:
+            intents = IntentEngine()
+            auto_reply = AutoReplyService([IntentResponder(intents)], fallback=intents.rules.fallback)
+        self.auto_reply = auto_reply
+
+        # Static replies (welcome, pricing...) from the response catalogue, stored by reference
+        if responses is None:
+            raise ValueError("CRMTelegramBot needs a response catalogue")
+        self.responses = responses
+
+        # Per-user ordered worker pool; without it telebot's own threads are used
+        self.worker_pool = None
+        if workers:
+            self.worker_pool = KeyedWorkerPool(num_workers=workers, queue_size=queue_size, name="crm-bot")
+            self._process_updates = self.bot.process_new_updates
+            self.bot.process_new_updates = self.dispatch_updates
 
         self.setup_handlers()
 
@@ -36,6 +88,22 @@ class CRMTelegramBot:
         self.bot.callback_query_handler(func=lambda call: call.data.startswith('contract_'))(
             self.contract_callback_handler)
 
+    @staticmethod
+    def update_key(update):
+        """Key that keeps updates from the same Telegram user in order"""
+        for event in (update.message, update.edited_message, update.callback_query):
+            if event is not None and event.from_user is not None:
+                return event.from_user.id
+        return update.update_id
+
+    def dispatch_updates(self, updates):
+        """Hand updates to the worker pool, blocking while it is saturated"""
+        for update in updates:
+            # Advance the offset here so polling doesn't fetch queued updates again
+            if update.update_id > self.bot.last_update_id:
+                self.bot.last_update_id = update.update_id
+            self.worker_pool.submit(self.update_key(update), self._process_updates, [update])
+
     def check_contract_session(self, message):
         """Check if user is in contract session"""
         return message.from_user.id in self.user_sessions
@@ -49,8 +117,107 @@ class CRMTelegramBot:
 
         return wrapper
 
+    @contextmanager
+    def handler_context(self):
+        """App context plus one transaction for everything a handler writes.
+
+        Re-entrant, so helpers called from a handler share its session.
+        Work registered with after_commit() runs once the transaction is
+        committed, and is dropped if it rolls back; in 'immediate' mode
+        every write commits on its own. Helpers raise inside a handler, so
+        a failure rolls the whole handler back here, once.
+        """
+        state = self._handler_state
+        if getattr(state, 'active', False):
+            yield
+            return
+
+        state.active = True
+        state.after_commit = []
+        try:
+            with self.app.app_context():
+                state.session = self.db.session()
+                try:
+                    yield
+                    self.db.session.commit()
+                except Exception:
+                    self.db.session.rollback()
+                    raise
+                finally:
+                    state.session = None
+
+            # A failing callback, e.g. a Bot API error, must not skip the others
+            for callback in state.after_commit:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Error after handler commit: {e}", exc_info=True)
+        finally:
+            state.active = False
+            state.after_commit = []
+
+    def _after_rollback(self, session):
+        """Forget the cache updates, publishes and replies of a handler transaction that rolled back"""
+        state = self._handler_state
+        if getattr(state, 'session', None) is session:
+            state.after_commit = []
+
+    def in_handler(self):
+        return getattr(self._handler_state, 'active', False)
+
+    def in_transaction(self):
+        """True when writes should be flushed and left for the handler to commit"""
+        return self.write_mode != 'immediate' and self.in_handler()
+
+    def commit(self):
+        """Commit now, or only flush when running inside a handler transaction"""
+        if self.in_transaction():
+            self.db.session.flush()
+        else:
+            self.db.session.commit()
+
+    def after_commit(self, callback):
+        """Run callback once the current handler transaction has committed"""
+        if self.in_transaction():
+            self._handler_state.after_commit.append(callback)
+        else:
+            callback()
+
+    def send_later(self, api_call, *args, **kwargs):
+        """Make a Bot API call once the handler's transaction has committed.
+
+        No database locks are held across the Telegram round-trip, and a
+        failed send can't roll back the messages already saved.
+        """
+        self.after_commit(lambda: api_call(*args, **kwargs))
+
+    def publish(self, event, data):
+        if self.hub:
+            self.after_commit(lambda: self.hub.publish(event, data))
+
+    def on_hub_event(self, event, data):
+        """Drop cached conversations that were closed or reassigned elsewhere"""
+        if event == 'conversation':
+            self.conversation_cache.pop(data['telegram_user_id'])
+
+    def cache_stats(self):
+        return {
+            'users': self.user_cache.stats(),
+            'conversations': self.conversation_cache.stats(),
+            'contract_sessions': self.user_sessions.stats()
+        }
+
+    def publish_conversation(self, conversation):
+        """Push conversation changes to open dashboards"""
+        if self.hub:
+            self.publish('conversation', serialize_conversation(conversation))
+
     def get_or_create_telegram_user(self, user_id: int, username: str, first_name: str, last_name: str = None):
         """Get existing Telegram user or create new one"""
+        cached = self.user_cache.get(user_id)
+        if cached and (cached.username, cached.first_name, cached.last_name) == (username, first_name, last_name):
+            return cached
+
         try:
             telegram_user = self.TelegramUser.query.filter_by(telegram_id=user_id).first()
             if telegram_user:
@@ -62,8 +229,7 @@ class CRMTelegramBot:
                     telegram_user.first_name = first_name
                     telegram_user.last_name = last_name
                     telegram_user.updated_at = datetime.utcnow()
-                    self.db.session.commit()
-                return telegram_user
+                    self.commit()
             else:
                 # Create new user
                 telegram_user = self.TelegramUser(
@@ -73,13 +239,23 @@ class CRMTelegramBot:
                     last_name=last_name
                 )
                 self.db.session.add(telegram_user)
-                self.db.session.commit()
-                return telegram_user
+                self.commit()
+
+            ref = TelegramUserRef(telegram_user.id, user_id, username, first_name, last_name)
+            self.after_commit(lambda: self.user_cache.set(user_id, ref))
+            return telegram_user
         except Exception as e:
             logger.error(f"Error getting/creating Telegram user: {e}")
+            if self.in_handler():
+                raise
             self.db.session.rollback()
             return None
 
+    def cache_conversation(self, conversation):
+        ref = ConversationRef(conversation.id, conversation.telegram_user_id, conversation.status,
+                              conversation.assigned_agent_id)
+        self.after_commit(lambda: self.conversation_cache.set(ref.telegram_user_id, ref))
+
     def get_or_create_conversation(self, telegram_user_id, conversation_type="general"):
         """Get existing conversation or create new one"""
         try:
@@ -96,9 +272,17 @@ class CRMTelegramBot:
                     status='contract_process'
                 )
                 self.db.session.add(conversation)
-                self.db.session.commit()
+                self.commit()
+                self.publish_conversation(conversation)
+
+                # The newest open conversation now belongs to the contract
+                self.after_commit(lambda: self.conversation_cache.pop(telegram_user_id))
                 return conversation
             else:
+                cached = self.conversation_cache.get(telegram_user_id)
+                if cached:
+                    return cached
+
                 # For general conversations, find existing open one
                 conversation = self.Conversation.query.filter_by(
                     telegram_user_id=telegram_user_id
@@ -118,43 +302,89 @@ class CRMTelegramBot:
                         status='open'
                     )
                     self.db.session.add(conversation)
-                    self.db.session.commit()
+                    self.commit()
+                    self.publish_conversation(conversation)
 
+                self.cache_conversation(conversation)
                 return conversation
 
         except Exception as e:
             logger.error(f"Error in get_or_create_conversation: {str(e)}")
+            if self.in_handler():
+                raise
             self.db.session.rollback()
             return None
 
-    def save_message(self, conversation, content, sender_type="user", sender_id=None, is_ai_response=False):
-        """Save message to database"""
+    def save_message(self, conversation, content, sender_type="user", sender_id=None, is_ai_response=False,
+                     template=None):
+        """Save message to database.
+
+        A (name, version) template stores a reference to a catalogue
+        response instead of its text. In 'window' mode the row is handed
+        to the message writer after the handler commits and None is
+        returned.
+        """
+        row = {
+            'conversation_id': conversation.id,
+            'sender_type': sender_type,
+            'sender_id': sender_id,  # Make sure this is set
+            'content': content,
+            'is_ai_response': is_ai_response,
+            'timestamp': datetime.utcnow(),
+            'read_by_agent': False,  # Ensure messages are marked as unread
+            'template_id': template[0] if template else None,
+            'template_version': template[1] if template else None
+        }
+
+        if self.write_mode == 'window':
+            assigned_agent_id = conversation.assigned_agent_id
+            self.after_commit(lambda: self.message_writer.submit(row, assigned_agent_id))
+            return None
+
         try:
-            message = self.Message(
-                conversation_id=conversation.id,
-                sender_type=sender_type,
-                sender_id=sender_id,  # Make sure this is set
-                content=content,
-                is_ai_response=is_ai_response,
-                timestamp=datetime.utcnow(),
-                read_by_agent=False  # Ensure messages are marked as unread
-            )
+            message = self.Message(**row)
             self.db.session.add(message)
 
-            # Update conversation timestamp
-            conversation.updated_at = datetime.utcnow()
+            # Update conversation timestamp; works for cached refs without loading the row
+            self.db.session.execute(
+                update(self.Conversation)
+                .where(self.Conversation.id == conversation.id)
+                .values(updated_at=row['timestamp'])
+                .execution_options(synchronize_session=False)
+            )
 
-            self.db.session.commit()
+            # Build the live update before commit expires the loaded attributes
+            self.db.session.flush()
+            event = {
+                'conversation_id': conversation.id,
+                'assigned_agent_id': conversation.assigned_agent_id,
+                'message': serialize_message(message)
+            }
+
+            self.commit()
+            self.publish('message', event)
             return message
         except Exception as e:
             logger.error(f"Error saving message: {e}")
+            if self.in_handler():
+                raise
             self.db.session.rollback()
             return None
 
+    def send_response(self, message, name, conversation=None):
+        """Reply with a catalogue response, saving only its reference to the conversation"""
+        response, version = self.responses.get(name)
+        if conversation and version is None:
+            self.save_message(conversation, response.text, sender_type="bot", is_ai_response=True)
+        elif conversation:
+            self.save_message(conversation, '', sender_type="bot", is_ai_response=True, template=(name, version))
+        self.send_later(self.bot.reply_to, message, response.text, parse_mode=response.parse_mode,
+                        reply_markup=response.reply_markup)
+
     # Apply decorator to each handler method individually
     def start_handler(self, message):
         """Handle /start and /help commands"""
-        with self.app.app_context():
+        with self.handler_context():
             user = message.from_user
 
             # Get or create Telegram user
@@ -166,31 +396,16 @@ class CRMTelegramBot:
             )
 
             if not telegram_user:
-                self.bot.reply_to(message, "❌ Error creating user. Please try again.")
+                self.send_later(self.bot.reply_to, message, "❌ Error creating user. Please try again.")
                 return
 
-            welcome_text = """
-🤖 Welcome to CRM Support Bot!
-
-Available commands:
-/start - Show this welcome message
-/help - Get help information  
-/contract - Start contract agreement process
-/pricing - Pricing cards
-
-We're here to help you! Just send us a message and we'll respond shortly.
-            """
-
             # Create general conversation if doesn't exist
             conversation = self.get_or_create_conversation(telegram_user.id, "general")
-            if conversation:
-                self.save_message(conversation, welcome_text, sender_type="bot", is_ai_response=True)
-
-            self.bot.reply_to(message, welcome_text)
+            self.send_response(message, 'welcome', conversation)
 
     def contract_handler(self, message):
         """Handle /contract command - start contract agreement process"""
-        with self.app.app_context():
+        with self.handler_context():
             user = message.from_user
 
             # Get or create Telegram user
@@ -202,13 +417,13 @@ We're here to help you! Just send us a message and we'll respond shortly.
             )
 
             if not telegram_user:
-                self.bot.reply_to(message, "❌ Error creating user. Please try again.")
+                self.send_later(self.bot.reply_to, message, "❌ Error creating user. Please try again.")
                 return
 
             # Create contract conversation
             conversation = self.get_or_create_conversation(telegram_user.id, "contract")
             if not conversation:
-                self.bot.reply_to(message, "❌ Error creating contract process. Please try again.")
+                self.send_later(self.bot.reply_to, message, "❌ Error creating contract process. Please try again.")
                 return
 
             # Initialize user session for contract process
@@ -222,22 +437,11 @@ We're here to help you! Just send us a message and we'll respond shortly.
             # Save start message
             self.save_message(conversation, "User started contract process")
 
-            welcome_text = """
-🤝 **Добро пожаловать!**
-
-Вы начинаете процесс заключения соглашения с нашей командой Zeffr.
-
-Пожалуйста, введите ваше ФИО полностью:
-            """
-
-            # Save bot message
-            self.save_message(conversation, welcome_text, sender_type="bot", is_ai_response=True)
-
-            self.bot.reply_to(message, welcome_text, parse_mode='Markdown')
+            self.send_response(message, 'contract_welcome', conversation)
 
     def pricing_handler(self, message):
         """Handle /pricing command - show pricing cards"""
-        with self.app.app_context():
+        with self.handler_context():
             user = message.from_user
 
             # Get or create Telegram user
@@ -249,7 +453,7 @@ We're here to help you! Just send us a message and we'll respond shortly.
             )
 
             if not telegram_user:
-                self.bot.reply_to(message, "❌ Error creating user. Please try again.")
+                self.send_later(self.bot.reply_to, message, "❌ Error creating user. Please try again.")
                 return
 
             # Get or create conversation
@@ -257,79 +461,17 @@ We're here to help you! Just send us a message and we'll respond shortly.
             if conversation:
                 self.save_message(conversation, "User requested pricing information", sender_type="user")
 
-            pricing_text = """
-💼 **Прайс-лист услуг Zefir-IT**
-
-**Мелкие задачи и правки:**
-• Исправление ошибок на сайте (до 1 ч) - 500 – 1 000 ₽
-• Настройка форм обратной связи, почты (1 ч) - 800 – 1 500 ₽
-• Подключение счётчиков (1 ч) - 500 – 1 000 ₽
-• Настройка адаптивности (2–3 ч) - 1 500 – 3 000 ₽
-• Установка SSL/домена/хостинга (0,5–1 день) - 1 000 – 2 000 ₽
-
-**Создание и доработка сайтов:**
-• Доработка сайта (1–3 ч) - 1 000 – 3 000 ₽
-• Вёрстка лендинга (1–2 дня) - 3 000 – 7 000 ₽
-• Сайт «под ключ» (2–4 дня) - 5 000 – 15 000 ₽
-• Интернет-магазин (5–7 дней) - 15 000 – 30 000 ₽
-• Многостраничный сайт (1–2 недели) - 25 000 – 50 000 ₽
-• SEO-оптимизация (1–3 дня) - 2 000 – 5 000 ₽
-• Подключение CMS (1–2 дня) - 3 000 – 8 000 ₽
-• Миграция сайта (1 день) - 2 000 – 4 000 ₽
-
-**Telegram-боты:**
-• Бот с базовой логикой (1–2 дня) - 5 000 – 15 000 ₽
-• Бот для заявок/заказов (2–3 дня) - 10 000 – 20 000 ₽
-• Интеграция с Google Sheets, CRM (3–5 дней) - 15 000 – 30 000 ₽
-• Бот с авторизацией и оплатой (4–6 дней) - 20 000 – 40 000 ₽
-• Кастомная админ-панель (1 неделя) - 25 000 – 45 000 ₽
-
-**Интеграции и автоматизация:**
-• Интеграция сайта с CRM (3–5 дней) - 15 000 – 35 000 ₽
-• Интеграция с платёжными системами (3–5 дней) - 20 000 – 40 000 ₽
-• Автоматизация бизнес-процессов (5–7 дней) - 20 000 – 50 000 ₽
-• Настройка Webhook, REST API (2–4 дня) - 10 000 – 25 000 ₽
-
-**Дополнительные услуги:**
-• Настройка Excel/Google Sheets (1–2 дня) - 2 000 – 6 000 ₽
-• Разработка мини-приложений (2–5 дней) - 8 000 – 25 000 ₽
-• Подключение ChatGPT/нейросетей (3–5 дней) - 15 000 – 40 000 ₽
-• Аналитика и визуализация данных (2–4 дня) - 10 000 – 25 000 ₽
-• Поддержка проекта (ежемесячно) - от 3 000 ₽ / мес
-
-💡 *Цены являются ориентировочными. Точная стоимость рассчитывается индивидуально под каждый проект.*
-
-Для обсуждения вашего проекта или получения консультации, просто напишите нам сообщение!
-            """
-
-            # Create keyboard with additional actions
-            keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            keyboard.add(
-                KeyboardButton("📋 Обсудить проект"),
-                KeyboardButton("💼 Начать договор"),
-                KeyboardButton("👨‍💻 Связаться с менеджером"),
-                KeyboardButton("🏠 Главное меню")
-            )
-
-            # Save pricing message to conversation
-            if conversation:
-                self.save_message(conversation, pricing_text, sender_type="bot", is_ai_response=True)
-
-            self.bot.reply_to(
-                message,
-                pricing_text,
-                parse_mode='Markdown',
-                reply_markup=keyboard
-            )
+            # Price list and keyboard come ready-made from the catalogue
+            self.send_response(message, 'pricing', conversation)
 
     def contract_message_handler(self, message):
         """Handle messages during contract process"""
-        with self.app.app_context():
+        with self.handler_context():
             user = message.from_user
             user_message = message.text
 
             if user.id not in self.user_sessions:
-                self.bot.reply_to(message, "Please start contract process with /contract")
+                self.send_later(self.bot.reply_to, message, "Please start contract process with /contract")
                 return
 
             session = self.user_sessions[user.id]
@@ -337,7 +479,7 @@ We're here to help you! Just send us a message and we'll respond shortly.
 
             conversation = self.Conversation.query.get(conversation_id)
             if not conversation:
-                self.bot.reply_to(message, "❌ Session error. Please start over with /contract")
+                self.send_later(self.bot.reply_to, message, "❌ Session error. Please start over with /contract")
                 return
 
             # Save user message
@@ -352,9 +494,12 @@ We're here to help you! Just send us a message and we'll respond shortly.
 
     def general_message_handler(self, message):
         """Handle general messages (not in contract process)"""
-        with self.app.app_context():
+        with self.handler_context():
             user = message.from_user
 
+            # Generate the AI response before any write, so no lock is held while it runs
+            ai_response = self.generate_ai_response(message.text)
+
             # Get or create Telegram user
             telegram_user = self.get_or_create_telegram_user(
                 user_id=user.id,
@@ -364,53 +509,32 @@ We're here to help you! Just send us a message and we'll respond shortly.
             )
 
             if not telegram_user:
-                self.bot.reply_to(message, "❌ Error processing message. Please try /start")
+                self.send_later(self.bot.reply_to, message, "❌ Error processing message. Please try /start")
                 return
 
             # Get or create general conversation
             conversation = self.get_or_create_conversation(telegram_user.id, "general")
             if not conversation:
-                self.bot.reply_to(message, "❌ Error creating conversation. Please try again.")
+                self.send_later(self.bot.reply_to, message, "❌ Error creating conversation. Please try again.")
                 return
 
             # Save user message
             self.save_message(conversation, message.text, sender_type="user")
 
-            # Generate AI response
-            ai_response = self.generate_ai_response(message.text, conversation.id)
-
             if ai_response:
                 # Save AI response
                 self.save_message(conversation, ai_response, sender_type="ai", is_ai_response=True)
 
                 # Send response to user
-                self.bot.reply_to(message, ai_response)
+                self.send_later(self.bot.reply_to, message, ai_response)
 
             # Notify agents
             self.notify_agents(conversation.id, message.text, telegram_user)
 
-    def generate_ai_response(self, user_message, conversation_id):
+    def generate_ai_response(self, user_message):
         """Generate AI response for general messages"""
         try:
-            user_message_lower = user_message.lower()
-
-            if any(word in user_message_lower for word in ['hello', 'hi', 'hey']):
-                return "Hello! I'm an AI assistant. How can I help you today?"
-
-            elif 'help' in user_message_lower:
-                return "I'm here to assist you! Please describe your issue and I'll connect you with a human agent if needed."
-
-            elif any(word in user_message_lower for word in ['price', 'cost', 'how much']):
-                return "Our pricing varies based on your needs. Our pricing is available by /pricing"
-
-            elif any(word in user_message_lower for word in ['thank', 'thanks']):
-                return "You're welcome! Is there anything else I can help you with?"
-
-            elif any(word in user_message_lower for word in ['bye', 'goodbye']):
-                return "Goodbye! Feel free to reach out if you need more assistance."
-
-            else:
-                return "Thank you for your message. I've forwarded it to our support team. An agent will respond shortly. In the meantime, is there any other information I can provide?"
+            return self.auto_reply.reply(user_message)
 
         except Exception as e:
             logger.error(f"Error generating AI response: {e}")
@@ -420,24 +544,29 @@ We're here to help you! Just send us a message and we'll respond shortly.
         """Notify agents about new message"""
         try:
             logger.info(f"New message from {tg_user.first_name}: {message}")
-            print(f"🔔 Conversation #{conversation_id}: {tg_user.first_name} - {message}")
+            self.publish('notification', {
+                'conversation_id': conversation_id,
+                'first_name': tg_user.first_name,
+                'text': message
+            })
         except Exception as e:
             logger.error(f"Error notifying agents: {e}")
 
     def process_full_name(self, message, full_name: str, session: dict, conversation):
         """Process and validate full name for contract"""
-        with self.app.app_context():
+        with self.handler_context():
             if len(full_name.split()) < 2:
                 error_msg = "❌ Пожалуйста, введите ФИО полностью (как минимум имя и фамилию):"
                 self.save_message(conversation, error_msg, sender_type="bot", is_ai_response=True)
-                self.bot.reply_to(message, error_msg)
+                self.send_later(self.bot.reply_to, message, error_msg)
                 return
 
             session['full_name'] = full_name
             session['step'] = 'waiting_passport'
+            self.user_sessions[message.from_user.id] = session
 
             conversation.title = f"Contract: {full_name}"
-            self.db.session.commit()
+            self.commit()
 
             next_step_text = """
 Теперь введите серию и номер вашего паспорта (через пробел):
@@ -445,21 +574,22 @@ We're here to help you! Just send us a message and we'll respond shortly.
             """
 
             self.save_message(conversation, next_step_text, sender_type="bot", is_ai_response=True)
-            self.bot.reply_to(message, next_step_text, parse_mode='Markdown')
+            self.send_later(self.bot.reply_to, message, next_step_text, parse_mode='Markdown')
 
     def process_passport(self, message, passport: str, session: dict, conversation):
         """Process and validate passport data for contract"""
-        with self.app.app_context():
+        with self.handler_context():
             passport_pattern = r'^\d{4}\s\d{6}$'
 
             if not re.match(passport_pattern, passport):
                 error_msg = "❌ Неверный формат паспорта. Пожалуйста, введите серию и номер через пробел (например: `4510 123456`):"
                 self.save_message(conversation, error_msg, sender_type="bot", is_ai_response=True)
-                self.bot.reply_to(message, error_msg, parse_mode='Markdown')
+                self.send_later(self.bot.reply_to, message, error_msg, parse_mode='Markdown')
                 return
 
             session['passport'] = passport
             session['step'] = 'waiting_agreement'
+            self.user_sessions[message.from_user.id] = session
 
             full_name = session['full_name']
 
@@ -481,7 +611,8 @@ We're here to help you! Just send us a message and we'll respond shortly.
             keyboard.add(InlineKeyboardButton("✅ Согласен", callback_data="contract_agree_terms"))
 
             self.save_message(conversation, confirmation_text, sender_type="bot", is_ai_response=True)
-            self.bot.reply_to(
+            self.send_later(
+                self.bot.reply_to,
                 message,
                 confirmation_text,
                 reply_markup=keyboard,
@@ -491,12 +622,12 @@ We're here to help you! Just send us a message and we'll respond shortly.
 
     def contract_callback_handler(self, call):
         """Handle contract agreement callback"""
-        with self.app.app_context():
+        with self.handler_context():
             user = call.from_user
             data = call.data
 
             if user.id not in self.user_sessions:
-                self.bot.answer_callback_query(call.id, "Сессия истекла. Начните с /contract")
+                self.send_later(self.bot.answer_callback_query, call.id, "Сессия истекла. Начните с /contract")
                 return
 
             session = self.user_sessions[user.id]
@@ -504,22 +635,23 @@ We're here to help you! Just send us a message and we'll respond shortly.
 
             conversation = self.Conversation.query.get(conversation_id)
             if not conversation:
-                self.bot.answer_callback_query(call.id, "Диалог не найден. Начните с /contract")
+                self.send_later(self.bot.answer_callback_query, call.id, "Диалог не найден. Начните с /contract")
                 return
 
             if data == "contract_agree_terms":
                 self.process_contract_agreement(call, session, conversation, user)
 
-            self.bot.answer_callback_query(call.id)
+            self.send_later(self.bot.answer_callback_query, call.id)
 
     def process_contract_agreement(self, call, session: dict, conversation, user):
         """Process contract agreement completion"""
-        with self.app.app_context():
+        with self.handler_context():
             full_name = session.get('full_name')
             passport = session.get('passport')
 
             if not full_name or not passport:
-                self.bot.edit_message_text(
+                self.send_later(
+                    self.bot.edit_message_text,
                     "❌ Данные не найдены. Пожалуйста, начните заново с /contract",
                     chat_id=call.message.chat.id,
                     message_id=call.message.message_id
@@ -529,7 +661,10 @@ We're here to help you! Just send us a message and we'll respond shortly.
             # Update conversation status to completed
             conversation.status = 'completed'
             conversation.closed_at = datetime.utcnow()
-            self.db.session.commit()
+            self.commit()
+            self.publish_conversation(conversation)
+            telegram_user_id = conversation.telegram_user_id
+            self.after_commit(lambda: self.conversation_cache.pop(telegram_user_id))
 
             success_text = f"""
 ✅ **Спасибо! Вы приняли условия оферты.**
@@ -550,7 +685,8 @@ We're here to help you! Just send us a message and we'll respond shortly.
             self.save_message(conversation, success_text, sender_type="bot", is_ai_response=True)
 
             # Remove keyboard and show final message
-            self.bot.edit_message_text(
+            self.send_later(
+                self.bot.edit_message_text,
                 success_text,
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
@@ -575,10 +711,22 @@ We're here to help you! Just send us a message and we'll respond shortly.
         now = datetime.now()
         return f"{now.day} {months[now.month]} {now.year} года"
 
+    def process_update_json(self, payload):
+        """Handle a raw update delivered to the webhook route"""
+        update = telebot.types.Update.de_json(payload)
+        self.bot.process_new_updates([update])
+
+    def set_webhook(self, url, secret_token=None):
+        """Ask Telegram to push updates to our webhook instead of being polled"""
+        logger.info(f"Setting Telegram webhook to {url}")
+        return self.bot.set_webhook(url=url, secret_token=secret_token)
+
     def run(self):
         """Run the single bot"""
         logger.info("CRM Telegram Bot is starting...")
         try:
+            # getUpdates is rejected while a webhook is registered
+            self.bot.remove_webhook()
             self.bot.infinity_polling()
         except Exception as e:
             logger.error(f"Error in CRM bot: {e}")
\ No newline at end of file
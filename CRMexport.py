@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+CONVERSATION_FIELDS = ['id', 'telegram_user_id', 'telegram_id', 'username', 'first_name', 'last_name', 'status',
+                       'assigned_agent_id', 'title', 'created_at', 'updated_at', 'closed_at']
+MESSAGE_FIELDS = ['id', 'conversation_id', 'sender_type', 'sender_id', 'content', 'message_type', 'timestamp',
+                  'is_ai_response', 'read_by_agent', 'template_id', 'template_version']
+
+
+def to_text(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+class ConversationExporter:
+    """Streams conversations and messages out as CSV or JSONL in constant memory.
+
+    Rows are read as plain tuples through a server-side cursor, yield_per
+    rows at a time, and encoded in chunks so neither the result set nor the
+    output is ever held in full.
+    """
+
+    def __init__(self, db, TelegramUser, Conversation, Message, yield_per=1000, template_text=None):
+        self.db = db
+        self.TelegramUser = TelegramUser
+        self.Conversation = Conversation
+        self.Message = Message
+        self.yield_per = yield_per
+        # (template_id, version) -> text, to export catalogue responses with the text that was sent
+        self.template_text = template_text
+
+    def _conversation_filters(self, status=None, date_from=None, date_to=None, timestamp_column=None):
+        Conversation = self.Conversation
+        timestamp_column = timestamp_column if timestamp_column is not None else Conversation.created_at
+        filters = []
+        if status:
+            filters.append(Conversation.status == status)
+        if date_from:
+            filters.append(timestamp_column >= date_from)
+        if date_to:
+            filters.append(timestamp_column < date_to)
+        return filters
+
+    def _stream(self, statement):
+        result = self.db.session.execute(statement.execution_options(yield_per=self.yield_per))
+        for partition in result.partitions():
+            yield from partition
+
+    def conversations(self, status=None, date_from=None, date_to=None):
+        """Conversation rows created in [date_from, date_to), with their Telegram user"""
+        Conversation = self.Conversation
+        TelegramUser = self.TelegramUser
+        statement = (
+            select(Conversation.id, Conversation.telegram_user_id, TelegramUser.telegram_id, TelegramUser.username,
+                   TelegramUser.first_name, TelegramUser.last_name, Conversation.status,
+                   Conversation.assigned_agent_id, Conversation.title, Conversation.created_at,
+                   Conversation.updated_at, Conversation.closed_at)
+            .join(TelegramUser, TelegramUser.id == Conversation.telegram_user_id)
+            .where(*self._conversation_filters(status, date_from, date_to))
+            .order_by(Conversation.id)
+        )
+        return self._stream(statement)
+
+    def messages(self, status=None, date_from=None, date_to=None, conversation_id=None):
+        """Message rows sent in [date_from, date_to), optionally only from conversations in a status"""
+        Message = self.Message
+        Conversation = self.Conversation
+        statement = select(Message.id, Message.conversation_id, Message.sender_type, Message.sender_id,
+                           Message.content, Message.message_type, Message.timestamp, Message.is_ai_response,
+                           Message.read_by_agent, Message.template_id, Message.template_version)
+        if status:
+            statement = statement.join(Conversation, Conversation.id == Message.conversation_id)
+        filters = self._conversation_filters(status, date_from, date_to, timestamp_column=Message.timestamp)
+        if conversation_id:
+            filters.append(Message.conversation_id == conversation_id)
+        rows = self._stream(statement.where(*filters).order_by(Message.id))
+        return self._resolve_templates(rows) if self.template_text else rows
+
+    def _resolve_templates(self, rows):
+        content = MESSAGE_FIELDS.index('content')
+        for row in rows:
+            if row.template_id:
+                row = tuple(row)
+                row = row[:content] + (self.template_text(row[-2], row[-1]),) + row[content + 1:]
+            yield row
+
+    def encode(self, rows, fields, fmt, chunk_rows=500):
+        """Yield the rows as CSV or JSONL text, chunk_rows rows per chunk"""
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(fields)
+
+        pending = 0
+        for row in rows:
+            values = [to_text(value) for value in row]
+            if writer:
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(fields, values)), ensure_ascii=False))
+                buffer.write('\n')
+
+            pending += 1
+            if pending >= chunk_rows:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    def export(self, kind, fmt, **filters):
+        """Text chunks for 'conversations' or 'messages'"""
+        if kind == 'conversations':
+            return self.encode(self.conversations(**filters), CONVERSATION_FIELDS, fmt)
+        if kind == 'messages':
+            return self.encode(self.messages(**filters), MESSAGE_FIELDS, fmt)
+        raise ValueError(f"Unknown export: {kind}")
@@ -0,0 +1,98 @@
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("CRM HUB")
+
+
+def serialize_message(msg):
+    """Convert a message row to the JSON shape used by the chat page"""
+    return {
+        'id': msg.id,
+        'sender_type': msg.sender_type,
+        'content': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'is_ai_response': msg.is_ai_response
+    }
+
+
+def serialize_conversation(conv):
+    """Convert a conversation row to the JSON shape used by live updates"""
+    return {
+        'id': conv.id,
+        'telegram_user_id': conv.telegram_user_id,
+        'status': conv.status,
+        'assigned_agent_id': conv.assigned_agent_id,
+        'title': conv.title,
+        'updated_at': conv.updated_at.isoformat() if conv.updated_at else None
+    }
+
+
+class LiveUpdateHub:
+    """In-process pub/sub hub that fans events out to streaming subscribers"""
+
+    def __init__(self, max_queue_size=100, heartbeat_interval=15):
+        self.max_queue_size = max_queue_size
+        self.heartbeat_interval = heartbeat_interval
+        self._subscribers = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """Register a new subscriber and return its event queue"""
+        subscription = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def add_listener(self, callback):
+        """Call callback(event, data) in the publisher's thread for every event"""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event, data):
+        """Deliver an event to every subscriber without blocking the publisher"""
+        item = {'event': event, 'data': data}
+        with self._lock:
+            subscribers = list(self._subscribers)
+            listeners = list(self._listeners)
+
+        for callback in listeners:
+            try:
+                callback(event, data)
+            except Exception as e:
+                logger.error(f"Error in {event} listener: {e}")
+
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(item)
+            except queue.Full:
+                # Slow clients catch up through the delta endpoint when they reconnect
+                logger.warning(f"Dropping {event} event for a slow subscriber")
+
+    def stream(self, subscription, accept=None):
+        """Yield server-sent events for a subscription until the client goes away"""
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    item = subscription.get(timeout=self.heartbeat_interval)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if accept and not accept(item):
+                    continue
+
+                yield f"event: {item['event']}\ndata: {json.dumps(item['data'])}\n\n"
+        finally:
+            self.unsubscribe(subscription)
@@ -0,0 +1,307 @@
+import csv
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+from sqlalchemy import bindparam, insert, select, update
+
+logger = logging.getLogger("CRM IMPORT")
+
+IMPORT_FORMATS = ('jsonl', 'csv')
+
+
+def read_records(path, fmt):
+    """Yield one dict per input record without reading the whole file"""
+    with open(path, encoding='utf-8', newline='') as source:
+        if fmt == 'csv':
+            yield from csv.DictReader(source)
+        else:
+            for line in source:
+                line = line.strip()
+                yield json.loads(line) if line else {}
+
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime(1970, 1, 1) + timedelta(seconds=value)
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+
+
+class HistoryImporter:
+    """Bulk loader for legacy chat history.
+
+    Each input record is one message carrying its sender's Telegram profile:
+    telegram_id and content are required; username, first_name, last_name,
+    language_code, conversation (an external conversation key, one per user
+    by default), title, status, sender_type and timestamp are optional.
+
+    Records are inserted with Core executemany in batches. Every batch
+    commits together with the job's progress, so a re-run of the same source
+    skips what is already in and carries on from the next record. A restart
+    reads the source from the top again but keeps the job's conversation
+    keys and skips messages already stored, so nothing is imported twice.
+
+    Core inserts skip the ORM session hooks, so after_batch(counts, inserted)
+    is called before each commit with the new users and messages as dicts.
+    """
+
+    def __init__(self, db, TelegramUser, Conversation, Message, ImportJob, ImportConversationKey,
+                 batch_size=5000, after_batch=None):
+        self.db = db
+        self.TelegramUser = TelegramUser
+        self.Conversation = Conversation
+        self.Message = Message
+        self.ImportJob = ImportJob
+        self.ImportConversationKey = ImportConversationKey
+        self.batch_size = batch_size
+        self.after_batch = after_batch
+
+    def job_for(self, source, restart=False):
+        session = self.db.session
+        job = session.execute(select(self.ImportJob).where(self.ImportJob.source == source)).scalar()
+        if job is not None and restart:
+            job.rows_done = 0
+            session.commit()
+        if job is None:
+            job = self.ImportJob(source=source, rows_done=0, users_created=0, conversations_created=0,
+                                 messages_created=0, errors=0, status='running', started_at=datetime.utcnow())
+            session.add(job)
+            session.commit()
+        return job
+
+    def run(self, path, fmt=None, restart=False):
+        """Import a JSONL or CSV file, resuming a previous run of the same file; returns a summary"""
+        fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        if fmt not in IMPORT_FORMATS:
+            raise ValueError(f"Unknown import format: {fmt}")
+
+        session = self.db.session
+        job = self.job_for(os.path.abspath(path), restart=restart)
+        # Also picks up records appended to a file that was imported before
+        if job.rows_done:
+            logger.info(f"Resuming {path} after record {job.rows_done}")
+        job.status = 'running'
+
+        records = islice(read_records(path, fmt), job.rows_done, None)
+        started = time.monotonic()
+        imported = 0
+
+        while True:
+            batch = list(islice(records, self.batch_size))
+            if not batch:
+                break
+
+            counts, inserted = self._import_batch(job, batch, skip_existing=restart)
+            job.rows_done += len(batch)
+            job.users_created += counts['users']
+            job.conversations_created += counts['conversations']
+            job.messages_created += counts['messages']
+            job.errors += counts['errors']
+            job.updated_at = datetime.utcnow()
+            if self.after_batch:
+                self.after_batch(counts, inserted)
+            session.commit()
+
+            imported += len(batch)
+            elapsed = time.monotonic() - started
+            logger.info(f"Imported {job.rows_done} records ({imported / elapsed:.0f} rows/s)")
+
+        job.status = 'completed'
+        job.finished_at = datetime.utcnow()
+        session.commit()
+
+        summary = self.summary(job, imported, time.monotonic() - started)
+        logger.info(f"Import of {path} finished: {summary}")
+        return summary
+
+    @staticmethod
+    def summary(job, imported, elapsed):
+        return {
+            'records': job.rows_done,
+            'imported_this_run': imported,
+            'users_created': job.users_created,
+            'conversations_created': job.conversations_created,
+            'messages_created': job.messages_created,
+            'skipped': job.errors,
+            'seconds': round(elapsed, 2),
+            'rows_per_second': round(imported / elapsed) if elapsed else None
+        }
+
+    def _import_batch(self, job, batch, skip_existing=False):
+        """Insert a batch; returns (counts, inserted rows by table) for after_batch"""
+        counts = {'users': 0, 'conversations': 0, 'open_conversations': 0, 'messages': 0, 'errors': 0}
+        inserted = {'telegram_users': [], 'messages': []}
+
+        rows = []
+        for offset, record in enumerate(batch, start=job.rows_done + 1):
+            try:
+                telegram_id = int(record['telegram_id'])
+                content = record['content']
+                if not content:
+                    raise ValueError('empty content')
+                timestamp = parse_timestamp(record.get('timestamp')) or datetime.utcnow()
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping record {offset}: {e}")
+                counts['errors'] += 1
+                continue
+            rows.append((telegram_id, record, content, timestamp))
+
+        if not rows:
+            return counts, inserted
+
+        user_ids = self._user_ids(rows, counts, inserted)
+        conversation_ids = self._conversation_ids(job, rows, user_ids, counts)
+
+        messages = [
+            {
+                'conversation_id': conversation_ids[self._conversation_key(telegram_id, record)],
+                'sender_type': record.get('sender_type') or 'user',
+                'sender_id': user_ids[telegram_id] if (record.get('sender_type') or 'user') == 'user' else None,
+                'content': content,
+                'message_type': record.get('message_type') or 'text',
+                'timestamp': timestamp,
+                'is_ai_response': (record.get('sender_type') == 'ai'),
+                'read_by_agent': True
+            }
+            for telegram_id, record, content, timestamp in rows
+        ]
+        if skip_existing:
+            messages = self._new_messages(messages, [bool(record.get('timestamp')) for _, record, _, _ in rows])
+        counts['messages'] = len(messages)
+        if not messages:
+            return counts, inserted
+        message_ids = self.db.session.execute(
+            insert(self.Message).returning(self.Message.id, sort_by_parameter_order=True), messages
+        ).scalars().all()
+        inserted['messages'] = [{**message, 'id': message_id} for message, message_id in zip(messages, message_ids)]
+
+        # Conversations sort by their newest message
+        latest = {}
+        for message in messages:
+            conversation_id = message['conversation_id']
+            if conversation_id not in latest or message['timestamp'] > latest[conversation_id]:
+                latest[conversation_id] = message['timestamp']
+        Conversation = self.Conversation
+        self.db.session.connection().execute(
+            update(Conversation)
+            .where(Conversation.id == bindparam('conversation_id'),
+                   (Conversation.updated_at.is_(None)) | (Conversation.updated_at < bindparam('timestamp')))
+            .values(updated_at=bindparam('timestamp')),
+            [{'conversation_id': key, 'timestamp': value} for key, value in latest.items()]
+        )
+        return counts, inserted
+
+    def _new_messages(self, messages, stamped):
+        """Messages not stored yet, matched on conversation, timestamp, sender and text.
+
+        A record without a timestamp got the time of the import, so it is
+        matched on conversation, sender and text alone.
+        """
+        Message = self.Message
+        query = (select(Message.conversation_id, Message.timestamp, Message.sender_type, Message.content)
+                 .where(Message.conversation_id.in_({message['conversation_id'] for message in messages})))
+        if all(stamped):
+            timestamps = [message['timestamp'] for message in messages]
+            query = query.where(Message.timestamp.between(min(timestamps), max(timestamps)))
+        existing = set()
+        unstamped = set()
+        for conversation_id, timestamp, sender_type, content in self.db.session.execute(query):
+            existing.add((conversation_id, timestamp, sender_type, content))
+            unstamped.add((conversation_id, sender_type, content))
+
+        new = []
+        for message, has_timestamp in zip(messages, stamped):
+            if has_timestamp:
+                key, seen = (message['conversation_id'], message['timestamp'], message['sender_type'],
+                             message['content']), existing
+            else:
+                key, seen = (message['conversation_id'], message['sender_type'], message['content']), unstamped
+            if key not in seen:
+                new.append(message)
+        return new
+
+    def _user_ids(self, rows, counts, inserted):
+        """telegram_id -> telegram_users.id, inserting users not seen before"""
+        TelegramUser = self.TelegramUser
+        profiles = {}
+        for telegram_id, record, _, timestamp in rows:
+            profiles.setdefault(telegram_id, (record, timestamp))
+
+        user_ids = dict(self.db.session.execute(
+            select(TelegramUser.telegram_id, TelegramUser.id).where(TelegramUser.telegram_id.in_(list(profiles)))
+        ).all())
+
+        missing = [
+            {
+                'telegram_id': telegram_id,
+                'username': record.get('username') or None,
+                'first_name': record.get('first_name') or str(telegram_id),
+                'last_name': record.get('last_name') or None,
+                'language_code': record.get('language_code') or 'en',
+                'created_at': timestamp,
+                'updated_at': timestamp
+            }
+            for telegram_id, (record, timestamp) in profiles.items() if telegram_id not in user_ids
+        ]
+        if missing:
+            created = self.db.session.execute(
+                insert(TelegramUser).returning(TelegramUser.telegram_id, TelegramUser.id, sort_by_parameter_order=True),
+                missing
+            ).all()
+            user_ids.update(created)
+            counts['users'] += len(created)
+            inserted['telegram_users'] = [{**user, 'id': user_ids[user['telegram_id']]} for user in missing]
+        return user_ids
+
+    @staticmethod
+    def _conversation_key(telegram_id, record):
+        return str(record.get('conversation') or telegram_id)
+
+    def _conversation_ids(self, job, rows, user_ids, counts):
+        """External conversation key -> conversations.id, creating conversations on first sight"""
+        Key = self.ImportConversationKey
+        Conversation = self.Conversation
+
+        first_seen = {}
+        for telegram_id, record, _, timestamp in rows:
+            first_seen.setdefault(self._conversation_key(telegram_id, record), (telegram_id, record, timestamp))
+
+        conversation_ids = dict(self.db.session.execute(
+            select(Key.external_key, Key.conversation_id)
+            .where(Key.job_id == job.id, Key.external_key.in_(list(first_seen)))
+        ).all())
+
+        missing = [key for key in first_seen if key not in conversation_ids]
+        if not missing:
+            return conversation_ids
+
+        new_rows = []
+        for key in missing:
+            telegram_id, record, timestamp = first_seen[key]
+            status = record.get('status') or 'completed'
+            new_rows.append({
+                'telegram_user_id': user_ids[telegram_id],
+                'status': status,
+                'title': record.get('title') or f"Imported chat {key}",
+                'created_at': timestamp,
+                'updated_at': timestamp,
+                'closed_at': timestamp if status == 'completed' else None
+            })
+            if status in ('open', 'assigned'):
+                counts['open_conversations'] += 1
+
+        created = self.db.session.execute(
+            insert(Conversation).returning(Conversation.id, sort_by_parameter_order=True), new_rows
+        ).scalars().all()
+        self.db.session.execute(insert(Key), [
+            {'job_id': job.id, 'external_key': key, 'conversation_id': conversation_id}
+            for key, conversation_id in zip(missing, created)
+        ])
+        conversation_ids.update(zip(missing, created))
+        counts['conversations'] += len(created)
+        return conversation_ids
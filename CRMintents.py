@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger("CRM INTENTS")
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Used when no rules file is configured; mirrors intents.json
+DEFAULT_RULES = {
+    'fallback': "Thank you for your message. I've forwarded it to our support team. An agent will respond shortly. "
+                "In the meantime, is there any other information I can provide?",
+    'intents': [
+        {'name': 'greeting', 'phrases': ['hello', 'hi', 'hey', 'привет', 'здравствуйте'],
+         'response': "Hello! I'm an AI assistant. How can I help you today?"},
+        {'name': 'help', 'phrases': ['help*', 'помощь', 'помоги*'],
+         'response': "I'm here to assist you! Please describe your issue and I'll connect you with a human agent if needed."},
+        {'name': 'pricing', 'phrases': ['price*', 'cost*', 'how much', 'цен*', 'стоимост*', 'сколько стоит'],
+         'response': "Our pricing varies based on your needs. Our pricing is available by /pricing"},
+        {'name': 'thanks', 'phrases': ['thank*', 'спасибо'],
+         'response': "You're welcome! Is there anything else I can help you with?"},
+        {'name': 'goodbye', 'phrases': ['bye', 'goodbye', 'пока', 'до свидания'],
+         'response': "Goodbye! Feel free to reach out if you need more assistance."},
+    ]
+}
+
+
+def tokenize(text):
+    """Lowercased word tokens; \\w is Unicode-aware, so Cyrillic words tokenize like Latin ones"""
+    return TOKEN_RE.findall(text.casefold().replace('ё', 'е'))
+
+
+class Intent:
+    def __init__(self, name, response, priority):
+        self.name = name
+        self.response = response
+        self.priority = priority
+
+    def __repr__(self):
+        return f"Intent({self.name!r})"
+
+
+class CompiledRules:
+    """Intents compiled into hash tables keyed by token n-grams.
+
+    A phrase is a sequence of whole words; a trailing * on its last word
+    matches any word starting with that stem ("цен*" matches "цены",
+    "цену"). Matching looks up every n-gram of the message up to the
+    longest phrase length, so its cost depends on the message, not on how
+    many phrases there are.
+    """
+
+    def __init__(self, rules):
+        self.fallback = rules.get('fallback')
+        self.intents = []
+        self.phrases = {}       # (token, ...) -> Intent
+        self.stems = {}         # ((token, ...), stem) -> Intent
+        self.stem_lengths = set()
+        self.max_length = 0
+
+        for priority, spec in enumerate(rules.get('intents', [])):
+            intent = Intent(spec['name'], spec['response'], priority)
+            self.intents.append(intent)
+            phrases = spec.get('phrases', [])
+            if isinstance(phrases, dict):
+                # {"en": [...], "ru": [...]}
+                phrases = [phrase for language in phrases.values() for phrase in language]
+
+            for phrase in phrases:
+                is_stem = phrase.endswith('*')
+                tokens = tokenize(phrase.rstrip('*'))
+                if not tokens:
+                    continue
+                self.max_length = max(self.max_length, len(tokens))
+                # The first intent listed for a phrase wins
+                if is_stem:
+                    self.stem_lengths.add(len(tokens[-1]))
+                    self.stems.setdefault((tuple(tokens[:-1]), tokens[-1]), intent)
+                else:
+                    self.phrases.setdefault(tuple(tokens), intent)
+
+        self.stem_lengths = sorted(self.stem_lengths)
+
+    def match(self, text):
+        """Highest-priority intent with a phrase in the text, or None"""
+        tokens = tokenize(text)
+        best = None
+        for start in range(len(tokens)):
+            for length in range(1, min(self.max_length, len(tokens) - start) + 1):
+                ngram = tuple(tokens[start:start + length])
+                intent = self.phrases.get(ngram)
+                if intent is not None and (best is None or intent.priority < best.priority):
+                    best = intent
+
+                if self.stems:
+                    head, last = ngram[:-1], ngram[-1]
+                    for stem_length in self.stem_lengths:
+                        if stem_length > len(last):
+                            break
+                        intent = self.stems.get((head, last[:stem_length]))
+                        if intent is not None and (best is None or intent.priority < best.priority):
+                            best = intent
+        return best
+
+    def __len__(self):
+        return len(self.phrases) + len(self.stems)
+
+
+class IntentEngine:
+    """Intent rules loaded from a JSON file and recompiled when the file changes.
+
+    The file's mtime is checked at most every reload_interval seconds while
+    messages are matched. A file that fails to parse is logged and the
+    previous rules stay in use.
+    """
+
+    def __init__(self, path=None, rules=None, reload_interval=2.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.reloads = 0
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.rules = CompiledRules(rules if rules is not None else DEFAULT_RULES)
+        if path:
+            self.reload()
+
+    def reload(self):
+        """Recompile the rules if the file changed; returns True when it did"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.error(f"Intent rules not readable, keeping the current ones: {e}")
+            return False
+        if mtime == self._mtime:
+            return False
+
+        with self._lock:
+            if mtime == self._mtime:
+                return False
+            try:
+                with open(self.path, encoding='utf-8') as source:
+                    compiled = CompiledRules(json.load(source))
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Invalid intent rules in {self.path}, keeping the current ones: {e}")
+                self._mtime = mtime
+                return False
+            # Swapping the reference is atomic; handlers in flight finish on the old rules
+            self.rules = compiled
+            self._mtime = mtime
+            self.reloads += 1
+        logger.info(f"Loaded {len(compiled.intents)} intents with {len(compiled)} phrases from {self.path}")
+        return True
+
+    def _maybe_reload(self):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            self.reload()
+
+    def version(self):
+        """Changes whenever new rules are loaded"""
+        self._maybe_reload()
+        return self.reloads
+
+    def match(self, text):
+        self._maybe_reload()
+        return self.rules.match(text)
+
+    def respond(self, text):
+        """The matched intent's response, or the fallback"""
+        intent = self.match(text)
+        return intent.response if intent is not None else self.rules.fallback
+
+
+def benchmark(sizes=(10, 100, 1000, 5000), messages=2000, seed=1):
+    """Microseconds per message for rule sets of increasing size.
+
+    Compares the compiled engine with the substring scan it replaced,
+    which checks every phrase against every message.
+    """
+    rng = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyzабвгдежзиклмнопрстуфхцчшщэюя'
+
+    def word():
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randint(3, 9)))
+
+    vocabulary = [word() for _ in range(5000)]
+    texts = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 25))) for _ in range(messages)]
+
+    results = []
+    for size in sizes:
+        phrases = [' '.join(word() for _ in range(rng.randint(1, 3))) for _ in range(size)]
+        rules = {'fallback': '', 'intents': [
+            {'name': f'intent{i}', 'phrases': phrases[i::50], 'response': ''} for i in range(min(50, size))
+        ]}
+        compiled = CompiledRules(rules)
+
+        started = time.perf_counter()
+        for text in texts:
+            compiled.match(text)
+        compiled_us = (time.perf_counter() - started) / messages * 1e6
+
+        started = time.perf_counter()
+        for text in texts:
+            lowered = text.lower()
+            any(phrase in lowered for phrase in phrases)
+        substring_us = (time.perf_counter() - started) / messages * 1e6
+
+        results.append({'phrases': size, 'compiled_us': round(compiled_us, 2), 'substring_us': round(substring_us, 2)})
+    return results
@@ -0,0 +1,159 @@
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, inspect, insert, select, text
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger("CRM MIGRATIONS")
+
+
+def create_index(name, table, columns):
+    """Migration step adding an index to an existing table.
+
+    On PostgreSQL the index is built CONCURRENTLY, so writes to the table
+    carry on while it builds. SQLite has no online index build; with WAL the
+    dashboard keeps reading and writers wait out the build on busy_timeout.
+    """
+    def step(connection):
+        if connection.dialect.name == 'postgresql':
+            # A failed concurrent build leaves an invalid index behind that IF NOT EXISTS would keep
+            invalid = connection.execute(text(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+            ), {'name': name}).scalar()
+            if invalid:
+                connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            connection.exec_driver_sql(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+            )
+        else:
+            connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+    step.description = f"index {name} on {table} ({', '.join(columns)})"
+    return step
+
+
+def add_column(table, name, ddl):
+    """Migration step adding a column, skipped when create_all already made it"""
+    def step(connection):
+        if name in {column['name'] for column in inspect(connection).get_columns(table)}:
+            return
+        connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+    step.description = f"column {table}.{name}"
+    return step
+
+
+def run_sql(description, statement):
+    """Migration step running one SQL statement that is safe to run twice"""
+    def step(connection):
+        connection.exec_driver_sql(statement)
+
+    step.description = description
+    return step
+
+
+class Migration:
+    """A numbered schema change made of idempotent steps"""
+
+    def __init__(self, version, name, *steps):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+class MigrationRunner:
+    """Applies pending migrations in version order and records them in schema_migrations.
+
+    Every step is idempotent, so a migration interrupted before it was
+    recorded simply runs again. Steps run in autocommit mode so each DDL
+    statement holds its locks only as long as it takes.
+    """
+
+    def __init__(self, db, migrations):
+        self.db = db
+        self.migrations = sorted(migrations, key=lambda migration: migration.version)
+        self.metadata = MetaData()
+        self.table = Table(
+            'schema_migrations', self.metadata,
+            Column('version', Integer, primary_key=True),
+            Column('name', String(200), nullable=False),
+            Column('applied_at', DateTime, nullable=False),
+            Column('seconds', Float),
+        )
+
+    def applied(self):
+        with self.db.engine.connect() as connection:
+            return set(connection.execute(select(self.table.c.version)).scalars())
+
+    def pending(self):
+        applied = self.applied()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    def upgrade(self):
+        """Apply every pending migration; returns the versions applied"""
+        engine = self.db.engine
+        self.metadata.create_all(engine)
+
+        done = []
+        for migration in self.pending():
+            started = time.monotonic()
+            logger.info(f"Applying migration {migration.version}: {migration.name}")
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                for step in migration.steps:
+                    logger.info(f"  {step.description}")
+                    step(connection)
+
+            try:
+                with engine.begin() as connection:
+                    connection.execute(insert(self.table).values(
+                        version=migration.version, name=migration.name, applied_at=datetime.utcnow(),
+                        seconds=round(time.monotonic() - started, 3)
+                    ))
+            except IntegrityError:
+                # Another process starting at the same time recorded it first
+                pass
+            done.append(migration.version)
+        return done
+
+    def status(self):
+        with self.db.engine.connect() as connection:
+            applied = {row.version: row for row in connection.execute(select(self.table))}
+        return [
+            {
+                'version': migration.version,
+                'name': migration.name,
+                'applied_at': applied[migration.version].applied_at.isoformat() if migration.version in applied else None,
+                'seconds': applied[migration.version].seconds if migration.version in applied else None
+            }
+            for migration in self.migrations
+        ]
+
+
+def explain(connection, statement):
+    """The database's query plan for a statement, one line per plan node"""
+    # Literal values give the planner the same statistics it sees for the real query
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    if connection.dialect.name == 'sqlite':
+        return [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}").all()]
+    return [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {compiled}").all()]
+
+
+def check_query_plans(db, checks):
+    """Run EXPLAIN on each (name, statement, expected index) and report whether the index is used.
+
+    On PostgreSQL the planner prefers sequential scans on small tables, so
+    the result is only meaningful against production-sized data.
+    """
+    report = []
+    with db.engine.connect() as connection:
+        for name, statement, index in checks:
+            plan = explain(connection, statement)
+            report.append({
+                'query': name,
+                'index': index,
+                'uses_index': any(index in line for line in plan),
+                'plan': plan
+            })
+    return report
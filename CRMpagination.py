@@ -0,0 +1,44 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import or_
+
+
+def encode_cursor(timestamp, row_id):
+    """Opaque page token for the row a page ended on"""
+    raw = json.dumps([timestamp.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor; raises ValueError on a malformed token"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        timestamp, row_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+
+def keyset_page(query, timestamp_column, id_column, cursor=None, limit=50):
+    """Return (rows, next_cursor) for a query ordered newest first by (timestamp, id).
+
+    Seeks past the cursor row instead of using OFFSET, so every page costs
+    one index range scan no matter how deep it is.
+    """
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(
+            timestamp_column <= timestamp,
+            or_(timestamp_column < timestamp, id_column < row_id)
+        )
+
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, timestamp_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
@@ -0,0 +1,116 @@
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy import update
+
+from CRMhub import serialize_message
+
+logger = logging.getLogger("CRM PERSISTENCE")
+
+# How message writes reach the database:
+#   immediate - commit after every write (one fsync per message)
+#   handler   - one transaction per bot handler
+#   window    - handler transactions plus messages buffered across handlers
+#               for up to flush_interval seconds and written by one thread
+WRITE_MODES = ('immediate', 'handler', 'window')
+
+
+class MessageWriter:
+    """Write-behind buffer that inserts messages in ordered, batched transactions"""
+
+    def __init__(self, app, db, Message, Conversation, hub=None, flush_interval=0.2, max_batch=200, max_retries=3):
+        self.app = app
+        self.db = db
+        self.Message = Message
+        self.Conversation = Conversation
+        self.hub = hub
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+
+        self.queue = queue.Queue()
+        self.stats = {'batches': 0, 'messages': 0, 'failed': 0}
+
+        self._thread = threading.Thread(target=self._run, name="crm-message-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row, assigned_agent_id=None):
+        """Buffer a message row; it is written within flush_interval seconds"""
+        self.queue.put((row, assigned_agent_id))
+
+    def flush(self):
+        """Block until every buffered message has been written"""
+        self.queue.join()
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with self.app.app_context():
+                    events = self._insert(batch)
+                break
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} buffered messages (attempt {attempt}): {e}")
+                if attempt == self.max_retries:
+                    self.stats['failed'] += len(batch)
+                    return
+                time.sleep(self.flush_interval * attempt)
+
+        self.stats['batches'] += 1
+        self.stats['messages'] += len(batch)
+
+        if self.hub:
+            for event in events:
+                self.hub.publish('message', event)
+
+    def _insert(self, batch):
+        session = self.db.session
+        messages = [self.Message(**row) for row, _ in batch]
+        session.add_all(messages)
+
+        # One updated_at bump per conversation instead of one per message
+        latest = {}
+        for row, _ in batch:
+            latest[row['conversation_id']] = max(latest.get(row['conversation_id'], row['timestamp']), row['timestamp'])
+        for conversation_id, timestamp in latest.items():
+            session.execute(
+                update(self.Conversation)
+                .where(self.Conversation.id == conversation_id)
+                .values(updated_at=timestamp)
+                .execution_options(synchronize_session=False)
+            )
+
+        session.flush()
+        events = [
+            {
+                'conversation_id': message.conversation_id,
+                'assigned_agent_id': assigned_agent_id,
+                'message': serialize_message(message)
+            }
+            for message, (_, assigned_agent_id) in zip(messages, batch)
+        ]
+        session.commit()
+        return events
@@ -0,0 +1,38 @@
+import logging
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("CRM QUERIES")
+
+
+class QueryCounter:
+    """Counts SQL statements per request and reports them in an X-Query-Count header.
+
+    Pages listed in budgets must run a fixed number of queries however much
+    data they show; going over the budget is logged as an N+1 regression.
+    """
+
+    def __init__(self, app=None, budgets=None):
+        self.budgets = budgets or {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        event.listen(Engine, 'before_cursor_execute', self._count)
+        app.after_request(self._report)
+
+    @staticmethod
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.query_count = g.get('query_count', 0) + 1
+
+    def _report(self, response):
+        count = g.get('query_count', 0)
+        response.headers['X-Query-Count'] = str(count)
+
+        budget = self.budgets.get(request.endpoint)
+        if budget is not None and count > budget:
+            logger.warning(f"{request.endpoint} ran {count} queries, budget is {budget}")
+        return response
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from CRMcache import LRUCache
+from CRMintents import tokenize
+
+logger = logging.getLogger("CRM RESPONDERS")
+
+RESPONDERS = ('intents', 'nearest')
+
+
+class Responder:
+    """A source of automatic replies; respond() returns None when it has nothing good to say"""
+
+    name = 'responder'
+
+    def respond(self, text):
+        raise NotImplementedError
+
+
+class IntentResponder(Responder):
+    """Replies from the keyword intents in intents.json"""
+
+    name = 'intents'
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def respond(self, text):
+        intent = self.engine.match(text)
+        return intent.response if intent is not None else None
+
+
+class NearestReplyResponder(Responder):
+    """Answers with what an agent replied to the most similar past user message.
+
+    Asks the suggested-replies index for its best match, so the bot and the
+    chat page's suggestions share one index, kept up to date by its own
+    background thread. Matches scoring under min_similarity are ignored.
+    """
+
+    name = 'nearest'
+
+    def __init__(self, index, min_similarity=0.5):
+        self.index = index
+        self.min_similarity = min_similarity
+
+    def respond(self, text):
+        matches = self.index.suggest(text, limit=1, min_score=self.min_similarity)
+        return matches[0]['reply'] if matches else None
+
+
+class AutoReplyService:
+    """Runs the responders in order under a hard deadline, with a cache of normalised queries.
+
+    The chain runs on a small thread pool and the caller waits at most
+    timeout seconds; on a miss, an error or no responder answering, the
+    fallback reply is returned, so a slow model never holds up a Telegram
+    handler. A request is only submitted when a worker is free, so chains
+    that overran their deadline can't pile up behind each other in the
+    pool's queue. Only real answers that arrived in time are cached, so a
+    responder that was still warming up gets asked again next time.
+    """
+
+    def __init__(self, responders, fallback, timeout=0.3, cache_size=5000, cache_ttl=600, workers=2,
+                 cache_version=None):
+        self.responders = list(responders)
+        self.fallback = fallback
+        # Part of the cache key, e.g. the intent rules' reload count, so edited rules apply at once
+        self.cache_version = cache_version
+        self.timeout = timeout
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crm-auto-reply")
+        # One slot per worker, held until the chain finishes, even after its caller gave up
+        self._slots = threading.BoundedSemaphore(workers)
+        self.stats = {'replies': 0, 'timeouts': 0, 'errors': 0, 'fallbacks': 0, 'saturated': 0,
+                      'answered_by': Counter(), 'slowest_ms': 0.0}
+
+    def fallback_reply(self):
+        return self.fallback() if callable(self.fallback) else self.fallback
+
+    def _run_chain(self, text):
+        for responder in self.responders:
+            reply = responder.respond(text)
+            if reply:
+                return responder.name, reply
+        return None, None
+
+    def reply(self, text):
+        self.stats['replies'] += 1
+        key = (self.cache_version() if self.cache_version else None, ' '.join(tokenize(text)))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        if not self._slots.acquire(blocking=False):
+            self.stats['saturated'] += 1
+            logger.warning("Every auto-reply worker is busy, sending the fallback")
+            return self.fallback_reply()
+
+        started = time.monotonic()
+        future = None
+        try:
+            future = self.executor.submit(self._run_chain, text)
+            future.add_done_callback(lambda _: self._slots.release())
+            name, reply = future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Only drops a chain that never started; a running one frees its slot when it returns
+            future.cancel()
+            self.stats['timeouts'] += 1
+            logger.warning(f"Auto-reply missed its {self.timeout * 1000:.0f} ms budget, sending the fallback")
+            return self.fallback_reply()
+        except Exception as e:
+            if future is None:
+                self._slots.release()
+            self.stats['errors'] += 1
+            logger.error(f"Error generating auto-reply: {e}", exc_info=True)
+            return self.fallback_reply()
+        finally:
+            self.stats['slowest_ms'] = max(self.stats['slowest_ms'], (time.monotonic() - started) * 1000)
+
+        if reply:
+            self.cache.set(key, reply)
+            self.stats['answered_by'][name] += 1
+            return reply
+        self.stats['fallbacks'] += 1
+        return self.fallback_reply()
+
+    def info(self):
+        return {
+            'responders': [responder.name for responder in self.responders],
+            'timeout_ms': self.timeout * 1000,
+            'cache': self.cache.stats(),
+            **self.stats
+        }
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from CRMcache import LRUCache
+
+logger = logging.getLogger("CRM RESPONSES")
+
+# Used when the catalogue file is missing or lacks an entry; mirrors responses.json
+DEFAULT_RESPONSES = {
+    'welcome': {
+        'text': [
+            '🤖 Welcome to CRM Support Bot!',
+            '',
+            'Available commands:',
+            '/start - Show this welcome message',
+            '/help - Get help information',
+            '/contract - Start contract agreement process',
+            '/pricing - Pricing cards',
+            '',
+            "We're here to help you! Just send us a message and we'll respond shortly.",
+        ],
+    },
+    'contract_welcome': {
+        'parse_mode': 'Markdown',
+        'text': [
+            '🤝 **Добро пожаловать!**',
+            '',
+            'Вы начинаете процесс заключения соглашения с нашей командой Zeffr.',
+            '',
+            'Пожалуйста, введите ваше ФИО полностью:',
+        ],
+    },
+    'pricing': {
+        'parse_mode': 'Markdown',
+        'text': [
+            '💼 **Прайс-лист услуг Zefir-IT**',
+            '',
+            '**Мелкие задачи и правки:**',
+            '• Исправление ошибок на сайте (до 1 ч) - 500 – 1 000 ₽',
+            '• Настройка форм обратной связи, почты (1 ч) - 800 – 1 500 ₽',
+            '• Подключение счётчиков (1 ч) - 500 – 1 000 ₽',
+            '• Настройка адаптивности (2–3 ч) - 1 500 – 3 000 ₽',
+            '• Установка SSL/домена/хостинга (0,5–1 день) - 1 000 – 2 000 ₽',
+            '',
+            '**Создание и доработка сайтов:**',
+            '• Доработка сайта (1–3 ч) - 1 000 – 3 000 ₽',
+            '• Вёрстка лендинга (1–2 дня) - 3 000 – 7 000 ₽',
+            '• Сайт «под ключ» (2–4 дня) - 5 000 – 15 000 ₽',
+            '• Интернет-магазин (5–7 дней) - 15 000 – 30 000 ₽',
+            '• Многостраничный сайт (1–2 недели) - 25 000 – 50 000 ₽',
+            '• SEO-оптимизация (1–3 дня) - 2 000 – 5 000 ₽',
+            '• Подключение CMS (1–2 дня) - 3 000 – 8 000 ₽',
+            '• Миграция сайта (1 день) - 2 000 – 4 000 ₽',
+            '',
+            '**Telegram-боты:**',
+            '• Бот с базовой логикой (1–2 дня) - 5 000 – 15 000 ₽',
+            '• Бот для заявок/заказов (2–3 дня) - 10 000 – 20 000 ₽',
+            '• Интеграция с Google Sheets, CRM (3–5 дней) - 15 000 – 30 000 ₽',
+            '• Бот с авторизацией и оплатой (4–6 дней) - 20 000 – 40 000 ₽',
+            '• Кастомная админ-панель (1 неделя) - 25 000 – 45 000 ₽',
+            '',
+            '**Интеграции и автоматизация:**',
+            '• Интеграция сайта с CRM (3–5 дней) - 15 000 – 35 000 ₽',
+            '• Интеграция с платёжными системами (3–5 дней) - 20 000 – 40 000 ₽',
+            '• Автоматизация бизнес-процессов (5–7 дней) - 20 000 – 50 000 ₽',
+            '• Настройка Webhook, REST API (2–4 дня) - 10 000 – 25 000 ₽',
+            '',
+            '**Дополнительные услуги:**',
+            '• Настройка Excel/Google Sheets (1–2 дня) - 2 000 – 6 000 ₽',
+            '• Разработка мини-приложений (2–5 дней) - 8 000 – 25 000 ₽',
+            '• Подключение ChatGPT/нейросетей (3–5 дней) - 15 000 – 40 000 ₽',
+            '• Аналитика и визуализация данных (2–4 дня) - 10 000 – 25 000 ₽',
+            '• Поддержка проекта (ежемесячно) - от 3 000 ₽ / мес',
+            '',
+            '💡 *Цены являются ориентировочными. Точная стоимость рассчитывается индивидуально под каждый проект.*',
+            '',
+            'Для обсуждения вашего проекта или получения консультации, просто напишите нам сообщение!',
+        ],
+        'keyboard': {'type': 'reply', 'resize_keyboard': True, 'row_width': 2,
+                     'buttons': ['📋 Обсудить проект', '💼 Начать договор', '👨‍💻 Связаться с менеджером',
+                                 '🏠 Главное меню']},
+    },
+}
+
+
+class Response:
+    """A catalogue entry ready to send: text, parse mode and keyboard JSON built once"""
+
+    def __init__(self, name, text, parse_mode=None, reply_markup=None):
+        self.name = name
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.digest = hashlib.sha1(f"{parse_mode}\n{text}".encode()).hexdigest()
+        # Set once the text is recorded in response_templates
+        self.version = None
+
+    def __repr__(self):
+        return f"Response({self.name!r})"
+
+
+def build_keyboard(spec):
+    """Serialise a keyboard spec from the catalogue file to the Bot API's JSON"""
+    if not spec:
+        return None
+    if spec.get('type', 'reply') == 'inline':
+        keyboard = InlineKeyboardMarkup(row_width=spec.get('row_width', 1))
+        keyboard.add(*(InlineKeyboardButton(button['text'], callback_data=button.get('callback_data'),
+                                            url=button.get('url'))
+                       for button in spec['buttons']))
+    else:
+        keyboard = ReplyKeyboardMarkup(resize_keyboard=spec.get('resize_keyboard', True),
+                                       one_time_keyboard=spec.get('one_time_keyboard'),
+                                       row_width=spec.get('row_width', 3))
+        keyboard.add(*(KeyboardButton(button) for button in spec['buttons']))
+    # telebot passes a string reply_markup through as is
+    return keyboard.to_json()
+
+
+def compile_responses(document):
+    responses = {}
+    for name, spec in document.items():
+        text = spec['text']
+        if isinstance(text, list):
+            # One list item per line keeps long texts editable in JSON
+            text = '\n'.join(text)
+        responses[name] = Response(name, text, spec.get('parse_mode'), build_keyboard(spec.get('keyboard')))
+    return responses
+
+
+class ResponseCatalogue:
+    """Static bot responses loaded from a JSON file, stored by reference instead of by text.
+
+    Each text is recorded once per version in the response_templates table;
+    a message sent from the catalogue keeps only the template name and
+    version, and its text is looked up through a small cache when shown.
+    Versions are recorded when the file is loaded, by init_db() and by the
+    reload thread, never from a bot handler, so sending a response never
+    writes outside the handler's own transaction. An edited text gets a
+    new version and older messages keep showing what was actually sent.
+    """
+
+    def __init__(self, app, db, ResponseTemplate, path, cache_size=256):
+        self.app = app
+        self.db = db
+        self.ResponseTemplate = ResponseTemplate
+        self.path = path
+        self.reloads = 0
+        self.responses = compile_responses(DEFAULT_RESPONSES)
+        self._texts = LRUCache(maxsize=cache_size)
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._thread = None
+        # The tables may not exist yet; init_db() records the versions through sync()
+        self.reload(record=False)
+
+    def reload(self, record=True):
+        """Re-read the file if it changed; returns True when it did"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.error(f"Response catalogue not readable, keeping the current one: {e}")
+            return False
+        if mtime == self._mtime:
+            return False
+
+        with self._lock:
+            if mtime == self._mtime:
+                return False
+            try:
+                with open(self.path, encoding='utf-8') as source:
+                    responses = compile_responses({**DEFAULT_RESPONSES, **json.load(source)})
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logger.error(f"Invalid response catalogue {self.path}, keeping the current one: {e}")
+                self._mtime = mtime
+                return False
+            if record:
+                self._record_all(responses)
+            # Swapping the reference is atomic; handlers in flight finish on the old responses
+            self.responses = responses
+            self._mtime = mtime
+            self.reloads += 1
+        logger.info(f"Loaded {len(responses)} responses from {self.path}")
+        return True
+
+    def _record_all(self, responses):
+        for name, response in responses.items():
+            current = self.responses.get(name)
+            if current is not None and current.digest == response.digest and current.version is not None:
+                response.version = current.version
+                continue
+            try:
+                response.version = self._record(response)
+            except Exception as e:
+                # Sent without a version, the text is stored in full instead
+                logger.error(f"Error recording response '{name}': {e}")
+
+    def sync(self):
+        """Record the current version of every response; returns {name: version}"""
+        with self._lock:
+            self._record_all(self.responses)
+        return {name: response.version for name, response in self.responses.items()}
+
+    def get(self, name):
+        """(Response, version) for a catalogue entry; version is None if it couldn't be recorded"""
+        response = self.responses[name]
+        return response, response.version
+
+    def _record(self, response):
+        """Version of the response's text in response_templates, adding a row if it is new"""
+        ResponseTemplate = self.ResponseTemplate
+        with self.app.app_context():
+            session = self.db.session
+            for _ in range(3):
+                latest = session.execute(
+                    select(ResponseTemplate)
+                    .where(ResponseTemplate.name == response.name)
+                    .order_by(ResponseTemplate.version.desc())
+                    .limit(1)
+                ).scalar()
+                if latest is not None and latest.text == response.text and latest.parse_mode == response.parse_mode:
+                    version = latest.version
+                    session.rollback()
+                    return version
+
+                version = latest.version + 1 if latest is not None else 1
+                session.add(ResponseTemplate(name=response.name, version=version, text=response.text,
+                                             parse_mode=response.parse_mode, created_at=datetime.utcnow()))
+                try:
+                    session.commit()
+                except IntegrityError:
+                    # Another process recorded a version at the same time; look again
+                    session.rollback()
+                    continue
+                logger.info(f"Recorded response '{response.name}' version {version}")
+                self._texts.set((response.name, version), response.text)
+                return version
+        raise RuntimeError(f"Could not record a version of response '{response.name}'")
+
+    def start(self, interval=2):
+        """Pick up edits to the file, and retry unrecorded versions, from a daemon thread"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name="crm-responses", daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval):
+        while True:
+            try:
+                if not self.reload() and any(response.version is None for response in self.responses.values()):
+                    self.sync()
+            except Exception as e:
+                logger.error(f"Error reloading the response catalogue: {e}", exc_info=True)
+            time.sleep(interval)
+
+    def text(self, name, version):
+        """The text a message sent as (name, version) showed the user"""
+        key = (name, version)
+        text = self._texts.get(key)
+        if text is not None:
+            return text
+
+        ResponseTemplate = self.ResponseTemplate
+        with self.app.app_context():
+            text = self.db.session.execute(
+                select(ResponseTemplate.text)
+                .where(ResponseTemplate.name == name, ResponseTemplate.version == version)
+            ).scalar()
+            self.db.session.rollback()
+        if text is None:
+            logger.error(f"Response '{name}' version {version} not found")
+            return ''
+        self._texts.set(key, text)
+        return text
+
+    def summary(self):
+        return {
+            'path': self.path,
+            'reloads': self.reloads,
+            'responses': {
+                name: {'bytes': len(response.text.encode()), 'version': response.version,
+                       'keyboard': response.reply_markup is not None}
+                for name, response in self.responses.items()
+            },
+            'text_cache': self._texts.stats()
+        }
@@ -0,0 +1,309 @@
+import heapq
+import logging
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import aliased
+
+from CRMhub import serialize_conversation
+from CRMstats import OPEN_STATUSES
+
+logger = logging.getLogger("CRM ROUTING")
+
+ROUTING_MODES = ('queue', 'auto', 'open')
+
+# Unassigned conversations in these states wait for an agent
+WAITING_STATUSES = ('open', 'contract_process')
+# Assigned conversations in these states count towards an agent's load
+FINISHED_STATUSES = ('completed', 'closed')
+
+
+class RoutingQueue:
+    """Queue of unassigned conversations, longest waiting first, with each agent's active load.
+
+    The queue is a heap of (waiting_since, conversation_id) kept up to date
+    from the live update hub and resynchronised from the database every
+    refresh interval, which also picks up changes made by other processes.
+    A conversation waits since its first user message after the last agent
+    reply, or since it was created if it has none; both paths read that
+    from the database, so a resync never reorders the queue. Entries are
+    invalidated lazily: a popped entry that no longer matches the waiting
+    map is skipped. The claim itself is a conditional UPDATE on
+    assigned_agent_id IS NULL, so two agents, or two processes, can never
+    both win the same conversation.
+    """
+
+    def __init__(self, app, db, Conversation, Message, hub=None, counters=None, max_load=5, auto_assign=False,
+                 agent_timeout=300, history=1000):
+        self.app = app
+        self.db = db
+        self.Conversation = Conversation
+        self.Message = Message
+        self.hub = hub
+        # StatsCounters; the claim's Core UPDATE bypasses its flush hook
+        self.counters = counters
+        self.max_load = max_load
+        self.auto_assign = auto_assign
+        self.agent_timeout = agent_timeout
+
+        self._heap = []
+        self._waiting = {}      # conversation id -> waiting since (UTC)
+        self._owners = {}       # conversation id -> agent id, active conversations only
+        self._load = Counter()  # agent id -> active conversations
+        self._seen = {}         # agent id -> monotonic time of last dashboard activity
+        self._lock = threading.Lock()
+        self._dispatching = threading.Lock()
+        self._thread = None
+
+        self._waits = deque(maxlen=history)  # seconds waited by recent assignments
+        self.stats = {'enqueued': 0, 'assigned': 0, 'auto_assigned': 0, 'lost_claims': 0, 'refreshes': 0}
+
+        if hub:
+            hub.add_listener(self.on_hub_event)
+
+    # -- state
+
+    def _enqueue(self, conversation_id, waiting_since):
+        known = self._waiting.get(conversation_id)
+        if known is not None and known <= waiting_since:
+            return
+        if known is None:
+            self.stats['enqueued'] += 1
+        self._waiting[conversation_id] = waiting_since
+        heapq.heappush(self._heap, (waiting_since, conversation_id))
+
+    def _set_owner(self, conversation_id, agent_id):
+        previous = self._owners.pop(conversation_id, None)
+        if previous is not None:
+            self._load[previous] -= 1
+            if not self._load[previous]:
+                del self._load[previous]
+        if agent_id is not None:
+            self._owners[conversation_id] = agent_id
+            self._load[agent_id] += 1
+
+    def _track(self, conversation_id, status, agent_id, waiting_since):
+        if agent_id is None and status in WAITING_STATUSES:
+            self._set_owner(conversation_id, None)
+            if waiting_since is not None:
+                self._enqueue(conversation_id, waiting_since)
+            return
+        self._waiting.pop(conversation_id, None)
+        self._set_owner(conversation_id, agent_id if status not in FINISHED_STATUSES else None)
+
+    def waiting_query(self):
+        """(id, waiting since) of the unassigned conversations waiting for an agent"""
+        Conversation = self.Conversation
+        Message = self.Message
+        Reply = aliased(Message)
+        last_reply = (
+            select(func.max(Reply.id))
+            .where(Reply.conversation_id == Conversation.id, Reply.sender_type == 'agent')
+            .correlate(Conversation)
+            .scalar_subquery()
+        )
+        first_unanswered = (
+            select(func.min(Message.timestamp))
+            .where(Message.conversation_id == Conversation.id, Message.sender_type == 'user',
+                   Message.id > func.coalesce(last_reply, 0))
+            .correlate(Conversation)
+            .scalar_subquery()
+        )
+        return (
+            select(Conversation.id, func.coalesce(first_unanswered, Conversation.created_at))
+            .where(Conversation.assigned_agent_id.is_(None), Conversation.status.in_(WAITING_STATUSES))
+        )
+
+    def _waiting_since(self, conversation_id):
+        with self.app.app_context():
+            row = self.db.session.execute(
+                self.waiting_query().where(self.Conversation.id == conversation_id)
+            ).first()
+            self.db.session.rollback()
+        return row[1] if row is not None else None
+
+    def on_hub_event(self, event, data):
+        if event == 'conversation':
+            conversation_id = data['id']
+            waiting = data['assigned_agent_id'] is None and data['status'] in WAITING_STATUSES
+        elif event == 'message' and data.get('assigned_agent_id') is None:
+            # Messages carry no status; claim() skips anything that is no longer waiting
+            conversation_id = data['conversation_id']
+            waiting = True
+        else:
+            return
+
+        waiting_since = None
+        if waiting and conversation_id not in self._waiting:
+            waiting_since = self._waiting_since(conversation_id) or datetime.utcnow()
+        with self._lock:
+            if event == 'conversation':
+                self._track(conversation_id, data['status'], data['assigned_agent_id'], waiting_since)
+            elif waiting_since is not None:
+                self._enqueue(conversation_id, waiting_since)
+        if self.auto_assign and data.get('assigned_agent_id') is None:
+            self.dispatch()
+
+    def refresh(self):
+        """Rebuild the queue and the loads from the database"""
+        Conversation = self.Conversation
+        with self.app.app_context():
+            waiting = self.db.session.execute(self.waiting_query()).all()
+            owners = self.db.session.execute(
+                select(Conversation.id, Conversation.assigned_agent_id)
+                .where(Conversation.assigned_agent_id.is_not(None), Conversation.status.not_in(FINISHED_STATUSES))
+            ).all()
+            self.db.session.rollback()
+
+        with self._lock:
+            self._waiting = {}
+            for conversation_id, waiting_since in waiting:
+                self._waiting[conversation_id] = waiting_since or datetime.utcnow()
+            self._heap = [(since, conversation_id) for conversation_id, since in self._waiting.items()]
+            heapq.heapify(self._heap)
+            self._owners = dict(owners)
+            self._load = Counter(self._owners.values())
+            self.stats['refreshes'] += 1
+
+    def touch(self, agent_id):
+        """Mark an agent as available for automatic assignment"""
+        self._seen[agent_id] = time.monotonic()
+
+    # -- claiming
+
+    def claim(self, conversation_id, agent_id):
+        """Assign a waiting conversation to an agent; False if someone else got it first.
+
+        Must run in an app context; commits the session.
+        """
+        Conversation = self.Conversation
+        session = self.db.session
+        previous = session.execute(select(Conversation.status).where(Conversation.id == conversation_id)).scalar()
+        won = False
+        if previous in WAITING_STATUSES:
+            # Matching the status read above tells the counters what the claim changed
+            result = session.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id, Conversation.assigned_agent_id.is_(None),
+                       Conversation.status == previous)
+                .values(assigned_agent_id=agent_id, status='assigned', updated_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            won = result.rowcount == 1
+            if won and self.counters is not None and previous not in OPEN_STATUSES:
+                self.counters.add('open_conversations', 1)
+        session.commit()
+
+        with self._lock:
+            waiting_since = self._waiting.pop(conversation_id, None)
+            if not won:
+                self.stats['lost_claims'] += 1
+                return False
+            self._set_owner(conversation_id, agent_id)
+            self.stats['assigned'] += 1
+            if waiting_since is not None:
+                self._waits.append((datetime.utcnow() - waiting_since).total_seconds())
+
+        # The commit expired the row, so this reads the assignment back
+        conversation = self.db.session.get(Conversation, conversation_id)
+        if self.hub and conversation is not None:
+            self.hub.publish('conversation', serialize_conversation(conversation))
+        return True
+
+    def _pop(self):
+        """Longest-waiting conversation id, or None; stale heap entries are dropped"""
+        with self._lock:
+            while self._heap:
+                since, conversation_id = heapq.heappop(self._heap)
+                if self._waiting.get(conversation_id) == since:
+                    return conversation_id
+        return None
+
+    def load(self, agent_id):
+        """Active conversations assigned to an agent"""
+        return self._load.get(agent_id, 0)
+
+    def take_next(self, agent_id):
+        """Claim the longest-waiting conversation for an agent; its id, or None"""
+        if self.load(agent_id) >= self.max_load:
+            return None
+        while True:
+            conversation_id = self._pop()
+            if conversation_id is None:
+                return None
+            if self.claim(conversation_id, agent_id):
+                return conversation_id
+
+    def available_agents(self):
+        """Agents seen within agent_timeout with room for more conversations, least loaded first"""
+        cutoff = time.monotonic() - self.agent_timeout
+        with self._lock:
+            agents = [agent_id for agent_id, seen in self._seen.items()
+                      if seen >= cutoff and self._load.get(agent_id, 0) < self.max_load]
+            return sorted(agents, key=lambda agent_id: (self._load.get(agent_id, 0), agent_id))
+
+    def dispatch(self):
+        """Hand waiting conversations to the least-loaded available agents; returns how many"""
+        # Claims publish events that land back here; one dispatch at a time is enough
+        if not self._dispatching.acquire(blocking=False):
+            return 0
+        assigned = 0
+        try:
+            with self.app.app_context():
+                while self._waiting:
+                    agents = self.available_agents()
+                    if not agents:
+                        break
+                    conversation_id = self.take_next(agents[0])
+                    if conversation_id is None:
+                        break
+                    self.stats['auto_assigned'] += 1
+                    assigned += 1
+        finally:
+            self._dispatching.release()
+        return assigned
+
+    def start(self, interval=30):
+        """Resynchronise from the database, and auto-assign if enabled, from a daemon thread"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name="crm-routing", daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval):
+        while True:
+            try:
+                self.refresh()
+                if self.auto_assign:
+                    self.dispatch()
+            except Exception as e:
+                logger.error(f"Error refreshing the routing queue: {e}", exc_info=True)
+            time.sleep(interval)
+
+    # -- metrics
+
+    def metrics(self):
+        now = datetime.utcnow()
+        with self._lock:
+            waits = sorted((now - since).total_seconds() for since in self._waiting.values())
+            assigned_waits = sorted(self._waits)
+            load = dict(self._load)
+
+        def percentile(values, fraction):
+            return round(values[min(len(values) - 1, int(len(values) * fraction))], 1) if values else None
+
+        return {
+            'depth': len(waits),
+            'oldest_wait_seconds': round(waits[-1], 1) if waits else None,
+            'median_wait_seconds': percentile(waits, 0.5),
+            'assigned_wait_p50_seconds': percentile(assigned_waits, 0.5),
+            'assigned_wait_p90_seconds': percentile(assigned_waits, 0.9),
+            'agent_load': load,
+            'max_load': self.max_load,
+            'auto_assign': self.auto_assign,
+            'available_agents': self.available_agents() if self.auto_assign else None,
+            **self.stats
+        }
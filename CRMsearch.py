@@ -0,0 +1,295 @@
+import bisect
+import logging
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from sqlalchemy import event, select, text
+
+logger = logging.getLogger("CRM SEARCH")
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(value):
+    return TOKEN_RE.findall(value.lower()) if value else []
+
+
+def make_snippet(content, terms, width=80):
+    """Text around the first matching term, marked with [brackets]"""
+    lowered = content.lower()
+    positions = [lowered.find(term) for term in terms if term in lowered]
+    start = max(0, min(positions) - width // 2) if positions else 0
+    snippet = content[start:start + width]
+    for term in terms:
+        snippet = re.sub(f'({re.escape(term)}\\w*)', r'[\1]', snippet, flags=re.IGNORECASE)
+    return ('…' if start else '') + snippet + ('…' if start + width < len(content) else '')
+
+
+class Fts5SearchIndex:
+    """Search backed by SQLite FTS5 tables that triggers keep in step with the base tables"""
+
+    backend = 'fts5'
+
+    SCHEMA = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "content, content='messages', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+
+        "CREATE VIRTUAL TABLE IF NOT EXISTS telegram_users_fts USING fts5("
+        "first_name, last_name, username, content='telegram_users', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS telegram_users_fts_ai AFTER INSERT ON telegram_users BEGIN "
+        "INSERT INTO telegram_users_fts(rowid, first_name, last_name, username) "
+        "VALUES (new.id, new.first_name, new.last_name, new.username); END",
+        "CREATE TRIGGER IF NOT EXISTS telegram_users_fts_ad AFTER DELETE ON telegram_users BEGIN "
+        "INSERT INTO telegram_users_fts(telegram_users_fts, rowid, first_name, last_name, username) "
+        "VALUES ('delete', old.id, old.first_name, old.last_name, old.username); END",
+        "CREATE TRIGGER IF NOT EXISTS telegram_users_fts_au AFTER UPDATE OF first_name, last_name, username "
+        "ON telegram_users BEGIN "
+        "INSERT INTO telegram_users_fts(telegram_users_fts, rowid, first_name, last_name, username) "
+        "VALUES ('delete', old.id, old.first_name, old.last_name, old.username); "
+        "INSERT INTO telegram_users_fts(rowid, first_name, last_name, username) "
+        "VALUES (new.id, new.first_name, new.last_name, new.username); END",
+    ]
+
+    def __init__(self, db):
+        self.db = db
+
+    def setup(self):
+        """Create the FTS tables and triggers, indexing existing rows the first time"""
+        session = self.db.session
+        existing = session.execute(text(
+            "SELECT name FROM sqlite_master WHERE name IN ('messages_fts', 'telegram_users_fts')"
+        )).scalars().all()
+
+        for statement in self.SCHEMA:
+            session.execute(text(statement))
+        for table in ('messages_fts', 'telegram_users_fts'):
+            if table not in existing:
+                session.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+                logger.info(f"Built search index {table}")
+        session.commit()
+
+    def index_rows(self, messages=(), users=()):
+        """Rows inserted with Core bypass the ORM; the triggers have indexed them already"""
+
+    @staticmethod
+    def match_expression(query):
+        # Every term must match, each as a prefix; quoting keeps FTS5 syntax out of user input
+        return ' '.join(f'"{term}"*' for term in tokenize(query))
+
+    def search_messages(self, query, limit=20, offset=0):
+        """[(message_id, snippet)] best match first"""
+        match = self.match_expression(query)
+        if not match:
+            return []
+        rows = self.db.session.execute(text(
+            "SELECT rowid, snippet(messages_fts, 0, '[', ']', '…', 12) FROM messages_fts "
+            "WHERE messages_fts MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset"
+        ), {'match': match, 'limit': limit, 'offset': offset}).all()
+        return [(row[0], row[1]) for row in rows]
+
+    def search_users(self, query, limit=10, offset=0):
+        """[telegram_user_id] best match first"""
+        match = self.match_expression(query)
+        if not match:
+            return []
+        return self.db.session.execute(text(
+            "SELECT rowid FROM telegram_users_fts WHERE telegram_users_fts MATCH :match "
+            "ORDER BY bm25(telegram_users_fts, 2.0, 1.0, 3.0) LIMIT :limit OFFSET :offset"
+        ), {'match': match, 'limit': limit, 'offset': offset}).scalars().all()
+
+    def stats(self):
+        session = self.db.session
+        return {
+            'backend': self.backend,
+            'messages': session.execute(text("SELECT count(*) FROM messages_fts")).scalar(),
+            'telegram_users': session.execute(text("SELECT count(*) FROM telegram_users_fts")).scalar()
+        }
+
+
+class InvertedIndex:
+    """In-memory inverted index with TF-IDF ranking and prefix matching"""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.vocabulary = []
+        self._lock = threading.RLock()
+
+    def add(self, doc_id, text_value):
+        with self._lock:
+            self.remove(doc_id)
+            terms = Counter(tokenize(text_value))
+            if not terms:
+                return
+            self.documents[doc_id] = terms
+            for term, count in terms.items():
+                if term not in self.postings:
+                    bisect.insort(self.vocabulary, term)
+                self.postings[term][doc_id] = count
+
+    def remove(self, doc_id):
+        with self._lock:
+            for term in self.documents.pop(doc_id, ()):
+                self.postings[term].pop(doc_id, None)
+
+    def expand(self, prefix):
+        """Every indexed term that starts with prefix"""
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\uffff')
+        return self.vocabulary[start:end]
+
+    def search(self, query, limit=20, offset=0):
+        """[doc_id] containing every query term (as a prefix), best match first"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        with self._lock:
+            total = len(self.documents) or 1
+            scores = None
+            for term in terms:
+                term_scores = defaultdict(float)
+                for word in self.expand(term):
+                    docs = self.postings[word]
+                    if not docs:
+                        continue
+                    idf = math.log(1 + total / len(docs))
+                    # A whole-word hit outranks a longer word that merely starts with the term
+                    weight = idf if word == term else idf / 2
+                    for doc_id, count in docs.items():
+                        term_scores[doc_id] += (1 + math.log(count)) * weight
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {doc_id: score + term_scores[doc_id] for doc_id, score in scores.items()
+                              if doc_id in term_scores}
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [doc_id for doc_id, _ in ranked[offset:offset + limit]]
+
+    def __len__(self):
+        return len(self.documents)
+
+
+class MemorySearchIndex:
+    """Fallback for databases without FTS5: inverted indexes built at startup.
+
+    Flushed inserts, updates and deletes are applied to the indexes as they
+    happen. Results are looked up in the database again, so ids from a
+    rolled-back transaction simply drop out.
+    """
+
+    backend = 'memory'
+
+    def __init__(self, db, TelegramUser, Message, chunk_size=5000):
+        self.db = db
+        self.TelegramUser = TelegramUser
+        self.Message = Message
+        self.chunk_size = chunk_size
+        self.messages = InvertedIndex()
+        self.users = InvertedIndex()
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+
+    @staticmethod
+    def user_text(user):
+        return ' '.join(part for part in (user.first_name, user.last_name, user.username) if part)
+
+    def index_rows(self, messages=(), users=()):
+        """Index rows inserted with Core, which the flush hook never sees; dicts with an 'id'"""
+        for message in messages:
+            self.messages.add(message['id'], message['content'])
+        for user in users:
+            self.users.add(user['id'], ' '.join(
+                part for part in (user['first_name'], user['last_name'], user['username']) if part))
+
+    def _index(self, obj):
+        if isinstance(obj, self.Message):
+            self.messages.add(obj.id, obj.content)
+        elif isinstance(obj, self.TelegramUser):
+            self.users.add(obj.id, self.user_text(obj))
+
+    def _after_flush(self, session, flush_context):
+        for obj in list(session.new) + list(session.dirty):
+            self._index(obj)
+        for obj in session.deleted:
+            if isinstance(obj, self.Message):
+                self.messages.remove(obj.id)
+            elif isinstance(obj, self.TelegramUser):
+                self.users.remove(obj.id)
+
+    def setup(self):
+        """Index every existing message and user, reading in id order by chunks"""
+        Message = self.Message
+        TelegramUser = self.TelegramUser
+        session = self.db.session
+
+        last_id = 0
+        while True:
+            rows = session.execute(
+                select(Message.id, Message.content).where(Message.id > last_id).order_by(Message.id).limit(self.chunk_size)
+            ).all()
+            if not rows:
+                break
+            for message_id, content in rows:
+                self.messages.add(message_id, content)
+            last_id = rows[-1][0]
+
+        for user in session.execute(select(TelegramUser)).scalars():
+            self.users.add(user.id, self.user_text(user))
+
+        logger.info(f"Built in-memory search index: {len(self.messages)} messages, {len(self.users)} users")
+
+    def search_messages(self, query, limit=20, offset=0):
+        ids = self.messages.search(query, limit, offset)
+        if not ids:
+            return []
+        contents = dict(self.db.session.execute(
+            select(self.Message.id, self.Message.content).where(self.Message.id.in_(ids))
+        ).all())
+        terms = tokenize(query)
+        return [(message_id, make_snippet(contents[message_id], terms)) for message_id in ids if message_id in contents]
+
+    def search_users(self, query, limit=10, offset=0):
+        return self.users.search(query, limit, offset)
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'messages': len(self.messages),
+            'telegram_users': len(self.users),
+            'terms': len(self.messages.vocabulary) + len(self.users.vocabulary)
+        }
+
+
+def fts5_available(db):
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(text("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)"))
+            connection.execute(text("DROP TABLE temp.fts5_probe"))
+        return True
+    except Exception:
+        return False
+
+
+def create_search_index(db, TelegramUser, Message, backend='auto'):
+    """FTS5 on SQLite builds that have it, the in-memory index everywhere else.
+
+    Must be called inside an app context, since probing for FTS5 needs the engine.
+    """
+    if backend == 'fts5' or (backend == 'auto' and fts5_available(db)):
+        return Fts5SearchIndex(db)
+    return MemorySearchIndex(db, TelegramUser, Message)
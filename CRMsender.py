@@ -0,0 +1,107 @@
+import logging
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from telebot.apihelper import ApiHTTPException, ApiTelegramException
+
+from CRMworkers import KeyedWorkerPool
+
+logger = logging.getLogger("CRM SENDER")
+
+
+def configure_http_pool(pool_size=10):
+    """Share one keep-alive connection pool between every Bot API call"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    apihelper.session = session
+    # Keep the pooled session instead of rebuilding it every 10 minutes
+    apihelper.SESSION_TIME_TO_LIVE = None
+    return session
+
+
+def retry_delay(error, attempt, base_delay):
+    """Seconds to wait before retrying a failed send, or None if it shouldn't be retried"""
+    if isinstance(error, ApiTelegramException):
+        if error.error_code == 429:
+            return error.result_json.get('parameters', {}).get('retry_after', base_delay * 2 ** attempt)
+        if error.error_code >= 500:
+            return base_delay * 2 ** attempt
+        return None
+
+    if isinstance(error, ApiHTTPException):
+        return base_delay * 2 ** attempt if error.result.status_code >= 500 else None
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return base_delay * 2 ** attempt
+
+    return None
+
+
+class OutboundSender:
+    """Long-lived Telegram client with a background send queue.
+
+    Messages to the same chat are delivered in the order they were queued.
+    """
+
+    def __init__(self, bot, workers=2, queue_size=500, max_retries=5, base_delay=1.0):
+        self.bot = bot
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.pool = KeyedWorkerPool(num_workers=workers, queue_size=queue_size, name="crm-sender")
+
+        self.stats = {'sent': 0, 'failed': 0, 'retries': 0, 'dropped': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def enqueue(self, chat_id, text, **kwargs):
+        """Queue a message for delivery and return immediately"""
+        try:
+            self.pool.submit(chat_id, self._deliver, chat_id, text, kwargs, block=False)
+            return True
+        except queue.Full:
+            logger.error(f"Outbound queue full, dropping message to {chat_id}")
+            self._count('dropped')
+            return False
+
+    def send_now(self, chat_id, text, **kwargs):
+        """Send a message, retrying on rate limits and server errors"""
+        attempt = 0
+        while True:
+            try:
+                result = self.bot.send_message(chat_id, text, **kwargs)
+                self._count('sent')
+                return result
+            except Exception as e:
+                delay = retry_delay(e, attempt, self.base_delay)
+                if delay is None or attempt >= self.max_retries:
+                    self._count('failed')
+                    raise
+
+                attempt += 1
+                self._count('retries')
+                logger.warning(f"Retrying message to {chat_id} in {delay}s (attempt {attempt}): {e}")
+                time.sleep(delay)
+
+    def pending(self):
+        return self.pool.pending()
+
+    def join(self):
+        """Wait until every queued message has been handled"""
+        self.pool.join()
+
+    def _deliver(self, chat_id, text, kwargs):
+        try:
+            self.send_now(chat_id, text, **kwargs)
+            logger.info(f"Message sent to user {chat_id}")
+        except Exception as e:
+            logger.error(f"Error sending message to user {chat_id}: {e}")
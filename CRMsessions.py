@@ -0,0 +1,212 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+from sqlalchemy import delete, event, select
+
+from CRMcache import LRUCache
+
+logger = logging.getLogger("CRM SESSIONS")
+
+
+class MemorySessionStore:
+    """Contract sessions kept in process memory with TTL eviction and a size cap"""
+
+    backend = 'memory'
+
+    def __init__(self, ttl=3600, maxsize=10000):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def __contains__(self, key):
+        return self.cache.get(key) is not None
+
+    def __getitem__(self, key):
+        session = self.cache.get(key)
+        if session is None:
+            raise KeyError(key)
+        return session
+
+    def __setitem__(self, key, session):
+        self.cache.set(key, session)
+
+    def __delitem__(self, key):
+        self.cache.pop(key)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stats(self):
+        self.cache.purge_expired()
+        return {'backend': self.backend, 'sessions': len(self.cache), **self.cache.stats()}
+
+
+class DatabaseSessionStore:
+    """Contract sessions persisted in the database behind a short-lived in-memory cache.
+
+    Sessions survive restarts and are shared by every bot worker and
+    process. Lookups are answered from memory, including for users known
+    to have no session, so ordinary chat messages don't query the sessions
+    table. Only committed rows are cached: a read or a save inside a bot
+    handler's transaction reaches the cache when that transaction commits
+    and is dropped if it rolls back. A save or delete invalidates the entry
+    at once, and entries expire after cache_ttl seconds, which bounds how
+    long a change made by another process goes unseen.
+    """
+
+    backend = 'database'
+    PENDING = 'contract_sessions'
+
+    def __init__(self, app, db, ContractSession, ttl=3600, maxsize=10000, cache_ttl=10, purge_interval=600):
+        self.app = app
+        self.db = db
+        self.ContractSession = ContractSession
+        self.ttl = ttl
+        # telegram_id -> (JSON data, expires_at); (None, None) when the user has no session
+        self.cache = LRUCache(maxsize=maxsize, ttl=cache_ttl)
+        self.purge_interval = purge_interval
+        self._last_purge = 0
+        self.db_reads = 0
+        # Bumped by every save and delete, so a read that raced one is not cached
+        self._version = 0
+        self._lock = threading.Lock()
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._after_rollback)
+
+    def run(self, work, write=False):
+        """Run work(session) in the caller's transaction, or in our own if there is none.
+
+        Inside a bot handler the write is only flushed so it commits together
+        with the handler, and SQLite isn't asked for a second write lock.
+        """
+        if has_app_context():
+            result = work(self.db.session)
+            if write:
+                self.db.session.flush()
+            return result
+
+        with self.app.app_context():
+            result = work(self.db.session)
+            if write:
+                self.db.session.commit()
+            return result
+
+    # -- cache
+
+    def _invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            self.cache.pop(key)
+
+    def _store(self, key, entry):
+        """Cache a committed save; readers that saw the old row before it must not cache theirs"""
+        with self._lock:
+            self._version += 1
+            self.cache.set(key, entry)
+
+    def _fill(self, key, entry, version):
+        with self._lock:
+            if version == self._version:
+                self.cache.set(key, entry)
+
+    def _apply(self, key, entry, version):
+        if version is None:
+            self._store(key, entry)
+        else:
+            self._fill(key, entry, version)
+
+    def _cache_later(self, key, entry, version=None):
+        """Cache an entry once the caller's transaction commits; version None marks a write"""
+        if not has_app_context():
+            self._apply(key, entry, version)
+            return
+        pending = self.db.session.info.setdefault(self.PENDING, {})
+        # A read after a save in the same transaction must not demote the save
+        if version is None or key not in pending or pending[key][1] is not None:
+            pending[key] = (entry, version)
+
+    def _after_commit(self, session):
+        for key, (entry, version) in session.info.pop(self.PENDING, {}).items():
+            self._apply(key, entry, version)
+
+    def _after_rollback(self, session):
+        session.info.pop(self.PENDING, None)
+
+    # -- mapping
+
+    def get(self, key, default=None):
+        entry = self.cache.get(key)
+        if entry is None:
+            version = self._version
+            self.db_reads += 1
+            row = self.run(lambda db_session: db_session.execute(
+                select(self.ContractSession.data, self.ContractSession.expires_at)
+                .where(self.ContractSession.telegram_id == key)
+            ).first())
+            entry = tuple(row) if row is not None else (None, None)
+            self._cache_later(key, entry, version)
+
+        data, expires_at = entry
+        if data is None or expires_at <= datetime.utcnow():
+            return default
+        # Decoded every time: handlers change the dict in place before saving it
+        return json.loads(data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        session = self.get(key)
+        if session is None:
+            raise KeyError(key)
+        return session
+
+    def __setitem__(self, key, session):
+        entry = (json.dumps(session), datetime.utcnow() + timedelta(seconds=self.ttl))
+
+        def save(db_session):
+            row = db_session.get(self.ContractSession, key)
+            if row is None:
+                row = self.ContractSession(telegram_id=key)
+                db_session.add(row)
+            row.data, row.expires_at = entry
+
+        self._invalidate(key)
+        self.run(save, write=True)
+        self._cache_later(key, entry)
+        self.purge_expired()
+
+    def __delitem__(self, key):
+        self._invalidate(key)
+        self.run(lambda db_session: db_session.execute(
+            delete(self.ContractSession).where(self.ContractSession.telegram_id == key)
+        ), write=True)
+        self._cache_later(key, (None, None))
+
+    def __len__(self):
+        return self.run(lambda db_session: db_session.query(self.ContractSession).filter(
+            self.ContractSession.expires_at > datetime.utcnow()
+        ).count())
+
+    def purge_expired(self, force=False):
+        """Delete abandoned sessions, at most once per purge_interval"""
+        now = time.monotonic()
+        if not force and now - self._last_purge < self.purge_interval:
+            return 0
+        self._last_purge = now
+
+        result = self.run(lambda db_session: db_session.execute(
+            delete(self.ContractSession).where(self.ContractSession.expires_at <= datetime.utcnow())
+        ), write=True)
+        if result.rowcount:
+            logger.info(f"Purged {result.rowcount} expired contract sessions")
+        return result.rowcount
+
+    def stats(self):
+        return {'backend': self.backend, 'sessions': len(self), 'db_reads': self.db_reads, **self.cache.stats()}
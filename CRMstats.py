@@ -0,0 +1,190 @@
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import event, inspect, select, update
+
+logger = logging.getLogger("CRM STATS")
+
+OPEN_STATUSES = ('open', 'assigned')
+
+
+class StatsCounters:
+    """Admin dashboard totals kept in a counters table instead of counted per page view.
+
+    Every flush that inserts, deletes or changes the status of a counted row
+    records a delta on its session. The deltas of committed transactions are
+    summed in memory and written by flush(), every few seconds from a
+    background thread and at exit, so writers never queue on the counter
+    rows. read() adds the deltas not written yet, so this process always
+    shows exact totals; other processes catch up on the next flush.
+    """
+
+    NAMES = ('telegram_users', 'agents', 'open_conversations', 'messages')
+    PENDING = 'stats_counters'
+
+    def __init__(self, app, db, StatCounter, User, TelegramUser, Conversation, Message):
+        self.app = app
+        self.db = db
+        self.StatCounter = StatCounter
+        self.User = User
+        self.TelegramUser = TelegramUser
+        self.Conversation = Conversation
+        self.Message = Message
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        # Keeps flush() from writing deltas a recompute() is counting in
+        self._writing = threading.Lock()
+        self._thread = None
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._after_rollback)
+        atexit.register(self.flush)
+
+    def _contribution(self, obj, status=None, is_agent=None):
+        """Counters a row adds to while it exists in the given state"""
+        if isinstance(obj, self.Message):
+            return {'messages': 1}
+        if isinstance(obj, self.TelegramUser):
+            return {'telegram_users': 1}
+        if isinstance(obj, self.Conversation):
+            status = obj.status if status is None else status
+            return {'open_conversations': 1} if status in OPEN_STATUSES else {}
+        if isinstance(obj, self.User):
+            is_agent = obj.is_agent if is_agent is None else is_agent
+            return {'agents': 1} if is_agent else {}
+        return {}
+
+    @staticmethod
+    def _previous(obj, attribute):
+        history = inspect(obj).attrs[attribute].history
+        if not history.has_changes() or not history.deleted:
+            return None
+        return history.deleted[0]
+
+    def _after_flush(self, session, flush_context):
+        deltas = Counter()
+        for obj in session.new:
+            deltas.update(self._contribution(obj))
+        for obj in session.deleted:
+            deltas.subtract(self._contribution(obj))
+
+        for obj in session.dirty:
+            if isinstance(obj, self.Conversation):
+                previous = self._previous(obj, 'status')
+                if previous is not None:
+                    deltas.subtract(self._contribution(obj, status=previous))
+                    deltas.update(self._contribution(obj))
+            elif isinstance(obj, self.User):
+                previous = self._previous(obj, 'is_agent')
+                if previous is not None:
+                    deltas.subtract(self._contribution(obj, is_agent=previous))
+                    deltas.update(self._contribution(obj))
+
+        for name, delta in deltas.items():
+            if delta:
+                self.add(name, delta, session=session)
+
+    def add(self, name, delta, session=None):
+        """Adjust a counter when the session commits, e.g. after a bulk insert that bypassed the ORM"""
+        session = session or self.db.session
+        session.info.setdefault(self.PENDING, Counter())[name] += delta
+
+    def _after_commit(self, session):
+        deltas = session.info.pop(self.PENDING, None)
+        if deltas:
+            with self._lock:
+                self._pending.update(deltas)
+
+    def _after_rollback(self, session):
+        session.info.pop(self.PENDING, None)
+
+    def flush(self):
+        """Write the committed deltas to the counters table; returns how many counters changed"""
+        with self._writing:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            deltas = {name: delta for name, delta in self._pending.items() if delta}
+            self._pending.clear()
+        if not deltas:
+            return 0
+
+        try:
+            with self.app.app_context(), self.db.engine.begin() as connection:
+                now = datetime.utcnow()
+                for name, delta in deltas.items():
+                    connection.execute(
+                        update(self.StatCounter)
+                        .where(self.StatCounter.name == name)
+                        .values(value=self.StatCounter.value + delta, updated_at=now)
+                    )
+        except Exception as e:
+            logger.error(f"Error writing admin statistics, keeping them for the next flush: {e}")
+            with self._lock:
+                self._pending.update(deltas)
+            return 0
+        return len(deltas)
+
+    def start(self, interval=2):
+        """Write the counters from a daemon thread every interval seconds"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name="crm-stats", daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval):
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def read(self):
+        """All counters from one scan of the small counters table, plus deltas this process hasn't written yet"""
+        rows = self.db.session.execute(select(self.StatCounter.name, self.StatCounter.value)).all()
+        totals = dict.fromkeys(self.NAMES, 0)
+        totals.update(rows)
+        with self._lock:
+            for name, delta in self._pending.items():
+                totals[name] = totals.get(name, 0) + delta
+        return totals
+
+    def is_initialized(self):
+        return self.db.session.query(self.StatCounter).count() == len(self.NAMES)
+
+    def recompute(self):
+        """Rebuild every counter from full COUNT queries"""
+        with self._writing:
+            return self._recompute()
+
+    def _recompute(self):
+        session = self.db.session
+        totals = {
+            'telegram_users': session.query(self.TelegramUser).count(),
+            'agents': session.query(self.User).filter_by(is_agent=True).count(),
+            'open_conversations': session.query(self.Conversation).filter(
+                self.Conversation.status.in_(OPEN_STATUSES)
+            ).count(),
+            'messages': session.query(self.Message).count()
+        }
+        # The counts include every delta committed so far; dropping them only now means
+        # one committed while counting can't be added on top of them again
+        with self._lock:
+            self._pending.clear()
+
+        now = datetime.utcnow()
+        for name, value in totals.items():
+            counter = session.get(self.StatCounter, name)
+            if counter is None:
+                session.add(self.StatCounter(name=name, value=value, updated_at=now))
+            else:
+                counter.value = value
+                counter.updated_at = now
+        session.commit()
+
+        logger.info(f"Recomputed admin statistics: {totals}")
+        return totals
@@ -0,0 +1,229 @@
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text, create_engine, event, insert, \
+    select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger("CRM STORAGE")
+
+# Connection settings applied to every SQLite connection in the production profile
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',      # readers no longer block the writer and vice versa
+    'synchronous': 'NORMAL',    # fsync at checkpoints instead of every commit; safe with WAL
+    'busy_timeout': 5000,       # wait up to 5s for the write lock instead of failing at once
+    'cache_size': -32000,       # 32 MB page cache per connection
+    'mmap_size': 268435456,     # read through a 256 MB memory map
+    'temp_store': 'MEMORY',
+}
+
+STORAGE_PROFILES = ('production', 'default')
+
+
+def is_sqlite(url):
+    return make_url(url).get_backend_name() == 'sqlite'
+
+
+def is_memory_sqlite(url):
+    database = make_url(url).database
+    return not database or database == ':memory:'
+
+
+def engine_options(url, threads, profile='production'):
+    """SQLAlchemy engine options sized for the number of threads that use the database"""
+    if profile != 'production':
+        return {}
+
+    if is_sqlite(url):
+        if is_memory_sqlite(url):
+            return {}
+        # One connection per thread; overflow covers bursts of dashboard requests
+        return {
+            'pool_size': threads,
+            'max_overflow': threads,
+            'pool_timeout': 30,
+            'connect_args': {'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000, 'check_same_thread': False},
+        }
+
+    return {
+        'pool_size': threads,
+        'max_overflow': threads * 2,
+        'pool_timeout': 30,
+        'pool_recycle': 1800,   # servers and proxies drop idle connections
+        'pool_pre_ping': True,
+    }
+
+
+def install_sqlite_pragmas(engine, pragmas=None):
+    """Apply the pragmas to every new connection of a SQLite engine"""
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    return set_pragmas
+
+
+def configure_storage(app, db, threads, profile='production'):
+    """Install the profile's connection settings on the app's engine"""
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    if profile != 'production' or not is_sqlite(url) or is_memory_sqlite(url):
+        return
+    with app.app_context():
+        install_sqlite_pragmas(db.engine)
+    logger.info(f"SQLite tuned for {threads} threads: {SQLITE_PRAGMAS}")
+
+
+def current_settings(engine):
+    """What the database reports for the tuned settings, plus pool usage"""
+    settings = {'dialect': engine.dialect.name, 'pool': engine.pool.status()}
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as connection:
+            for name in SQLITE_PRAGMAS:
+                settings[name] = connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+    return settings
+
+
+class StorageBenchmark:
+    """Mixed read/write load test modelled on the bot and dashboard traffic.
+
+    Writer threads insert a message and bump its conversation in one
+    transaction, like a bot handler; reader threads page through the newest
+    messages of a random conversation, like the chat view. The scratch
+    database is separate from the application's.
+    """
+
+    def __init__(self, writers=4, readers=4, seconds=10, conversations=200):
+        self.writers = writers
+        self.readers = readers
+        self.seconds = seconds
+        self.conversations = conversations
+
+        self.metadata = MetaData()
+        self.conversations_table = Table(
+            'bench_conversations', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('updated_at', DateTime),
+        )
+        self.messages_table = Table(
+            'bench_messages', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('conversation_id', Integer, index=True),
+            Column('sender_type', String(20)),
+            Column('content', Text),
+            Column('timestamp', DateTime, index=True),
+        )
+
+    def run(self, url, options=None, pragmas=None):
+        engine = create_engine(url, **(options or {}))
+        if pragmas:
+            install_sqlite_pragmas(engine, pragmas)
+
+        self.metadata.drop_all(engine)
+        self.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(insert(self.conversations_table),
+                               [{'id': i, 'updated_at': datetime.utcnow()} for i in range(1, self.conversations + 1)])
+
+        results = {'writes': [], 'reads': [], 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + self.seconds
+
+        def record(kind, elapsed):
+            with lock:
+                results[kind].append(elapsed)
+
+        def writer():
+            while time.monotonic() < deadline:
+                conversation_id = random.randint(1, self.conversations)
+                started = time.perf_counter()
+                try:
+                    with engine.begin() as connection:
+                        connection.execute(insert(self.messages_table).values(
+                            conversation_id=conversation_id, sender_type='user',
+                            content='benchmark message ' * 5, timestamp=datetime.utcnow()))
+                        connection.execute(update(self.conversations_table)
+                                           .where(self.conversations_table.c.id == conversation_id)
+                                           .values(updated_at=datetime.utcnow()))
+                    record('writes', time.perf_counter() - started)
+                except OperationalError:
+                    with lock:
+                        results['errors'] += 1
+
+        def reader():
+            messages = self.messages_table
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    with engine.connect() as connection:
+                        connection.execute(
+                            select(messages).where(messages.c.conversation_id == random.randint(1, self.conversations))
+                            .order_by(messages.c.timestamp.desc()).limit(50)
+                        ).all()
+                    record('reads', time.perf_counter() - started)
+                except OperationalError:
+                    with lock:
+                        results['errors'] += 1
+
+        threads = [threading.Thread(target=writer) for _ in range(self.writers)]
+        threads += [threading.Thread(target=reader) for _ in range(self.readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+
+        return {
+            'writes_per_second': round(len(results['writes']) / self.seconds, 1),
+            'reads_per_second': round(len(results['reads']) / self.seconds, 1),
+            'write_latency_ms': self.latency(results['writes']),
+            'read_latency_ms': self.latency(results['reads']),
+            'lock_errors': results['errors'],
+        }
+
+    @staticmethod
+    def latency(samples):
+        if not samples:
+            return None
+        samples = sorted(samples)
+        return {
+            'p50': round(samples[len(samples) // 2] * 1000, 2),
+            'p99': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2),
+            'max': round(samples[-1] * 1000, 2),
+        }
+
+    def compare(self, url=None, threads=None):
+        """Run the default and production profiles against the same scratch database"""
+        directory = None
+        if url is None:
+            directory = tempfile.mkdtemp(prefix='crm-storage-bench-')
+            url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        threads = threads or self.writers + self.readers
+
+        report = {'database': url if directory is None else 'temporary SQLite file'}
+        try:
+            for profile in STORAGE_PROFILES:
+                if is_sqlite(url):
+                    # The default profile runs the stock rollback journal
+                    pragmas = SQLITE_PRAGMAS if profile == 'production' else {'journal_mode': 'DELETE'}
+                else:
+                    pragmas = None
+                logger.info(f"Benchmarking the {profile} profile for {self.seconds}s")
+                report[profile] = self.run(url, engine_options(url, threads, profile), pragmas)
+        finally:
+            if directory is not None:
+                shutil.rmtree(directory, ignore_errors=True)
+        return report
@@ -0,0 +1,331 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+import zlib
+from array import array
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from CRMintents import tokenize
+
+try:
+    import numpy as np
+except ImportError:  # scoring falls back to an in-memory inverted index
+    np = None
+
+logger = logging.getLogger("CRM SUGGEST")
+
+# Hashed feature space; unigrams and bigrams of the user message
+FEATURES = 1 << 18
+
+
+def features(text):
+    """{feature: weight} of a text, L2-normalised log term frequencies"""
+    tokens = tokenize(text)
+    counts = defaultdict(int)
+    for token in tokens:
+        counts[zlib.crc32(token.encode()) % FEATURES] += 1
+    for first, second in zip(tokens, tokens[1:]):
+        counts[zlib.crc32(f"{first} {second}".encode()) % FEATURES] += 1
+    weights = {feature: 1 + math.log(count) for feature, count in counts.items()}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1
+    return {feature: weight / norm for feature, weight in weights.items()}
+
+
+class SuggestionIndex:
+    """On-disk index of (user message -> agent reply that followed) pairs for suggested replies.
+
+    Question vectors are hashed unigram/bigram features stored row by row
+    in append-only binary files (indptr, feature ids, weights) next to the
+    reply texts. update() appends only the pairs completed since the last
+    run and then publishes the new row count in meta.json, so a crash
+    mid-append leaves the published index intact. Readers memory-map the
+    files with NumPy and score every row in one vectorised pass, with
+    query-side IDF from the stored document frequencies. Without NumPy the
+    same files are loaded into an inverted index.
+    """
+
+    FILES = ('indptr.bin', 'features.bin', 'weights.bin', 'offsets.bin', 'replies.jsonl')
+
+    def __init__(self, app, db, Message, path, max_pending=10000):
+        self.app = app
+        self.db = db
+        self.Message = Message
+        self.path = path
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._thread = None
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def read_meta(self):
+        try:
+            with open(self._file('meta.json'), encoding='utf-8') as source:
+                return json.load(source)
+        except FileNotFoundError:
+            return {'rows': 0, 'nnz': 0, 'replies_bytes': 0, 'last_message_id': 0, 'pending': {}}
+
+    def _write_meta(self, meta):
+        temporary = self._file('meta.json.tmp')
+        with open(temporary, 'w', encoding='utf-8') as target:
+            json.dump(meta, target, ensure_ascii=False)
+        os.replace(temporary, self._file('meta.json'))
+
+    # -- writing
+
+    def _acquire_writer(self, stale_after=600):
+        """One writer across processes; a lock file older than stale_after seconds is taken over"""
+        lock_path = self._file('update.lock')
+        try:
+            if time.time() - os.path.getmtime(lock_path) > stale_after:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _truncate_to(self, meta):
+        """Drop anything appended after the published row count, e.g. by a crashed update"""
+        sizes = {
+            'indptr.bin': meta['rows'] * 8,
+            'features.bin': meta['nnz'] * 4,
+            'weights.bin': meta['nnz'] * 4,
+            'offsets.bin': meta['rows'] * 8,
+            'replies.jsonl': meta['replies_bytes'],
+        }
+        for name, size in sizes.items():
+            with open(self._file(name), 'ab') as target:
+                target.truncate(size)
+
+    def update(self, batch_size=5000, rebuild=False):
+        """Append the pairs completed since the last update; returns how many were added"""
+        if not self._acquire_writer():
+            return 0
+        try:
+            meta = {'rows': 0, 'nnz': 0, 'replies_bytes': 0, 'last_message_id': 0, 'pending': {}} \
+                if rebuild else self.read_meta()
+            self._truncate_to(meta)
+            df = array('I')
+            if meta['rows'] and os.path.exists(self._file('df.bin')):
+                with open(self._file('df.bin'), 'rb') as source:
+                    df.frombytes(source.read())
+            if len(df) != FEATURES:
+                df = array('I', bytes(4 * FEATURES))
+
+            added = 0
+            Message = self.Message
+            with self.app.app_context():
+                while True:
+                    rows = self.db.session.execute(
+                        select(Message.id, Message.conversation_id, Message.sender_type, Message.content)
+                        .where(Message.id > meta['last_message_id'])
+                        .order_by(Message.id)
+                        .limit(batch_size)
+                    ).all()
+                    self.db.session.rollback()
+                    if not rows:
+                        break
+                    added += self._append(rows, meta, df)
+                    meta['last_message_id'] = rows[-1].id
+
+                    with open(self._file('df.bin'), 'wb') as target:
+                        df.tofile(target)
+                    self._write_meta(meta)
+
+            if added:
+                logger.info(f"Added {added} reply pairs to the suggestion index ({meta['rows']} total)")
+            return added
+        finally:
+            os.remove(self._file('update.lock'))
+
+    def _append(self, rows, meta, df):
+        pending = meta['pending']
+        indptr, feature_ids, weights, offsets = array('q'), array('I'), array('f'), array('q')
+        replies = []
+        position = meta['replies_bytes']
+
+        for message_id, conversation_id, sender_type, content in rows:
+            key = str(conversation_id)
+            if sender_type == 'user':
+                pending.pop(key, None)
+                pending[key] = content
+                continue
+            if sender_type != 'agent' or key not in pending:
+                continue
+
+            question = pending.pop(key)
+            vector = features(question)
+            if not vector:
+                continue
+            for feature, weight in vector.items():
+                feature_ids.append(feature)
+                weights.append(weight)
+                df[feature] += 1
+            meta['nnz'] += len(vector)
+            meta['rows'] += 1
+            indptr.append(meta['nnz'])
+
+            line = (json.dumps({'reply': content, 'question': question, 'conversation_id': conversation_id,
+                                'message_id': message_id}, ensure_ascii=False) + '\n').encode()
+            offsets.append(position)
+            position += len(line)
+            replies.append(line)
+
+        # Questions that never got an answer are forgotten oldest first
+        while len(pending) > self.max_pending:
+            pending.pop(next(iter(pending)))
+
+        for name, values in (('indptr.bin', indptr), ('features.bin', feature_ids), ('weights.bin', weights),
+                             ('offsets.bin', offsets)):
+            with open(self._file(name), 'ab') as target:
+                values.tofile(target)
+        with open(self._file('replies.jsonl'), 'ab') as target:
+            target.writelines(replies)
+        meta['replies_bytes'] = position
+        return len(replies)
+
+    def start(self, interval=60):
+        """Keep the index up to date from a daemon thread"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name="crm-suggest-index", daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval):
+        while True:
+            try:
+                self.update()
+            except Exception as e:
+                logger.error(f"Error updating the suggestion index: {e}", exc_info=True)
+            time.sleep(interval)
+
+    # -- reading
+
+    def _load(self):
+        """The published rows, re-read when meta.json changes"""
+        try:
+            stamp = os.stat(self._file('meta.json')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        loaded = self._loaded
+        if loaded is not None and loaded['stamp'] == stamp:
+            return loaded
+
+        with self._lock:
+            if self._loaded is not None and self._loaded['stamp'] == stamp:
+                return self._loaded
+            meta = self.read_meta()
+            if not meta['rows']:
+                return None
+
+            df = array('I')
+            with open(self._file('df.bin'), 'rb') as source:
+                df.frombytes(source.read())
+            loaded = {'stamp': stamp, 'rows': meta['rows'], 'df': df}
+
+            if np is not None:
+                loaded['indptr'] = np.concatenate(([0], np.memmap(self._file('indptr.bin'), dtype=np.int64, mode='r',
+                                                                  shape=(meta['rows'],))))
+                loaded['features'] = np.memmap(self._file('features.bin'), dtype=np.uint32, mode='r',
+                                               shape=(meta['nnz'],))
+                loaded['weights'] = np.memmap(self._file('weights.bin'), dtype=np.float32, mode='r',
+                                              shape=(meta['nnz'],))
+            else:
+                loaded['postings'] = self._postings(meta)
+
+            self._loaded = loaded
+            return loaded
+
+    def _postings(self, meta):
+        indptr, feature_ids, weights = array('q'), array('I'), array('f')
+        for name, values, count in (('indptr.bin', indptr, meta['rows']), ('features.bin', feature_ids, meta['nnz']),
+                                    ('weights.bin', weights, meta['nnz'])):
+            with open(self._file(name), 'rb') as source:
+                values.fromfile(source, count)
+
+        postings = defaultdict(list)
+        start = 0
+        for row, end in enumerate(indptr):
+            for position in range(start, end):
+                postings[feature_ids[position]].append((row, weights[position]))
+            start = end
+        return postings
+
+    def _scores(self, loaded, query):
+        rows = loaded['rows']
+        if np is not None:
+            dense = np.zeros(FEATURES, dtype=np.float32)
+            dense[list(query)] = list(query.values())
+            contributions = dense[loaded['features']] * loaded['weights']
+            # Every stored row has at least one feature, so reduceat sees no empty segments
+            return np.add.reduceat(contributions, loaded['indptr'][:-1])
+
+        scores = defaultdict(float)
+        for feature, weight in query.items():
+            for row, row_weight in loaded['postings'].get(feature, ()):
+                scores[row] += weight * row_weight
+        return scores
+
+    def suggest(self, text, limit=3, min_score=0.2):
+        """Up to limit distinct past agent replies to questions like text, best first"""
+        loaded = self._load()
+        vector = features(text)
+        if loaded is None or not vector:
+            return []
+
+        # Rare features say more about the question than common ones; unseen ones say nothing
+        rows = loaded['rows']
+        df = loaded['df']
+        query = {
+            feature: weight * (math.log((rows + 1) / (df[feature] + 1)) + 1)
+            for feature, weight in vector.items() if df[feature]
+        }
+        if not query:
+            return []
+        norm = math.sqrt(sum(weight * weight for weight in query.values()))
+        query = {feature: weight / norm for feature, weight in query.items()}
+
+        scores = self._scores(loaded, query)
+        if np is not None:
+            candidates = min(rows, limit * 10)
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            ranked = sorted(((int(row), float(scores[row])) for row in top), key=lambda item: -item[1])
+        else:
+            ranked = sorted(scores.items(), key=lambda item: -item[1])[:limit * 10]
+
+        suggestions = []
+        seen = set()
+        with open(self._file('offsets.bin'), 'rb') as offsets, open(self._file('replies.jsonl'), 'rb') as replies:
+            for row, score in ranked:
+                if score < min_score or len(suggestions) >= limit:
+                    break
+                offsets.seek(row * 8)
+                replies.seek(array('q', offsets.read(8))[0])
+                entry = json.loads(replies.readline())
+                key = ' '.join(tokenize(entry['reply']))
+                if key in seen:
+                    continue
+                seen.add(key)
+                suggestions.append({'reply': entry['reply'], 'question': entry['question'],
+                                    'score': round(score, 3)})
+        return suggestions
+
+    def summary(self):
+        meta = self.read_meta()
+        return {
+            'path': self.path,
+            'pairs': meta['rows'],
+            'features': meta['nnz'],
+            'last_message_id': meta['last_message_id'],
+            'vectorised': np is not None
+        }
@@ -0,0 +1,59 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("CRM WORKERS")
+
+
+class KeyedWorkerPool:
+    """Bounded worker pool where tasks sharing a key run in submission order.
+
+    Each key is pinned to one worker, so updates from one Telegram user stay
+    in order while different users are handled in parallel. submit() blocks
+    when a worker's queue is full, which slows down the producer.
+    """
+
+    def __init__(self, num_workers=4, queue_size=100, name="crm-worker"):
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1")
+
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self.threads = []
+        for index, task_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(task_queue,), name=f"{name}-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args, block=True, timeout=None):
+        """Queue a task behind earlier tasks with the same key"""
+        task_queue = self.queues[hash(key) % len(self.queues)]
+        task_queue.put((func, args), block=block, timeout=timeout)
+
+    def pending(self):
+        """Number of tasks waiting across all workers"""
+        return sum(task_queue.qsize() for task_queue in self.queues)
+
+    def join(self):
+        """Wait until every queued task has been processed"""
+        for task_queue in self.queues:
+            task_queue.join()
+
+    def shutdown(self, wait=True):
+        for task_queue in self.queues:
+            task_queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _worker(self, task_queue):
+        while True:
+            item = task_queue.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                func(*args)
+            except Exception as e:
+                logger.error(f"Error in worker task: {e}", exc_info=True)
+            finally:
+                task_queue.task_done()
@@ -165,6 +165,8 @@ a = Analysis(
     binaries=[],
     datas=[
         ('crm_zefir_bot.py', '.'),
+        ('intents.json', '.'),
+        ('responses.json', '.'),
         ('.env', '.'),
     ],
     hiddenimports=[
@@ -56,6 +56,8 @@ RUN pyinstaller --onefile --console --name CRMTelegramBot ^
     --hidden-import=python_dotenv ^
     --hidden-import=sqlalchemy ^
     --add-data "crm_zefir_bot.py;." ^
+    --add-data "intents.json;." ^
+    --add-data "responses.json;." ^
     --add-data ".env;." ^
     windows_launcher.py
 
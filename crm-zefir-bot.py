@@ -1,16 +1,41 @@
-from flask import render_template_string, request, jsonify, redirect, url_for, render_template
+from flask import render_template_string, request, jsonify, redirect, url_for, render_template, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 import telebot
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import threading
 
 from CRMclassbot import CRMTelegramBot
+from CRMhub import LiveUpdateHub, serialize_message, serialize_conversation
+from CRMsender import OutboundSender, configure_http_pool
+from CRMbroadcast import BroadcastEngine
+from CRMpersistence import MessageWriter, WRITE_MODES
+from CRMcache import LRUCache
+from CRMsessions import MemorySessionStore, DatabaseSessionStore
+from CRMqueries import QueryCounter
+from CRMpagination import keyset_page
+from CRMstats import StatsCounters
+from CRMsearch import create_search_index
+from CRManalytics import ConversationAnalytics
+from CRMexport import ConversationExporter, EXPORT_FORMATS
+from CRMimport import HistoryImporter, IMPORT_FORMATS
+from CRMarchive import ConversationArchiver
+from CRMmigrations import Migration, MigrationRunner, add_column, create_index, run_sql, check_query_plans
+from CRMintents import IntentEngine, benchmark as intents_benchmark
+from CRMsuggest import SuggestionIndex
+from CRMresponses import ResponseCatalogue
+from CRMrouting import RoutingQueue, ROUTING_MODES
+from CRMresponders import AutoReplyService, IntentResponder, NearestReplyResponder, RESPONDERS
+from CRMstorage import StorageBenchmark, configure_storage, current_settings, engine_options
+import click
+import json
+from sqlalchemy.orm import joinedload
 import sys
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
 from flask_login import LoginManager
 import logging
+import hashlib
 import os
 
 cli = sys.modules['flask.cli']
@@ -29,18 +54,66 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///crm_bot.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# One pooled connection per thread that talks to the database: bot workers, request
+# threads and the background writers (message window, broadcasts, archiver)
+STORAGE_PROFILE = os.getenv('STORAGE_PROFILE', 'production')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE') or int(os.getenv('BOT_WORKERS', '4')) + 8 + 4)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'], DB_POOL_SIZE, STORAGE_PROFILE
+)
+
 # Initialize extensions
 db = SQLAlchemy(app)
+configure_storage(app, db, DB_POOL_SIZE, STORAGE_PROFILE)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Pages render with a fixed number of queries; more than this means an N+1 crept back in
+query_counter = QueryCounter(app, budgets={
+    'dashboard': 4,
+    'api_conversations': 3,
+    'admin_dashboard': 3,
+    'user_management': 6,
+    'user_conversations': 4,
+    'search_users': 4,
+    'search_messages': 3,
+    'debug_conversations': 3
+})
+
+# Live updates for open dashboards and chats
+live_hub = LiveUpdateHub()
+
 # Initialize Telegram bot
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not BOT_TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN not found in environment variables!")
     exit(1)
 
+# Optional webhook mode: Telegram pushes updates to /telegram/webhook instead of being polled
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+
+# Point the Bot API client at another server, e.g. a local fake endpoint in tests
+if os.getenv('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Set once the bot is started by main() or create_webhook_app()
+crm_bot = None
+
+# One long-lived client with pooled connections for agent replies
+configure_http_pool(int(os.getenv('TELEGRAM_POOL_SIZE', '10')))
+outbound_sender = OutboundSender(telebot.TeleBot(BOT_TOKEN, threaded=False))
+
+# Automatic replies; edits to the rules file are picked up without a restart
+intent_engine = IntentEngine(
+    path=os.getenv('INTENTS_PATH') or os.path.join(app.root_path, 'intents.json'),
+    reload_interval=float(os.getenv('INTENTS_RELOAD_INTERVAL', '2'))
+)
+
+# Conversation.telegram_user_id -> Telegram chat id; the mapping never changes
+telegram_id_cache = LRUCache(maxsize=int(os.getenv('USER_CACHE_SIZE', '10000')))
+
 
 def init_telegram_bot(app, db, TelegramUser, Conversation, Message):
     """Initialize the single Telegram bot"""
@@ -49,7 +122,41 @@ def init_telegram_bot(app, db, TelegramUser, Conversation, Message):
         logger.error("TELEGRAM_BOT_TOKEN not found in environment variables!")
         return None
 
-    return CRMTelegramBot(app, db, bot_token, TelegramUser, Conversation, Message)
+    write_mode = os.getenv('MESSAGE_WRITE_MODE', 'handler')
+    if write_mode not in WRITE_MODES:
+        logger.error(f"Unknown MESSAGE_WRITE_MODE '{write_mode}', expected one of {', '.join(WRITE_MODES)}")
+        return None
+
+    session_ttl = int(os.getenv('SESSION_TTL', '3600'))
+    session_max = int(os.getenv('SESSION_MAX', '10000'))
+    if os.getenv('SESSION_STORE', 'memory') == 'database':
+        session_store = DatabaseSessionStore(app, db, ContractSession, ttl=session_ttl, maxsize=session_max,
+                                             cache_ttl=int(os.getenv('SESSION_CACHE_TTL', '10')))
+    else:
+        session_store = MemorySessionStore(ttl=session_ttl, maxsize=session_max)
+
+    message_writer = None
+    if write_mode == 'window':
+        message_writer = MessageWriter(
+            app, db, Message, Conversation,
+            hub=live_hub,
+            flush_interval=int(os.getenv('MESSAGE_FLUSH_INTERVAL_MS', '200')) / 1000,
+            max_batch=int(os.getenv('MESSAGE_BATCH_SIZE', '200'))
+        )
+
+    return CRMTelegramBot(
+        app, db, bot_token, TelegramUser, Conversation, Message,
+        hub=live_hub,
+        workers=int(os.getenv('BOT_WORKERS', '4')),
+        queue_size=int(os.getenv('BOT_QUEUE_SIZE', '100')),
+        write_mode=write_mode,
+        message_writer=message_writer,
+        cache_size=int(os.getenv('USER_CACHE_SIZE', '10000')),
+        cache_ttl=int(os.getenv('USER_CACHE_TTL', '300')),
+        session_store=session_store,
+        auto_reply=auto_reply,
+        responses=response_catalogue
+    )
 
 
 
@@ -108,6 +215,14 @@ class Conversation(db.Model):
 
     messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
 
+    # Backs the newest-first keyset pagination of the dashboard
+    __table_args__ = (
+        db.Index('ix_conversations_updated_at_id', 'updated_at', 'id'),
+        db.Index('ix_conversations_status_updated_at_id', 'status', 'updated_at', 'id'),
+        # The bot's lookup of a user's open conversation, newest first
+        db.Index('ix_conversations_user_status_updated_at', 'telegram_user_id', 'status', 'updated_at'),
+    )
+
 
 class Message(db.Model):
     __tablename__ = 'messages'
@@ -120,9 +235,242 @@ class Message(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     is_ai_response = db.Column(db.Boolean, default=False)
     read_by_agent = db.Column(db.Boolean, default=False)
+    # Set for catalogue responses, whose text lives once per version in response_templates
+    template_id = db.Column(db.String(50), nullable=True)
+    template_version = db.Column(db.Integer, nullable=True)
+
+    @property
+    def text(self):
+        """The text shown to the user, resolving catalogue references"""
+        if self.template_id:
+            return response_catalogue.text(self.template_id, self.template_version)
+        return self.content
+
+    # Every history page is a range scan of one conversation in (timestamp, id) order
+    __table_args__ = (
+        db.Index('ix_messages_conversation_timestamp_id', 'conversation_id', 'timestamp', 'id'),
+        # Unread counts on the dashboard and marking a chat read
+        db.Index('ix_messages_conversation_read', 'conversation_id', 'read_by_agent'),
+    )
+
+
+class ResponseTemplate(db.Model):
+    __tablename__ = 'response_templates'
+    __table_args__ = (
+        db.UniqueConstraint('name', 'version', name='uq_response_templates_name_version'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    parse_mode = db.Column(db.String(20), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Broadcast(db.Model):
+    __tablename__ = 'broadcasts'
+    id = db.Column(db.Integer, primary_key=True)
+    text = db.Column(db.Text, nullable=False)
+    segment = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    total_recipients = db.Column(db.Integer, default=0, nullable=False)
+    sent_count = db.Column(db.Integer, default=0, nullable=False)
+    failed_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class BroadcastRecipient(db.Model):
+    __tablename__ = 'broadcast_recipients'
+    __table_args__ = (
+        db.Index('ix_broadcast_recipients_broadcast_status', 'broadcast_id', 'status', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    broadcast_id = db.Column(db.Integer, db.ForeignKey('broadcasts.id'), nullable=False)
+    telegram_user_id = db.Column(db.Integer, db.ForeignKey('telegram_users.id'), nullable=False)
+    chat_id = db.Column(db.BigInteger, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    error = db.Column(db.String(255), nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+class ContractSession(db.Model):
+    __tablename__ = 'contract_sessions'
+    telegram_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class StatCounter(db.Model):
+    __tablename__ = 'stat_counters'
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ConversationMetrics(db.Model):
+    __tablename__ = 'conversation_metrics'
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id', ondelete='CASCADE'), primary_key=True,
+                                autoincrement=False)
+    status = db.Column(db.String(20), nullable=True)
+    assigned_agent_id = db.Column(db.Integer, nullable=True, index=True)
+    first_agent_id = db.Column(db.Integer, nullable=True)
+    message_count = db.Column(db.Integer, default=0, nullable=False)
+    user_message_count = db.Column(db.Integer, default=0, nullable=False)
+    agent_message_count = db.Column(db.Integer, default=0, nullable=False)
+    ai_message_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=True)
+    closed_at = db.Column(db.DateTime, nullable=True)
+    first_user_message_at = db.Column(db.DateTime, nullable=True)
+    first_agent_response_at = db.Column(db.DateTime, nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+
+
+class AnalyticsDaily(db.Model):
+    __tablename__ = 'analytics_daily'
+    day = db.Column(db.Date, primary_key=True)
+    messages = db.Column(db.Integer, default=0, nullable=False)
+    user_messages = db.Column(db.Integer, default=0, nullable=False)
+    agent_messages = db.Column(db.Integer, default=0, nullable=False)
+
+
+class AnalyticsWatermark(db.Model):
+    __tablename__ = 'analytics_watermarks'
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+    last_run_at = db.Column(db.DateTime, nullable=True)
+
+class ImportJob(db.Model):
+    __tablename__ = 'import_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(500), unique=True, nullable=False)
+    status = db.Column(db.String(20), default='running', nullable=False)
+    rows_done = db.Column(db.Integer, default=0, nullable=False)
+    users_created = db.Column(db.Integer, default=0, nullable=False)
+    conversations_created = db.Column(db.Integer, default=0, nullable=False)
+    messages_created = db.Column(db.Integer, default=0, nullable=False)
+    errors = db.Column(db.Integer, default=0, nullable=False)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    conversation_keys = db.relationship('ImportConversationKey', cascade='all, delete-orphan', lazy=True)
+
+
+class ImportConversationKey(db.Model):
+    __tablename__ = 'import_conversation_keys'
+    job_id = db.Column(db.Integer, db.ForeignKey('import_jobs.id'), primary_key=True)
+    external_key = db.Column(db.String(200), primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
 
 # end models.py ------
 
+# create_all() only makes missing tables; indexes and columns added to existing tables go here
+SCHEMA_MIGRATIONS = [
+    Migration(
+        1, 'Keyset pagination indexes',
+        create_index('ix_conversations_updated_at_id', 'conversations', ['updated_at', 'id']),
+        create_index('ix_conversations_status_updated_at_id', 'conversations', ['status', 'updated_at', 'id']),
+        create_index('ix_messages_conversation_timestamp_id', 'messages', ['conversation_id', 'timestamp', 'id'])
+    ),
+    Migration(
+        2, 'Open conversation lookup index',
+        create_index('ix_conversations_user_status_updated_at', 'conversations',
+                     ['telegram_user_id', 'status', 'updated_at'])
+    ),
+    Migration(
+        3, 'Catalogue response references on messages',
+        add_column('messages', 'template_id', 'VARCHAR(50)'),
+        add_column('messages', 'template_version', 'INTEGER')
+    ),
+    Migration(
+        4, 'Metrics of archived conversations',
+        run_sql('delete conversation_metrics rows left by archived conversations',
+                'DELETE FROM conversation_metrics WHERE conversation_id NOT IN (SELECT id FROM conversations)')
+    ),
+    Migration(
+        5, 'Unread messages index',
+        create_index('ix_messages_conversation_read', 'messages', ['conversation_id', 'read_by_agent'])
+    ),
+]
+migrations = MigrationRunner(db, SCHEMA_MIGRATIONS)
+
+# Welcome, contract and pricing texts with their keyboards; edits are picked up without a restart
+RESPONSES_RELOAD_INTERVAL = float(os.getenv('RESPONSES_RELOAD_INTERVAL', '2'))
+response_catalogue = ResponseCatalogue(
+    app, db, ResponseTemplate,
+    path=os.getenv('RESPONSES_PATH') or os.path.join(app.root_path, 'responses.json')
+)
+
+# Past agent replies, offered to agents and sent by the nearest responder; updated in the background
+SUGGEST_INTERVAL = int(os.getenv('SUGGEST_INTERVAL', '60'))
+suggestion_index = SuggestionIndex(
+    app, db, Message,
+    path=os.getenv('SUGGEST_INDEX_PATH') or os.path.join(app.instance_path, 'suggestions')
+)
+
+# Automatic replies: the configured responders in order, then the intents' fallback reply
+auto_reply_responders = []
+for responder_name in os.getenv('AUTO_REPLY_RESPONDERS', 'intents,nearest').split(','):
+    responder_name = responder_name.strip()
+    if responder_name == 'intents':
+        auto_reply_responders.append(IntentResponder(intent_engine))
+    elif responder_name == 'nearest':
+        auto_reply_responders.append(NearestReplyResponder(
+            suggestion_index, min_similarity=float(os.getenv('NEAREST_REPLY_MIN_SIMILARITY', '0.5'))
+        ))
+    elif responder_name:
+        logger.error(f"Unknown auto-reply responder '{responder_name}', expected one of {', '.join(RESPONDERS)}")
+auto_reply = AutoReplyService(
+    auto_reply_responders,
+    fallback=lambda: intent_engine.rules.fallback,
+    timeout=int(os.getenv('AUTO_REPLY_TIMEOUT_MS', '300')) / 1000,
+    cache_size=int(os.getenv('AUTO_REPLY_CACHE_SIZE', '5000')),
+    cache_ttl=int(os.getenv('AUTO_REPLY_CACHE_TTL', '600')),
+    cache_version=intent_engine.version
+)
+
+stats_counters = StatsCounters(app, db, StatCounter, User, TelegramUser, Conversation, Message)
+STATS_FLUSH_INTERVAL = int(os.getenv('STATS_FLUSH_INTERVAL', '2'))
+analytics = ConversationAnalytics(app, db, Conversation, Message, ConversationMetrics, AnalyticsDaily,
+                                  AnalyticsWatermark)
+ANALYTICS_INTERVAL = int(os.getenv('ANALYTICS_INTERVAL', '300'))
+# Waiting conversations go to agents longest-wait first: 'queue' on "Take next", 'auto' to the least-loaded
+# active agent; 'open' shows every agent all unassigned conversations and the first to open one claims it
+ROUTING_MODE = os.getenv('ROUTING_MODE', 'queue')
+if ROUTING_MODE not in ROUTING_MODES:
+    logger.error(f"Unknown ROUTING_MODE '{ROUTING_MODE}', expected one of {', '.join(ROUTING_MODES)}")
+    ROUTING_MODE = 'queue'
+ROUTING_REFRESH = int(os.getenv('ROUTING_REFRESH', '30'))
+routing = RoutingQueue(
+    app, db, Conversation, Message,
+    hub=live_hub,
+    counters=stats_counters,
+    max_load=int(os.getenv('ROUTING_MAX_LOAD', '5')),
+    auto_assign=ROUTING_MODE == 'auto',
+    agent_timeout=int(os.getenv('ROUTING_AGENT_TIMEOUT', '300'))
+)
+
+exporter = ConversationExporter(db, TelegramUser, Conversation, Message, template_text=response_catalogue.text)
+
+# Conversations closed longer than ARCHIVE_AFTER_DAYS move to a compressed archive file
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+archiver = ConversationArchiver(
+    app, db, Conversation, Message,
+    path=os.getenv('ARCHIVE_PATH') or os.path.join(app.instance_path, 'crm_archive.db'),
+    retention_days=ARCHIVE_AFTER_DAYS,
+    interval=int(os.getenv('ARCHIVE_INTERVAL', '3600')),
+    dependent_tables=[(ImportConversationKey, ImportConversationKey.conversation_id),
+                      (ConversationMetrics, ConversationMetrics.conversation_id)],
+    after_batch=lambda counts: stats_counters.add('messages', -counts['messages'])
+)
+with app.app_context():
+    search_index = create_search_index(db, TelegramUser, Message, backend=os.getenv('SEARCH_BACKEND', 'auto'))
+# Rate-limited mass messaging through the shared outbound client
+broadcast_engine = BroadcastEngine(
+    app, db, TelegramUser, Conversation, Broadcast, BroadcastRecipient, outbound_sender,
+    global_rate=float(os.getenv('BROADCAST_RATE', '25'))
+)
+
 # HTML Templates
 ADMIN_DASHBOARD_HTML = '''
 {% extends "base.html" %}
@@ -158,6 +506,14 @@ ADMIN_DASHBOARD_HTML = '''
         <a href="{{ url_for('dashboard') }}" class="btn btn-secondary" style="text-align: center; padding: 1.5rem;">
             💬 Conversation Dashboard
         </a>
+        <a href="{{ url_for('admin_analytics') }}" class="btn btn-secondary" style="text-align: center; padding: 1.5rem;">
+            📈 Conversation Analytics
+        </a>
+        <form method="post" action="{{ url_for('recompute_stats') }}" style="margin: 0;">
+            <button type="submit" class="btn btn-secondary" style="width: 100%; padding: 1.5rem;">
+                🔄 Recompute Statistics
+            </button>
+        </form>
     </div>
 
     <!-- Recent Activity -->
@@ -203,7 +559,7 @@ USER_MANAGEMENT_HTML = '''
                     <h4>{{ user.username }}</h4>
                     <p><strong>Email:</strong> {{ user.email }}</p>
                     <p><strong>Registered:</strong> {{ user.created_at.strftime('%Y-%m-%d') }}</p>
-                    <p><strong>Assigned Conversations:</strong> {{ user.assigned_conversations|length }}</p>
+                    <p><strong>Assigned Conversations:</strong> {{ assigned_counts.get(user.id, 0) }}</p>
                 </div>
                 <div class="user-actions">
                     <button onclick="deleteUser({{ user.id }})" class="btn btn-danger">Delete</button>
@@ -223,7 +579,9 @@ USER_MANAGEMENT_HTML = '''
             <input type="text" id="searchInput" placeholder="Search by name or username..." onkeyup="searchUsers()">
         </div>
 
-        <div class="users-grid">
+        <div class="users-grid" id="searchResults" style="display: none;"></div>
+
+        <div class="users-grid" id="telegramUserCards">
             {% for user in telegram_users.items %}
             <div class="user-card">
                 <div class="user-info">
@@ -232,7 +590,7 @@ USER_MANAGEMENT_HTML = '''
                     <p><strong>Telegram ID:</strong> {{ user.telegram_id }}</p>
                     <p><strong>Language:</strong> {{ user.language_code }}</p>
                     <p><strong>Joined:</strong> {{ user.created_at.strftime('%Y-%m-%d %H:%M') }}</p>
-                    <p><strong>Conversations:</strong> {{ user.conversations|length }}</p>
+                    <p><strong>Conversations:</strong> {{ conversation_counts.get(user.id, 0) }}</p>
                 </div>
                 <div class="user-actions">
                     <a href="{{ url_for('user_conversations', user_id=user.id) }}" class="btn btn-secondary">View Conversations</a>
@@ -297,19 +655,53 @@ function openTab(tabName) {
     event.currentTarget.classList.add("active");
 }
 
+var searchTimer = null;
+
+function renderUserCard(user) {
+    var card = document.createElement('div');
+    card.className = 'user-card';
+    card.innerHTML = '<div class="user-info"><h4></h4>' +
+        '<p><strong>Username:</strong> <span class="username"></span></p>' +
+        '<p><strong>Telegram ID:</strong> <span class="telegram-id"></span></p>' +
+        '<p><strong>Conversations:</strong> <span class="conversations"></span></p></div>' +
+        '<div class="user-actions"><a class="btn btn-secondary">View Conversations</a></div>';
+    card.querySelector('h4').textContent = user.name;
+    card.querySelector('.username').textContent = '@' + (user.username || 'N/A');
+    card.querySelector('.telegram-id').textContent = user.telegram_id;
+    card.querySelector('.conversations').textContent = user.conversations_count;
+    card.querySelector('a').href = '{{ url_for("user_conversations", user_id=0) }}'.replace('/0/', '/' + user.id + '/');
+    return card;
+}
+
+// Search every user on the server, not just the cards on this page
 function searchUsers() {
-    var input = document.getElementById('searchInput');
-    var filter = input.value.toLowerCase();
-    var userCards = document.querySelectorAll('#telegram-users .user-card');
-
-    userCards.forEach(function(card) {
-        var text = card.textContent.toLowerCase();
-        if (text.includes(filter)) {
-            card.style.display = 'block';
-        } else {
-            card.style.display = 'none';
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(function() {
+        var query = document.getElementById('searchInput').value.trim();
+        var results = document.getElementById('searchResults');
+        var pageCards = document.getElementById('telegramUserCards');
+
+        if (!query) {
+            results.style.display = 'none';
+            pageCards.style.display = '';
+            return;
         }
-    });
+
+        fetch('{{ url_for("search_users") }}?q=' + encodeURIComponent(query))
+            .then(response => response.json())
+            .then(users => {
+                results.innerHTML = '';
+                users.forEach(function(user) {
+                    results.appendChild(renderUserCard(user));
+                });
+                if (!users.length) {
+                    results.textContent = 'No matching Telegram users.';
+                }
+                results.style.display = '';
+                pageCards.style.display = 'none';
+            })
+            .catch(error => console.error('Error searching users:', error));
+    }, 250);
 }
 
 function deleteUser(userId) {
@@ -375,7 +767,7 @@ USER_CONVERSATIONS_HTML = '''
             </div>
             <p><strong>Started:</strong> {{ conversation.created_at.strftime('%Y-%m-%d %H:%M') }}</p>
             <p><strong>Last Activity:</strong> {{ conversation.updated_at.strftime('%Y-%m-%d %H:%M') }}</p>
-            <p><strong>Messages:</strong> {{ conversation.messages|length }}</p>
+            <p><strong>Messages:</strong> {{ message_counts.get(conversation.id, 0) }}</p>
             {% if conversation.assigned_agent %}
             <p><strong>Assigned Agent:</strong> {{ conversation.assigned_agent.username }}</p>
             {% endif %}
@@ -387,6 +779,51 @@ USER_CONVERSATIONS_HTML = '''
         </div>
         {% endfor %}
     </div>
+
+    {% if archived_conversations %}
+    <h3 style="margin-top: 2rem;">Archived Conversations</h3>
+    <div class="conversations-list">
+        {% for conversation in archived_conversations %}
+        <div class="conversation-item">
+            <div class="conversation-header">
+                <h3>Conversation #{{ conversation.id }}</h3>
+                <span class="status-badge status-{{ conversation.status }}">archived</span>
+            </div>
+            <p><strong>Started:</strong> {{ conversation.created_at.strftime('%Y-%m-%d %H:%M') if conversation.created_at else '' }}</p>
+            <p><strong>Closed:</strong> {{ conversation.closed_at.strftime('%Y-%m-%d %H:%M') if conversation.closed_at else '' }}</p>
+            <p><strong>Messages:</strong> {{ conversation.message_count }}</p>
+            <a href="{{ url_for('archived_conversation', archive_id=conversation.archive_id) }}" class="btn btn-secondary">View Archive</a>
+        </div>
+        {% endfor %}
+    </div>
+    {% endif %}
+</div>
+{% endblock %}
+'''
+
+ARCHIVED_CONVERSATION_HTML = '''
+{% extends "base.html" %}
+{% block content %}
+<div class="chat-container">
+    <div class="chat-header">
+        <h2>Archived conversation #{{ conversation.id }}{% if conversation.title %}: {{ conversation.title }}{% endif %}</h2>
+        <div>
+            <span class="status-badge status-{{ conversation.status }}">{{ conversation.status }}</span>
+            <span style="margin-left: 10px;">Archived {{ conversation.archived_at.strftime('%Y-%m-%d') }}</span>
+            <a href="{{ url_for('user_conversations', user_id=conversation.telegram_user_id) }}" class="btn btn-secondary" style="margin-left: 10px;">← Back</a>
+        </div>
+    </div>
+
+    <div class="chat-messages">
+        {% for message in messages %}
+        <div class="message {{ message.sender_type }}">
+            <div class="message-content">
+                <div class="message-text">{{ message.content }}</div>
+                <div class="message-meta">{{ message.timestamp.strftime('%Y-%m-%d %H:%M') if message.timestamp else '' }}</div>
+            </div>
+        </div>
+        {% endfor %}
+    </div>
 </div>
 {% endblock %}
 '''
@@ -403,17 +840,49 @@ ERROR_HTML = '''
 '''
 
 
+def get_telegram_chat_id(telegram_user_id):
+    """Look up the Telegram chat id for a user row, caching the result"""
+    chat_id = telegram_id_cache.get(telegram_user_id)
+    if chat_id is None:
+        chat_id = db.session.query(TelegramUser.telegram_id).filter_by(id=telegram_user_id).scalar()
+        if chat_id is not None:
+            telegram_id_cache.set(telegram_user_id, chat_id)
+    return chat_id
+
+
+def count_by(column, ids=None):
+    """Row counts grouped by a foreign key column in one query, as {id: count}"""
+    query = db.session.query(column, db.func.count()).group_by(column)
+    if ids is not None:
+        if not ids:
+            return {}
+        query = query.filter(column.in_(ids))
+    return dict(query.all())
+
+
+def unread_query():
+    """User messages no agent has opened yet"""
+    return Message.query.filter(Message.read_by_agent == False, Message.sender_type == 'user')
+
+
+def unread_counts(conversation_ids):
+    """Unread user messages per conversation in one query, as {conversation_id: count}"""
+    if not conversation_ids:
+        return {}
+    return dict(
+        unread_query().filter(Message.conversation_id.in_(conversation_ids))
+        .with_entities(Message.conversation_id, db.func.count()).group_by(Message.conversation_id).all()
+    )
+
+
 # Telegram bot broadcast function
 def broadcast_to_user(telegram_user_id, message, is_agent=False):
-    """Send message to Telegram user with app context"""
+    """Queue a message to a Telegram user without waiting on the Bot API"""
     try:
-        with app.app_context():
-            tg_user = TelegramUser.query.get(telegram_user_id)
-            if tg_user:
-                prefix = "" # "👨‍💼 Agent: " if is_agent else ""
-                bot = telebot.TeleBot(BOT_TOKEN)
-                bot.send_message(tg_user.telegram_id, f"{prefix}{message}")
-                logger.info(f"Message sent to user {tg_user.telegram_id}")
+        chat_id = get_telegram_chat_id(telegram_user_id)
+        if chat_id:
+            prefix = "" # "👨‍💼 Agent: " if is_agent else ""
+            outbound_sender.enqueue(chat_id, f"{prefix}{message}")
     except Exception as e:
         logger.error(f"Error sending message to user {telegram_user_id}: {e}")
 
@@ -483,53 +952,181 @@ def logout():
     return redirect(url_for('login'))
 
 
+DASHBOARD_PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', '50'))
+
+
+def parse_date(value, end=False):
+    """A from/to filter value; as the end of a range, a date without a time includes that whole day"""
+    if not value:
+        return None
+    if end:
+        try:
+            return datetime.combine(date.fromisoformat(value), datetime.min.time()) + timedelta(days=1)
+        except ValueError:
+            pass
+    return datetime.fromisoformat(value)
+
+
+def parse_date_option(ctx, param, value):
+    try:
+        return parse_date(value, end=param.name == 'date_to')
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def dashboard_query(args):
+    """Conversations visible to the current user, narrowed by the dashboard filters"""
+    query = Conversation.query.options(joinedload(Conversation.telegram_user))
+
+    if current_user.is_agent and (ROUTING_MODE == 'open' or args.get('agent') == 'unassigned'):
+        query = query.filter(
+            (Conversation.assigned_agent_id == current_user.id) |
+            (Conversation.assigned_agent_id.is_(None))
+        )
+    else:
+        query = query.filter_by(assigned_agent_id=current_user.id)
+
+    if args.get('status'):
+        query = query.filter(Conversation.status == args['status'])
+
+    agent = args.get('agent')
+    if agent == 'unassigned':
+        query = query.filter(Conversation.assigned_agent_id.is_(None))
+    elif agent:
+        query = query.filter(Conversation.assigned_agent_id == int(agent))
+
+    date_from = parse_date(args.get('from'))
+    if date_from:
+        query = query.filter(Conversation.updated_at >= date_from)
+    date_to = parse_date(args.get('to'), end=True)
+    if date_to:
+        query = query.filter(Conversation.updated_at < date_to)
+
+    return query
+
+
+def dashboard_page(args):
+    """One page of the dashboard as (conversations, next_cursor)"""
+    per_page = min(args.get('per_page', DASHBOARD_PAGE_SIZE, type=int), 200)
+    return keyset_page(
+        dashboard_query(args), Conversation.updated_at, Conversation.id,
+        cursor=args.get('cursor'), limit=per_page
+    )
+
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
     try:
         logger.info(f"Dashboard accessed by user: {current_user.username}")
 
+        conversations, next_cursor = dashboard_page(request.args)
+        agents = User.query.filter_by(is_agent=True).order_by(User.username).all()
         if current_user.is_agent:
-            conversations = Conversation.query.filter(
-                (Conversation.assigned_agent_id == current_user.id) |
-                (Conversation.assigned_agent_id.is_(None))
-            ).order_by(Conversation.updated_at.desc()).all()
-        else:
-            conversations = Conversation.query.filter_by(
-                assigned_agent_id=current_user.id
-            ).order_by(Conversation.updated_at.desc()).all()
-
-        logger.info(f"Found {len(conversations)} conversations for user {current_user.username}")
-
-        return render_template("dashboard.html", conversations=conversations)
+            routing.touch(current_user.id)
+
+        logger.info(f"Showing {len(conversations)} conversations for user {current_user.username}")
+
+        filters = {key: request.args[key] for key in ('status', 'agent', 'from', 'to') if request.args.get(key)}
+        return render_template(
+            "dashboard.html",
+            conversations=conversations,
+            next_cursor=next_cursor,
+            filters=filters,
+            agents=agents,
+            unread=unread_counts([conv.id for conv in conversations]),
+            first_page='cursor' not in request.args,
+            routing_mode=ROUTING_MODE,
+            queue=routing.metrics() if current_user.is_agent else None
+        )
 
+    except ValueError as e:
+        return render_template_string(ERROR_HTML, error=f'Invalid filter: {str(e)}'), 400
     except Exception as e:
         logger.error(f"Error in dashboard: {str(e)}", exc_info=True)
         return render_template_string(ERROR_HTML, error=f'Error loading dashboard: {str(e)}')
 
 
+@app.route('/api/conversations')
+@login_required
+def api_conversations():
+    try:
+        conversations, next_cursor = dashboard_page(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    unread = unread_counts([conv.id for conv in conversations])
+    conversations_data = []
+    for conv in conversations:
+        data = serialize_conversation(conv)
+        data['created_at'] = conv.created_at.isoformat() if conv.created_at else None
+        data['unread'] = unread.get(conv.id, 0)
+        data['telegram_user'] = {
+            'first_name': conv.telegram_user.first_name,
+            'last_name': conv.telegram_user.last_name
+        }
+        conversations_data.append(data)
+
+    return jsonify({'conversations': conversations_data, 'next_cursor': next_cursor})
+
+
 @app.route('/admin')
 @login_required
 def admin_dashboard():
     if not current_user.is_agent:
         return render_template_string(ERROR_HTML, error='Access denied'), 403
 
-    total_users = TelegramUser.query.count()
-    total_agents = User.query.filter_by(is_agent=True).count()
-    open_conversations = Conversation.query.filter(Conversation.status.in_(['open', 'assigned'])).count()
-    total_messages = Message.query.count()
+    stats = stats_counters.read()
     recent_users = TelegramUser.query.order_by(TelegramUser.created_at.desc()).limit(6).all()
 
     return render_template_string(
         ADMIN_DASHBOARD_HTML,
-        total_users=total_users,
-        total_agents=total_agents,
-        open_conversations=open_conversations,
-        total_messages=total_messages,
+        total_users=stats['telegram_users'],
+        total_agents=stats['agents'],
+        open_conversations=stats['open_conversations'],
+        total_messages=stats['messages'],
         recent_users=recent_users
     )
 
 
+@app.route('/admin/recompute-stats', methods=['POST'])
+@login_required
+def recompute_stats():
+    if not current_user.is_agent:
+        return render_template_string(ERROR_HTML, error='Access denied'), 403
+
+    stats_counters.recompute()
+    return redirect(url_for('admin_dashboard'))
+
+
+@app.route('/admin/analytics')
+@login_required
+def admin_analytics():
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    return jsonify(analytics.report(days=request.args.get('days', 14, type=int)))
+
+
+@app.route('/admin/analytics/refresh', methods=['POST'])
+@login_required
+def refresh_analytics():
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    # Only messages added since the last refresh are read
+    return jsonify({'success': True, 'processed': analytics.refresh()})
+
+
+@app.cli.command('analytics')
+def analytics_command():
+    """Bring the conversation metrics up to date and print the report."""
+    init_db()
+    processed = analytics.refresh()
+    print(f"Processed {processed} new messages")
+    print(json.dumps(analytics.report(), indent=2))
+
+
 @app.route('/user-management')
 @login_required
 def user_management():
@@ -545,10 +1142,15 @@ def user_management():
         page=page, per_page=per_page, error_out=False
     )
 
+    assigned_counts = count_by(Conversation.assigned_agent_id, [agent.id for agent in agents])
+    conversation_counts = count_by(Conversation.telegram_user_id, [user.id for user in telegram_users.items])
+
     return render_template_string(
         USER_MANAGEMENT_HTML,
         agents=agents,
-        telegram_users=telegram_users
+        telegram_users=telegram_users,
+        assigned_counts=assigned_counts,
+        conversation_counts=conversation_counts
     )
 
 
@@ -559,17 +1161,48 @@ def user_conversations(user_id):
         return render_template_string(ERROR_HTML, error='Access denied'), 403
 
     telegram_user = TelegramUser.query.get_or_404(user_id)
-    conversations = Conversation.query.filter_by(
+    conversations = Conversation.query.options(joinedload(Conversation.assigned_agent)).filter_by(
         telegram_user_id=user_id
     ).order_by(Conversation.updated_at.desc()).all()
 
+    message_counts = count_by(Message.conversation_id, [conv.id for conv in conversations])
+
     return render_template_string(
         USER_CONVERSATIONS_HTML,
         telegram_user=telegram_user,
-        conversations=conversations
+        conversations=conversations,
+        message_counts=message_counts,
+        archived_conversations=archiver.conversations_for_user(user_id)
     )
 
 
+@app.route('/archive/<int:archive_id>')
+@login_required
+def archived_conversation(archive_id):
+    if not current_user.is_agent:
+        return render_template_string(ERROR_HTML, error='Access denied'), 403
+
+    archived = archiver.load(archive_id)
+    if archived is None:
+        return render_template_string(ERROR_HTML, error='Archived conversation not found'), 404
+
+    conversation, messages = archived
+    for message in messages:
+        if message.template_id:
+            message.content = response_catalogue.text(message.template_id, message.template_version)
+    return render_template_string(ARCHIVED_CONVERSATION_HTML, conversation=conversation, messages=messages)
+
+
+@app.cli.command('archive')
+@click.option('--days', type=int, default=None, help='Archive conversations closed more than this many days ago')
+def archive_command(days):
+    """Move long-closed conversations into the compressed archive."""
+    init_db()
+    archived = archiver.run_once(retention_days=days)
+    print(f"Archived {archived} conversations")
+    print(json.dumps(archiver.summary(), indent=2))
+
+
 @app.route('/add-agent', methods=['POST'])
 @login_required
 def add_agent():
@@ -610,6 +1243,8 @@ def delete_agent():
 
     db.session.delete(user)
     db.session.commit()
+    # Their conversations go back in the queue
+    routing.refresh()
 
     return jsonify({'success': True})
 
@@ -624,11 +1259,15 @@ def search_users():
     if not query:
         return jsonify([])
 
-    users = TelegramUser.query.filter(
-        (TelegramUser.first_name.ilike(f'%{query}%')) |
-        (TelegramUser.last_name.ilike(f'%{query}%')) |
-        (TelegramUser.username.ilike(f'%{query}%'))
-    ).limit(10).all()
+    page = max(request.args.get('page', 1, type=int), 1)
+    user_ids = search_index.search_users(query, limit=10, offset=(page - 1) * 10)
+    if not user_ids:
+        return jsonify([])
+
+    users_by_id = {user.id: user for user in TelegramUser.query.filter(TelegramUser.id.in_(user_ids))}
+    users = [users_by_id[user_id] for user_id in user_ids if user_id in users_by_id]
+
+    conversation_counts = count_by(Conversation.telegram_user_id, [user.id for user in users])
 
     users_data = []
     for user in users:
@@ -637,12 +1276,57 @@ def search_users():
             'name': f"{user.first_name} {user.last_name or ''}",
             'username': user.username,
             'telegram_id': user.telegram_id,
-            'conversations_count': len(user.conversations)
+            'conversations_count': conversation_counts.get(user.id, 0)
         })
 
     return jsonify(users_data)
 
 
+@app.route('/search-messages')
+@login_required
+def search_messages():
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(request.args.get('per_page', 20, type=int), 100)
+    if not query:
+        return jsonify({'results': [], 'page': page, 'has_more': False})
+
+    # One extra hit tells whether there is a next page
+    hits = search_index.search_messages(query, limit=per_page + 1, offset=(page - 1) * per_page)
+    has_more = len(hits) > per_page
+    hits = hits[:per_page]
+
+    messages = {}
+    if hits:
+        messages = {
+            msg.id: msg for msg in Message.query.options(
+                joinedload(Message.conversation).joinedload(Conversation.telegram_user)
+            ).filter(Message.id.in_([message_id for message_id, _ in hits]))
+        }
+
+    results = []
+    for message_id, snippet in hits:
+        msg = messages.get(message_id)
+        if not msg:
+            continue
+        results.append({
+            'message_id': msg.id,
+            'conversation_id': msg.conversation_id,
+            'sender_type': msg.sender_type,
+            'timestamp': msg.timestamp.isoformat(),
+            'snippet': snippet,
+            'telegram_user': {
+                'id': msg.conversation.telegram_user.id,
+                'name': f"{msg.conversation.telegram_user.first_name} {msg.conversation.telegram_user.last_name or ''}"
+            }
+        })
+
+    return jsonify({'results': results, 'page': page, 'has_more': has_more})
+
+
 @app.route('/conversation/<int:conversation_id>')
 @login_required
 def conversation(conversation_id):
@@ -651,13 +1335,77 @@ def conversation(conversation_id):
     if not current_user.is_agent and conv.assigned_agent_id != current_user.id:
         return render_template_string(ERROR_HTML, error='Access denied'), 403
 
+    # Opening an unassigned chat claims it; the conditional update lets only one agent win
     if current_user.is_agent and not conv.assigned_agent_id:
-        conv.assigned_agent_id = current_user.id
-        conv.status = 'assigned'
-        db.session.commit()
+        routing.claim(conv.id, current_user.id)
+
+    messages = message_page(conversation_id, limit=MESSAGE_PAGE_SIZE + 1)
+    has_older = len(messages) > MESSAGE_PAGE_SIZE
+    return render_template("chat.html", conversation=conv, messages=messages[-MESSAGE_PAGE_SIZE:],
+                           has_older=has_older, page_size=MESSAGE_PAGE_SIZE)
+
 
-    messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.timestamp).all()
-    return render_template("chat.html", conversation=conv, messages=messages)
+@app.route('/conversation/<int:conversation_id>/read', methods=['POST'])
+@login_required
+def mark_conversation_read(conversation_id):
+    """Mark the user's messages read; the chat page posts this, so opening a chat stays a plain read"""
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    marked = unread_query().filter(Message.conversation_id == conversation_id).update(
+        {'read_by_agent': True}, synchronize_session=False
+    )
+    db.session.commit()
+    return jsonify({'success': True, 'marked': marked})
+
+
+@app.route('/conversation/<int:conversation_id>/suggestions')
+@login_required
+def conversation_suggestions(conversation_id):
+    conv = Conversation.query.get_or_404(conversation_id)
+    if not current_user.is_agent and conv.assigned_agent_id != current_user.id:
+        return jsonify({'error': 'Access denied'}), 403
+
+    latest = Message.query.filter(
+        Message.conversation_id == conversation_id, Message.sender_type == 'user'
+    ).order_by(Message.timestamp.desc(), Message.id.desc()).first()
+    if latest is None:
+        return jsonify({'message_id': None, 'suggestions': []})
+
+    limit = min(request.args.get('limit', 3, type=int), 10)
+    return jsonify({'message_id': latest.id, 'suggestions': suggestion_index.suggest(latest.content, limit=limit)})
+
+
+@app.route('/routing/take-next', methods=['POST'])
+@login_required
+def take_next_conversation():
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    routing.touch(current_user.id)
+    conversation_id = routing.take_next(current_user.id)
+    if conversation_id is None:
+        if routing.load(current_user.id) >= routing.max_load:
+            error = f'You already have {routing.max_load} active conversations'
+        else:
+            error = 'No conversations waiting'
+        return jsonify({'success': False, 'error': error})
+
+    return jsonify({
+        'success': True,
+        'conversation_id': conversation_id,
+        'url': url_for('conversation', conversation_id=conversation_id)
+    })
+
+
+@app.route('/routing/metrics')
+@login_required
+def routing_metrics():
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+
+    routing.touch(current_user.id)
+    return jsonify(routing.metrics())
 
 
 @app.route('/send_message', methods=['POST'])
@@ -676,29 +1424,153 @@ def send_message():
     )
     db.session.add(message)
     conv.updated_at = datetime.utcnow()
+    db.session.flush()
+    message_data = serialize_message(message)
+    telegram_user_id = conv.telegram_user_id
+    assigned_agent_id = conv.assigned_agent_id
     db.session.commit()
 
-    broadcast_to_user(conv.telegram_user_id, content, is_agent=True)
+    live_hub.publish('message', {
+        'conversation_id': conversation_id,
+        'assigned_agent_id': assigned_agent_id,
+        'message': message_data
+    })
+    broadcast_to_user(telegram_user_id, content, is_agent=True)
+
+    return jsonify({'success': True, 'message': message_data})
 
-    return jsonify({'success': True})
+
+MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', '50'))
+
+
+def message_page(conversation_id, before_id=None, after_id=None, limit=MESSAGE_PAGE_SIZE):
+    """Up to limit messages of a conversation in (timestamp, id) order.
+
+    With after_id the page starts right after that message; otherwise it is
+    the newest limit messages, or the ones just before before_id.
+    """
+    query = Message.query.filter(Message.conversation_id == conversation_id)
+
+    if after_id is not None:
+        return query.filter(Message.id > after_id).order_by(Message.timestamp, Message.id).limit(limit).all()
+
+    if before_id is not None:
+        before_timestamp = db.session.query(Message.timestamp).filter(Message.id == before_id).scalar_subquery()
+        # The plain upper bound lets the database turn this into an index range scan
+        query = query.filter(
+            Message.timestamp <= before_timestamp,
+            (Message.timestamp < before_timestamp) | (Message.id < before_id)
+        )
+
+    messages = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    messages.reverse()
+    return messages
 
 
 @app.route('/get_messages/<int:conversation_id>')
 @login_required
 def get_messages(conversation_id):
-    messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.timestamp).all()
+    limit = min(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), 500)
+
+    # Scrolling back through history: the page of messages before a known one
+    before_id = request.args.get('before_id', type=int)
+    if before_id is not None:
+        messages = message_page(conversation_id, before_id=before_id, limit=limit)
+        return jsonify([serialize_message(msg) for msg in messages])
+
+    # Clients pass the id of the last message they have and only get newer ones back
+    after_id = request.args.get('after_id', 0, type=int)
+
+    # The newest message id is enough to tell whether anything changed
+    last_id = db.session.query(db.func.max(Message.id)).filter_by(conversation_id=conversation_id).scalar() or 0
+    etag = f"{conversation_id}-{after_id}-{last_id}-{limit}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
     messages_data = []
+    if last_id > after_id:
+        messages = message_page(conversation_id, after_id=after_id, limit=limit)
+        messages_data = [serialize_message(msg) for msg in messages]
+
+    response = jsonify(messages_data)
+    response.set_etag(etag)
+    return response
 
-    for msg in messages:
-        messages_data.append({
-            'id': msg.id,
-            'sender_type': msg.sender_type,
-            'content': msg.content,
-            'timestamp': msg.timestamp.isoformat(),
-            'is_ai_response': msg.is_ai_response
-        })
 
-    return jsonify(messages_data)
+@app.route('/broadcasts', methods=['POST'])
+@login_required
+def create_broadcast():
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    text = (request.json.get('text') or '').strip()
+    segment = request.json.get('segment') or {}
+    if not text:
+        return jsonify({'success': False, 'error': 'Text is required'}), 400
+
+    try:
+        broadcast_id = broadcast_engine.create(text, segment, created_by=current_user.id)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    broadcast_engine.start(broadcast_id)
+    return jsonify({'success': True, 'broadcast_id': broadcast_id})
+
+
+@app.route('/broadcasts/<int:broadcast_id>')
+@login_required
+def broadcast_status(broadcast_id):
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    broadcast = Broadcast.query.get_or_404(broadcast_id)
+    return jsonify(broadcast_engine.progress(broadcast))
+
+
+@app.route('/broadcasts/<int:broadcast_id>/cancel', methods=['POST'])
+@login_required
+def cancel_broadcast(broadcast_id):
+    if not current_user.is_agent:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    broadcast_engine.cancel(broadcast_id)
+    return jsonify({'success': True})
+
+
+@app.route('/stream')
+@login_required
+def stream():
+    """Server-sent events with new messages and conversation changes"""
+    conversation_id = request.args.get('conversation_id', type=int)
+    user_id = current_user.id
+    is_agent = current_user.is_agent
+
+    if conversation_id:
+        conv = Conversation.query.get_or_404(conversation_id)
+        if not is_agent and conv.assigned_agent_id != user_id:
+            return jsonify({'error': 'Access denied'}), 403
+
+    def accept(item):
+        data = item['data']
+        event_conversation_id = data.get('conversation_id', data.get('id'))
+        if conversation_id and event_conversation_id != conversation_id:
+            return False
+        if not is_agent and not conversation_id:
+            return data.get('assigned_agent_id') == user_id
+        return True
+
+    # Release the request's DB connection before holding the stream open
+    db.session.remove()
+
+    subscription = live_hub.subscribe()
+    return Response(
+        live_hub.stream(subscription, accept),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 @app.route('/ai_response', methods=['POST'])
@@ -720,6 +1592,23 @@ def ai_response():
     return jsonify({'success': True})
 
 
+@app.route('/telegram/webhook', methods=['POST'])
+def telegram_webhook():
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return jsonify({'error': 'Access denied'}), 403
+
+    if crm_bot is None:
+        return jsonify({'error': 'Bot is not running'}), 503
+
+    try:
+        crm_bot.process_update_json(request.get_data(as_text=True))
+    except Exception as e:
+        logger.error(f"Error processing webhook update: {e}")
+        return jsonify({'success': False, 'error': 'Invalid update'}), 400
+
+    return jsonify({'success': True})
+
+
 # Debug routes
 @app.route('/debug/conversations')
 @login_required
@@ -727,7 +1616,8 @@ def debug_conversations():
     if not current_user.is_agent:
         return jsonify({'error': 'Access denied'}), 403
 
-    conversations = Conversation.query.all()
+    conversations = Conversation.query.options(joinedload(Conversation.telegram_user)).all()
+    message_counts = count_by(Message.conversation_id)
     conversation_data = []
 
     for conv in conversations:
@@ -743,7 +1633,7 @@ def debug_conversations():
                 'first_name': conv.telegram_user.first_name if conv.telegram_user else None,
                 'last_name': conv.telegram_user.last_name if conv.telegram_user else None
             } if conv.telegram_user else None,
-            'message_count': len(conv.messages)
+            'message_count': message_counts.get(conv.id, 0)
         })
 
     return jsonify({
@@ -752,6 +1642,220 @@ def debug_conversations():
     })
 
 
+@app.route('/export/<kind>.<fmt>')
+@login_required
+def export(kind, fmt):
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+    if kind not in ('conversations', 'messages') or fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'Unknown export'}), 404
+
+    try:
+        filters = {
+            'status': request.args.get('status'),
+            'date_from': parse_date(request.args.get('from')),
+            'date_to': parse_date(request.args.get('to'), end=True)
+        }
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date: {e}'}), 400
+    if kind == 'messages':
+        filters['conversation_id'] = request.args.get('conversation_id', type=int)
+
+    logger.info(f"{current_user.username} exporting {kind} as {fmt}: {filters}")
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(
+        stream_with_context(exporter.export(kind, fmt, **filters)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={kind}.{fmt}'}
+    )
+
+
+@app.cli.command('export')
+@click.argument('kind', type=click.Choice(['conversations', 'messages']))
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='csv')
+@click.option('--status', default=None, help='Only conversations in this status')
+@click.option('--from', 'date_from', callback=parse_date_option, default=None,
+              help='Start of the date range (inclusive)')
+@click.option('--to', 'date_to', callback=parse_date_option, default=None,
+              help='End of the date range; a date alone includes that whole day')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-')
+def export_command(kind, fmt, status, date_from, date_to, output):
+    """Stream conversations or messages to a CSV or JSONL file."""
+    init_db()
+    for chunk in exporter.export(kind, fmt, status=status, date_from=date_from, date_to=date_to):
+        output.write(chunk)
+
+
+def record_imported_batch(counts, inserted):
+    """Core inserts bypass the ORM hooks that maintain the admin counters and the in-memory search index"""
+    stats_counters.add('telegram_users', counts['users'])
+    stats_counters.add('open_conversations', counts['open_conversations'])
+    stats_counters.add('messages', counts['messages'])
+    search_index.index_rows(messages=inserted['messages'], users=inserted['telegram_users'])
+
+
+@app.cli.command('import-history')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), default=None,
+              help='Input format; guessed from the file extension by default')
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--restart', is_flag=True,
+              help='Read the file from the beginning again, skipping records already imported')
+def import_history_command(path, fmt, batch_size, restart):
+    """Bulk-load legacy users, conversations and messages from JSONL or CSV."""
+    init_db()
+
+    importer = HistoryImporter(db, TelegramUser, Conversation, Message, ImportJob, ImportConversationKey,
+                               batch_size=batch_size, after_batch=record_imported_batch)
+    print(json.dumps(importer.run(path, fmt=fmt, restart=restart), indent=2))
+
+
+@app.cli.command('storage-bench')
+@click.option('--writers', default=4, show_default=True, help='Threads writing messages')
+@click.option('--readers', default=4, show_default=True, help='Threads reading conversations')
+@click.option('--seconds', default=10, show_default=True, help='Duration of each run')
+@click.option('--url', default=None, help='Scratch database; a temporary SQLite file by default')
+def storage_bench_command(writers, readers, seconds, url):
+    """Load-test the default and production storage profiles side by side."""
+    benchmark = StorageBenchmark(writers=writers, readers=readers, seconds=seconds)
+    print(json.dumps(benchmark.compare(url), indent=2))
+
+
+def hot_query_checks():
+    """The queries behind the busiest pages and bot handlers, with the index each should use"""
+    return [
+        ('open conversation of a user',
+         db.select(Conversation).where(Conversation.telegram_user_id == 1,
+                                       Conversation.status.in_(['open', 'assigned', 'contract_process']))
+         .order_by(Conversation.updated_at.desc()).limit(1),
+         'ix_conversations_user_status_updated_at'),
+        ('dashboard page',
+         db.select(Conversation).order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+         .limit(DASHBOARD_PAGE_SIZE + 1),
+         'ix_conversations_updated_at_id'),
+        ('dashboard page by status',
+         db.select(Conversation).where(Conversation.status == 'open')
+         .order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(DASHBOARD_PAGE_SIZE + 1),
+         'ix_conversations_status_updated_at_id'),
+        ('latest messages of a conversation',
+         db.select(Message).where(Message.conversation_id == 1)
+         .order_by(Message.timestamp.desc(), Message.id.desc()).limit(MESSAGE_PAGE_SIZE + 1),
+         'ix_messages_conversation_timestamp_id'),
+        ('unread messages per conversation',
+         unread_query().filter(Message.conversation_id.in_([1, 2, 3]))
+         .with_entities(Message.conversation_id, db.func.count()).group_by(Message.conversation_id).statement,
+         'ix_messages_conversation_read'),
+    ]
+
+
+@app.cli.command('intents-bench')
+@click.option('--sizes', default='10,100,1000,5000', show_default=True, help='Comma-separated phrase counts')
+@click.option('--messages', default=2000, show_default=True)
+def intents_bench_command(sizes, messages):
+    """Per-message intent matching cost as the rule set grows."""
+    results = intents_benchmark(sizes=[int(size) for size in sizes.split(',')], messages=messages)
+    print(f"{'phrases':>8} {'compiled µs':>12} {'substring µs':>13}")
+    for row in results:
+        print(f"{row['phrases']:>8} {row['compiled_us']:>12} {row['substring_us']:>13}")
+
+
+@app.cli.command('suggest-index')
+@click.option('--rebuild', is_flag=True, help='Index every reply again instead of only the new ones')
+def suggest_index_command(rebuild):
+    """Build or update the suggested-replies index from past conversations."""
+    init_db()
+    added = suggestion_index.update(rebuild=rebuild)
+    print(f"Added {added} reply pairs")
+    print(json.dumps(suggestion_index.summary(), indent=2))
+
+
+@app.cli.command('migrate')
+@click.option('--status', 'show_status', is_flag=True, help='List migrations and when they were applied')
+def migrate_command(show_status):
+    """Apply pending schema migrations to an existing database."""
+    init_db()
+    if show_status:
+        for migration in migrations.status():
+            print(f"{migration['version']:>4}  {migration['applied_at'] or 'pending':<26}  {migration['name']}")
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """EXPLAIN the hot queries and fail if one does not use its index."""
+    init_db()
+    with app.app_context():
+        report = check_query_plans(db, hot_query_checks())
+
+    for check in report:
+        print(f"{'ok' if check['uses_index'] else 'MISSING':<8} {check['query']} -> {check['index']}")
+        if not check['uses_index']:
+            for line in check['plan']:
+                print(f"         {line}")
+    if not all(check['uses_index'] for check in report):
+        sys.exit(1)
+
+
+@app.route('/debug/outbound')
+@login_required
+def debug_outbound():
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+
+    return jsonify({
+        'pending': outbound_sender.pending(),
+        'cached_chat_ids': len(telegram_id_cache),
+        **outbound_sender.stats
+    })
+
+
+@app.route('/debug/cache')
+@login_required
+def debug_cache():
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+
+    stats = {'chat_ids': telegram_id_cache.stats()}
+    if crm_bot:
+        stats.update(crm_bot.cache_stats())
+    return jsonify(stats)
+
+
+@app.route('/debug/auto-reply')
+@login_required
+def debug_auto_reply():
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+
+    return jsonify(auto_reply.info())
+
+
+@app.route('/debug/responses')
+@login_required
+def debug_responses():
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+
+    return jsonify(response_catalogue.summary())
+
+
+@app.route('/debug/storage')
+@login_required
+def debug_storage():
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+
+    return jsonify({'profile': STORAGE_PROFILE, 'pool_size': DB_POOL_SIZE, **current_settings(db.engine)})
+
+
+@app.route('/debug/archive')
+@login_required
+def debug_archive():
+    if not current_user.is_agent:
+        return jsonify({'error': 'Access denied'}), 403
+
+    return jsonify(archiver.summary())
+
+
 @app.route('/test/create-sample')
 def create_sample_data():
     try:
@@ -809,6 +1913,8 @@ def create_sample_data():
 def init_db():
     with app.app_context():
         db.create_all()
+        migrations.upgrade()
+        response_catalogue.sync()
         logger.info("✅ Database initialized!")
 
         admin_user = User.query.filter_by(username='admin').first()
@@ -823,6 +1929,12 @@ def init_db():
             db.session.commit()
             logger.info("✅ Default admin user created: admin / admin123")
 
+        search_index.setup()
+
+        # Counters are maintained incrementally; build them once for a new or upgraded database
+        if not stats_counters.is_initialized():
+            stats_counters.recompute()
+
 
 def get_public_ip_urllib():
     return requests.get('https://4.indent.me', verify=False)
@@ -832,6 +1944,52 @@ def run_flask():
     app.run(debug=False, port=2000, use_reloader=False)
 
 
+def start_services():
+    """Initialise the database and start the background work; shared by main() and create_webhook_app()"""
+    init_db()
+
+    # Pick up broadcasts interrupted by the last shutdown
+    broadcast_engine.resume()
+
+    if ARCHIVE_AFTER_DAYS > 0:
+        archiver.start()
+    if SUGGEST_INTERVAL > 0:
+        suggestion_index.start(SUGGEST_INTERVAL)
+    if ROUTING_REFRESH > 0:
+        routing.start(ROUTING_REFRESH)
+    if RESPONSES_RELOAD_INTERVAL > 0:
+        response_catalogue.start(RESPONSES_RELOAD_INTERVAL)
+    if ANALYTICS_INTERVAL > 0:
+        analytics.start(ANALYTICS_INTERVAL)
+    if STATS_FLUSH_INTERVAL > 0:
+        stats_counters.start(STATS_FLUSH_INTERVAL)
+
+
+def start_bot():
+    """Start the Telegram bot in webhook or long-polling mode"""
+    global crm_bot
+    crm_bot = init_telegram_bot(app, db, TelegramUser, Conversation, Message)
+    if not crm_bot:
+        return False
+
+    if WEBHOOK_URL:
+        crm_bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}/telegram/webhook", WEBHOOK_SECRET)
+    else:
+        bot_thread = threading.Thread(target=crm_bot.run, daemon=True)
+        bot_thread.start()
+    return True
+
+
+def create_webhook_app():
+    """Set up the app for a WSGI server; wsgi.py calls this for gunicorn "wsgi:app" """
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL must be set to serve the bot from a WSGI server")
+
+    start_services()
+    start_bot()
+    return app
+
+
 def main():
     print("""
        __    __   _____   _____    __  __    ____     ____    _______  __    __   
@@ -854,8 +2012,8 @@ def main():
     logging.getLogger('CRM CLASS BOT').disabled = True
     print("🚀 Starting CRM Bot System...")
 
-    # Initialize database
-    init_db()
+    # Initialize database and background work
+    start_services()
 
     # Start Flask in a separate thread
     flask_thread = threading.Thread(target=run_flask, daemon=True)
@@ -867,10 +2025,7 @@ def main():
 
     # Start the single bot
     logger.info("Starting CRM Telegram Bot...")
-    crm_bot = init_telegram_bot(app, db, TelegramUser, Conversation, Message)
-    if crm_bot:
-        bot_thread = threading.Thread(target=crm_bot.run, daemon=True)
-        bot_thread.start()
+    if start_bot():
         logger.info("✅ CRM Telegram Bot started successfully!")
     else:
         logger.error("❌ Failed to start CRM Telegram Bot")
@@ -885,6 +2040,8 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
+        if crm_bot and crm_bot.message_writer:
+            crm_bot.message_writer.flush()
 
 
 if __name__ == '__main__':
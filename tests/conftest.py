@@ -0,0 +1,126 @@
+import importlib.util
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_telegram_ids = count(7_000_000)
+
+
+class BotAPIStub(BaseHTTPRequestHandler):
+    """Answers every Bot API method with success and records (method, params) in server.calls"""
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1].split('?')[0]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else self.path.partition('?')[2]
+        self.server.calls.append((method, {key: values[0] for key, values in parse_qs(body).items()}))
+
+        result = True
+        if method == 'sendMessage':
+            result = {'message_id': len(self.server.calls), 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+        payload = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def bot_api():
+    """A local stand-in for the Telegram Bot API"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BotAPIStub)
+    server.calls = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(scope='session')
+def crm(tmp_path_factory, bot_api):
+    """The app module, set up against a scratch database; it configures itself once per process"""
+    data = tmp_path_factory.mktemp('crm')
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:test-token',
+        'TELEGRAM_API_URL': f"http://127.0.0.1:{bot_api.server_address[1]}/bot{{0}}/{{1}}",
+        'WEBHOOK_URL': 'https://crm.example.com',
+        'DATABASE_URL': f"sqlite:///{data / 'crm.db'}",
+        'ARCHIVE_PATH': str(data / 'archive.db'),
+        'SUGGEST_INDEX_PATH': str(data / 'suggestions'),
+        # No background threads; tests drive everything themselves
+        'ARCHIVE_AFTER_DAYS': '0',
+        'SUGGEST_INTERVAL': '0',
+        'ROUTING_REFRESH': '0',
+        'RESPONSES_RELOAD_INTERVAL': '0',
+        'ANALYTICS_INTERVAL': '0',
+    })
+    sys.path.insert(0, ROOT)
+    # Same module name as wsgi.py uses, so importing wsgi reuses this module
+    spec = importlib.util.spec_from_file_location('crm_zefir_bot', os.path.join(ROOT, 'crm-zefir-bot.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    module.init_db()
+    return module
+
+
+@pytest.fixture
+def agent(crm):
+    """A fresh agent account, so each test sees only the conversations it creates"""
+    with crm.app.app_context():
+        name = f"agent{next(_telegram_ids)}"
+        user = crm.User(username=name, email=f"{name}@example.com", is_agent=True)
+        user.set_password('secret')
+        crm.db.session.add(user)
+        crm.db.session.commit()
+        return user.id, user.username
+
+
+@pytest.fixture
+def agent_client(crm, agent):
+    client = crm.app.test_client()
+    response = client.post('/login', data={'username': agent[1], 'password': 'secret'})
+    assert response.status_code == 302
+    return client
+
+
+def add_conversations(crm, agent_id, conversations, messages_each):
+    """Conversations assigned to agent_id with alternating user/agent messages; returns their ids"""
+    ids = []
+    now = datetime.utcnow()
+    with crm.app.app_context():
+        session = crm.db.session
+        for _ in range(conversations):
+            telegram_id = next(_telegram_ids)
+            user = crm.TelegramUser(telegram_id=telegram_id, username=f"user{telegram_id}",
+                                    first_name='Test', last_name=str(telegram_id))
+            session.add(user)
+            session.flush()
+            conversation = crm.Conversation(telegram_user_id=user.id, title=f"Chat {telegram_id}",
+                                            status='assigned', assigned_agent_id=agent_id,
+                                            created_at=now, updated_at=now)
+            session.add(conversation)
+            session.flush()
+            for i in range(messages_each):
+                sender = 'user' if i % 2 == 0 else 'agent'
+                session.add(crm.Message(conversation_id=conversation.id, sender_type=sender,
+                                        sender_id=user.id if sender == 'user' else agent_id,
+                                        content=f"message {i} in {telegram_id}",
+                                        timestamp=now - timedelta(minutes=messages_each - i)))
+            ids.append(conversation.id)
+        session.commit()
+    return ids
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert
+
+from CRMarchive import ConversationArchiver
+from conftest import add_conversations
+
+
+def test_a_message_added_while_archiving_is_kept(crm, agent, tmp_path):
+    conversation_id = add_conversations(crm, agent[0], 1, 4)[0]
+    with crm.app.app_context():
+        conversation = crm.db.session.get(crm.Conversation, conversation_id)
+        conversation.status = 'completed'
+        conversation.closed_at = datetime.utcnow() - timedelta(days=400)
+        telegram_user_id = conversation.telegram_user_id
+        crm.db.session.commit()
+        engine = crm.db.engine
+
+    late = []
+
+    def add_message_before_the_delete(conn, cursor, statement, parameters, context, executemany):
+        # The bot saves a message just as the archiver starts deleting
+        if not late and statement.startswith('DELETE FROM messages'):
+            late.append(True)
+            with engine.begin() as connection:
+                connection.execute(insert(crm.Message).values(
+                    conversation_id=conversation_id, sender_type='user', content='one more thing',
+                    timestamp=datetime.utcnow(), is_ai_response=False, read_by_agent=False))
+
+    archiver = ConversationArchiver(crm.app, crm.db, crm.Conversation, crm.Message, str(tmp_path / 'archive.db'),
+                                    retention_days=365,
+                                    dependent_tables=[(crm.ConversationMetrics, crm.ConversationMetrics.conversation_id)])
+    event.listen(engine, 'before_cursor_execute', add_message_before_the_delete)
+    try:
+        archiver.run_once()
+    finally:
+        event.remove(engine, 'before_cursor_execute', add_message_before_the_delete)
+
+    with crm.app.app_context():
+        assert crm.db.session.get(crm.Conversation, conversation_id) is not None
+        assert crm.Message.query.filter_by(conversation_id=conversation_id).count() == 5
+
+    # The next run archives it together with the late message
+    archiver.run_once()
+    with crm.app.app_context():
+        assert crm.db.session.get(crm.Conversation, conversation_id) is None
+        assert crm.Message.query.filter_by(conversation_id=conversation_id).count() == 0
+    assert [row['message_count'] for row in archiver.conversations_for_user(telegram_user_id)] == [5]
@@ -0,0 +1,74 @@
+import pytest
+from sqlalchemy import func, insert, select
+
+import CRMbroadcast
+from CRMbroadcast import BroadcastEngine
+
+
+class RecordingSender:
+    """Counts the recipients already marked sent each time a message goes out"""
+
+    def __init__(self, crm):
+        self.crm = crm
+        with crm.app.app_context():
+            self.engine = crm.db.engine
+        self.broadcast_id = None
+        self.persisted = []
+
+    def send_now(self, chat_id, text):
+        Recipient = self.crm.BroadcastRecipient
+        with self.engine.connect() as connection:
+            self.persisted.append(connection.execute(
+                select(func.count()).select_from(Recipient)
+                .where(Recipient.broadcast_id == self.broadcast_id, Recipient.status == 'sent')
+            ).scalar())
+
+
+def add_audience(crm, language_code, first_telegram_id, size):
+    with crm.app.app_context():
+        for i in range(size):
+            crm.db.session.add(crm.TelegramUser(telegram_id=first_telegram_id + i, first_name='Broadcast',
+                                                language_code=language_code))
+        crm.db.session.commit()
+
+
+def test_statuses_are_written_while_the_chunk_is_still_sending(crm):
+    add_audience(crm, 'xb', 9_100_000, 30)
+
+    sender = RecordingSender(crm)
+    engine = BroadcastEngine(crm.app, crm.db, crm.TelegramUser, crm.Conversation, crm.Broadcast,
+                             crm.BroadcastRecipient, sender, global_rate=1000, per_chat_interval=0,
+                             workers=1, flush_size=5)
+    with crm.app.app_context():
+        sender.broadcast_id = engine.create('Hello', {'language_code': 'xb'})
+    engine.run(sender.broadcast_id)
+
+    # One 500-row chunk; the last sends already see most of the earlier ones recorded
+    assert len(sender.persisted) == 30
+    assert sender.persisted[-1] >= 20
+
+    with crm.app.app_context():
+        broadcast = crm.db.session.get(crm.Broadcast, sender.broadcast_id)
+        assert (broadcast.status, broadcast.sent_count, broadcast.failed_count) == ('completed', 30, 0)
+
+
+def test_a_broadcast_is_not_saved_without_its_whole_audience(crm, monkeypatch):
+    add_audience(crm, 'xc', 9_200_000, 30)
+    inserts = []
+
+    def insert_failing_on_the_second_chunk(table):
+        inserts.append(table)
+        if len(inserts) == 2:
+            raise RuntimeError('connection lost')
+        return insert(table)
+
+    monkeypatch.setattr(CRMbroadcast, 'insert', insert_failing_on_the_second_chunk)
+    engine = BroadcastEngine(crm.app, crm.db, crm.TelegramUser, crm.Conversation, crm.Broadcast,
+                             crm.BroadcastRecipient, RecordingSender(crm), chunk_size=10)
+    with crm.app.app_context():
+        with pytest.raises(RuntimeError):
+            engine.create('Partial audience', {'language_code': 'xc'})
+        crm.db.session.rollback()
+
+    with crm.app.app_context():
+        assert crm.Broadcast.query.filter_by(text='Partial audience').count() == 0
@@ -0,0 +1,30 @@
+import json
+from datetime import datetime
+
+from conftest import add_conversations
+
+
+def test_parse_date_includes_the_whole_end_day(crm):
+    assert crm.parse_date('2024-03-05') == datetime(2024, 3, 5)
+    assert crm.parse_date('2024-03-05', end=True) == datetime(2024, 3, 6)
+    assert crm.parse_date('2024-03-05T12:30', end=True) == datetime(2024, 3, 5, 12, 30)
+    assert crm.parse_date('', end=True) is None
+
+
+def test_to_date_includes_conversations_and_messages_from_that_day(crm, agent, agent_client):
+    conversation_id = add_conversations(crm, agent[0], 1, 2)[0]
+    midday = datetime(2024, 3, 5, 12, 0)
+    with crm.app.app_context():
+        crm.db.session.get(crm.Conversation, conversation_id).updated_at = midday
+        crm.Message.query.filter_by(conversation_id=conversation_id).update({'timestamp': midday})
+        crm.db.session.commit()
+
+    listed = agent_client.get('/api/conversations?from=2024-03-05&to=2024-03-05').get_json()['conversations']
+    assert [conversation['id'] for conversation in listed] == [conversation_id]
+
+    exported = agent_client.get(f'/export/messages.jsonl?from=2024-03-05&to=2024-03-05'
+                                f'&conversation_id={conversation_id}').get_data(as_text=True)
+    assert len([json.loads(line) for line in exported.splitlines()]) == 2
+
+    listed = agent_client.get('/api/conversations?from=2024-03-05&to=2024-03-05T12:00').get_json()['conversations']
+    assert listed == []
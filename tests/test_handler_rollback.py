@@ -0,0 +1,35 @@
+import json
+
+TELEGRAM_ID = 5550099
+
+
+def failing_message(**row):
+    raise RuntimeError('database is locked')
+
+
+def test_a_failed_save_drops_the_handlers_cache_updates_and_publishes(crm, bot_api, monkeypatch):
+    import wsgi
+
+    bot = wsgi.load_module().crm_bot
+    monkeypatch.setattr(bot, 'Message', failing_message)
+    events = crm.live_hub.subscribe()
+    calls = len(bot_api.calls)
+    try:
+        bot.process_update_json(json.dumps({
+            'update_id': 817000001,
+            'message': {
+                'message_id': 1, 'date': 1760000000, 'text': 'Hello, is anyone there?',
+                'chat': {'id': TELEGRAM_ID, 'type': 'private', 'first_name': 'Pavel'},
+                'from': {'id': TELEGRAM_ID, 'is_bot': False, 'first_name': 'Pavel'}
+            }
+        }))
+        bot.worker_pool.join()
+    finally:
+        crm.live_hub.unsubscribe(events)
+
+    # The new user and conversation were rolled back, and nothing points at them
+    assert bot.user_cache.get(TELEGRAM_ID) is None
+    assert events.empty()
+    assert [method for method, params in bot_api.calls[calls:] if method == 'sendMessage'] == []
+    with crm.app.app_context():
+        assert crm.TelegramUser.query.filter_by(telegram_id=TELEGRAM_ID).first() is None
@@ -0,0 +1,31 @@
+import json
+
+from CRMimport import HistoryImporter
+from CRMsearch import MemorySearchIndex
+
+
+def test_imported_rows_reach_the_counters_and_the_memory_index(crm, tmp_path, monkeypatch):
+    source = tmp_path / 'history.jsonl'
+    source.write_text(''.join(json.dumps({
+        'telegram_id': 7_300_000 + i, 'first_name': 'Zinaida', 'last_name': f'Imported{i}',
+        'content': f'legacy quokkaberry order {i}', 'status': 'open', 'timestamp': 1700000000 + i
+    }) + '\n' for i in range(5)))
+
+    with crm.app.app_context():
+        # Built before the import, the way a running process would have it
+        memory_index = MemorySearchIndex(crm.db, crm.TelegramUser, crm.Message)
+        memory_index.setup()
+        monkeypatch.setattr(crm, 'search_index', memory_index)
+        before = crm.stats_counters.read()
+
+        importer = HistoryImporter(crm.db, crm.TelegramUser, crm.Conversation, crm.Message, crm.ImportJob,
+                                   crm.ImportConversationKey, batch_size=2, after_batch=crm.record_imported_batch)
+        importer.run(str(source))
+
+        after = crm.stats_counters.read()
+        assert after['telegram_users'] - before['telegram_users'] == 5
+        assert after['messages'] - before['messages'] == 5
+        assert after['open_conversations'] - before['open_conversations'] == 5
+
+        assert len(memory_index.search_messages('quokkaberry')) == 5
+        assert len(memory_index.search_users('Zinaida')) == 5
@@ -0,0 +1,49 @@
+from conftest import add_conversations
+
+N = 5
+
+
+def pages(crm, conversation_id):
+    """Every page with a query budget, plus the chat, keyed by endpoint"""
+    with crm.app.app_context():
+        telegram_user_id = crm.db.session.get(crm.Conversation, conversation_id).telegram_user_id
+    return {
+        'dashboard': '/dashboard',
+        'api_conversations': '/api/conversations',
+        'admin_dashboard': '/admin',
+        'user_management': '/user-management',
+        'user_conversations': f'/user/{telegram_user_id}/conversations',
+        'search_users': '/search-users?q=Test',
+        'search_messages': '/search-messages?q=message',
+        'debug_conversations': '/debug/conversations',
+        'chat': f'/conversation/{conversation_id}',
+    }
+
+
+def query_counts(crm, client, conversation_id):
+    counts = {}
+    for page, url in pages(crm, conversation_id).items():
+        response = client.get(url)
+        assert response.status_code == 200, url
+        counts[page] = int(response.headers['X-Query-Count'])
+    return counts
+
+
+def test_pages_run_the_same_queries_for_n_and_10n_rows(crm, agent, agent_client):
+    agent_id = agent[0]
+    small = add_conversations(crm, agent_id, N, N)
+    with_n = query_counts(crm, agent_client, small[0])
+
+    large = add_conversations(crm, agent_id, 9 * N, 10 * N)
+    with_10n = query_counts(crm, agent_client, large[0])
+
+    assert with_10n == with_n
+
+
+def test_pages_stay_within_their_budgets(crm, agent, agent_client):
+    chat_id = add_conversations(crm, agent[0], N, N)[0]
+    counts = query_counts(crm, agent_client, chat_id)
+
+    assert set(crm.query_counter.budgets) <= set(counts), 'a budgeted page is not measured'
+    for page, budget in crm.query_counter.budgets.items():
+        assert counts[page] <= budget, page
@@ -0,0 +1,16 @@
+from CRMmigrations import check_query_plans
+
+
+def test_hot_queries_use_their_indexes(crm):
+    with crm.app.app_context():
+        report = check_query_plans(crm.db, crm.hot_query_checks())
+
+    assert report
+    missing = {check['query']: check['plan'] for check in report if not check['uses_index']}
+    assert missing == {}
+
+
+def test_migrations_are_all_applied(crm):
+    with crm.app.app_context():
+        assert [migration['applied_at'] is not None for migration in crm.migrations.status()] == \
+            [True] * len(crm.SCHEMA_MIGRATIONS)
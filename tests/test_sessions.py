@@ -0,0 +1,62 @@
+import json
+
+from CRMsessions import DatabaseSessionStore
+from conftest import add_conversations
+
+TELEGRAM_ID = 5550077
+
+
+def text_update(update_id, text):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 1760000000, 'text': text,
+            'chat': {'id': TELEGRAM_ID, 'type': 'private', 'first_name': 'Olga'},
+            'from': {'id': TELEGRAM_ID, 'is_bot': False, 'first_name': 'Olga'}
+        }
+    })
+
+
+def test_contract_messages_are_served_from_the_session_cache(crm, agent):
+    import wsgi
+
+    bot = wsgi.load_module().crm_bot
+    store = DatabaseSessionStore(crm.app, crm.db, crm.ContractSession)
+    conversation_id = add_conversations(crm, agent[0], 1, 0)[0]
+    store[TELEGRAM_ID] = {'conversation_id': conversation_id, 'step': 'waiting_full_name',
+                          'full_name': None, 'passport': None}
+
+    memory_store, bot.user_sessions = bot.user_sessions, store
+    try:
+        # One-word names are rejected, so the session is read on every message and never changes
+        for update_id in range(10):
+            bot.process_update_json(text_update(816000000 + update_id, 'Olga'))
+        bot.worker_pool.join()
+        assert store.db_reads == 0
+
+        # The last step's save reaches the cache on commit; the next messages still don't read the table
+        bot.process_update_json(text_update(816000100, 'Olga Petrova'))
+        bot.process_update_json(text_update(816000101, '12 34'))
+        bot.worker_pool.join()
+        assert store.db_reads == 0
+        assert store[TELEGRAM_ID]['step'] == 'waiting_passport'
+    finally:
+        bot.user_sessions = memory_store
+
+    # Another worker reads the row once, then answers from its own cache
+    other = DatabaseSessionStore(crm.app, crm.db, crm.ContractSession)
+    assert [other.get(TELEGRAM_ID)['full_name'] for _ in range(5)] == ['Olga Petrova'] * 5
+    assert other.db_reads == 1
+
+
+def test_a_rolled_back_save_is_not_cached(crm):
+    store = DatabaseSessionStore(crm.app, crm.db, crm.ContractSession)
+    store[TELEGRAM_ID + 1] = {'step': 'waiting_full_name'}
+
+    with crm.app.app_context():
+        store[TELEGRAM_ID + 1] = {'step': 'waiting_passport'}
+        assert store[TELEGRAM_ID + 1] == {'step': 'waiting_passport'}
+        crm.db.session.rollback()
+
+    assert store[TELEGRAM_ID + 1] == {'step': 'waiting_full_name'}
+    assert store.db_reads == 2
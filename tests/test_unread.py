@@ -0,0 +1,18 @@
+from conftest import add_conversations
+
+
+def unread(client, conversation_id):
+    conversations = client.get('/api/conversations').get_json()['conversations']
+    return {conversation['id']: conversation['unread'] for conversation in conversations}[conversation_id]
+
+
+def test_opening_a_chat_leaves_marking_read_to_the_post(crm, agent_client, agent):
+    conversation_id = add_conversations(crm, agent[0], 1, 4)[0]
+    assert unread(agent_client, conversation_id) == 2
+
+    assert agent_client.get(f'/conversation/{conversation_id}').status_code == 200
+    assert unread(agent_client, conversation_id) == 2
+
+    response = agent_client.post(f'/conversation/{conversation_id}/read')
+    assert response.get_json() == {'success': True, 'marked': 2}
+    assert unread(agent_client, conversation_id) == 0
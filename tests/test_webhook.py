@@ -0,0 +1,48 @@
+import json
+
+# A private /start message as Telegram delivers it to the webhook
+RECORDED_UPDATE = {
+    'update_id': 815000001,
+    'message': {
+        'message_id': 42,
+        'date': 1760000000,
+        'chat': {'id': 5550001, 'type': 'private', 'first_name': 'Ivan', 'username': 'ivan_p'},
+        'from': {'id': 5550001, 'is_bot': False, 'first_name': 'Ivan', 'last_name': 'Petrov',
+                 'username': 'ivan_p', 'language_code': 'ru'},
+        'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+    }
+}
+
+
+def post_update(client, secret, update):
+    return client.post('/telegram/webhook', data=json.dumps(update), content_type='application/json',
+                       headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+
+
+def test_webhook_update_is_answered_through_the_bot_api(crm, bot_api):
+    import wsgi
+
+    assert wsgi.app is crm.app
+    assert ('setWebhook', {'url': 'https://crm.example.com/telegram/webhook',
+                           'secret_token': crm.WEBHOOK_SECRET}) in bot_api.calls
+
+    response = post_update(wsgi.app.test_client(), crm.WEBHOOK_SECRET, RECORDED_UPDATE)
+    assert response.status_code == 200
+    assert response.get_json() == {'success': True}
+    crm.crm_bot.worker_pool.join()
+
+    replies = [params for method, params in bot_api.calls if method == 'sendMessage']
+    assert replies[-1]['chat_id'] == '5550001'
+    assert replies[-1]['text'] == crm.response_catalogue.get('welcome')[0].text
+
+    with crm.app.app_context():
+        user = crm.TelegramUser.query.filter_by(telegram_id=5550001).one()
+        conversation = crm.Conversation.query.filter_by(telegram_user_id=user.id).one()
+        messages = crm.Message.query.filter_by(conversation_id=conversation.id).order_by(crm.Message.id).all()
+        assert [(message.sender_type, message.text) for message in messages] == [('bot', replies[-1]['text'])]
+
+
+def test_webhook_rejects_a_wrong_secret(crm):
+    response = post_update(crm.app.test_client(), 'not-the-secret', RECORDED_UPDATE)
+    assert response.status_code == 403
@@ -0,0 +1,27 @@
+"""WSGI entry point for webhook mode, e.g. gunicorn "wsgi:app"
+
+The application lives in crm-zefir-bot.py, which can't be imported by name,
+so it is loaded from its path as the module crm_zefir_bot.
+"""
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MODULE = 'crm_zefir_bot'
+
+
+def load_module():
+    """The application module, loaded once per process"""
+    module = sys.modules.get(MODULE)
+    if module is None:
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        spec = importlib.util.spec_from_file_location(MODULE, os.path.join(ROOT, 'crm-zefir-bot.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[MODULE] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+app = load_module().create_webhook_app()